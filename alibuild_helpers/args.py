@@ -1,7 +1,7 @@
 import argparse
 from alibuild_helpers.utilities import detectArch, normalise_multiple_options, default_builder_image, docker_platform_for
 from alibuild_helpers.workarea import cleanup_git_log
-import multiprocessing
+from alibuild_helpers.scheduler import available_cpus
 
 import re
 import os
@@ -53,6 +53,10 @@ def doParseArgs():
                                       description="Generate a dependency graph for a given package.")
   doctor_parser = subparsers.add_parser("doctor", help="verify status of your system",
                                         description="Verify the status of your system.")
+  server_parser = subparsers.add_parser("server", help="keep resolved state warm between runs",
+                                        description=("Keep parsed recipes, the results of system checks "
+                                                     "and repository refs in memory, for aliBuild build, "
+                                                     "deps and doctor to reuse while this runs."))
   init_parser = subparsers.add_parser("init", help="initialise local packages",
                                       description="Initialise development packages.")
   version_parser = subparsers.add_parser("version", help="display %(prog)s version",
@@ -66,11 +70,15 @@ def doParseArgs():
   analytics_parser.add_argument("state", choices=["on", "off"], help="Whether to report analytics or not")
 
   # Options for the build command
-  build_parser.add_argument("pkgname", metavar="PACKAGE", nargs="+",
+  build_parser.add_argument("pkgname", metavar="PACKAGE", nargs="*",
                             help="One of the packages in CONFIGDIR. May be specified multiple times.")
+  build_parser.add_argument("--all", dest="allPackages", action="store_true",
+                            help=("Build all packages in CONFIGDIR that can be built with the selected "
+                                  "defaults, as a single build sharing their common dependencies."))
 
   build_parser.add_argument("--defaults", dest="defaults", default="o2", metavar="DEFAULT",
-                            help="Use defaults from CONFIGDIR/defaults-%(metavar)s.sh.")
+                            help=("Use defaults from CONFIGDIR/defaults-%(metavar)s.sh. Several "
+                                  "comma-separated defaults build the packages with each of them in turn."))
   build_parser.add_argument("-a", "--architecture", dest="architecture", metavar="ARCH", default=detectedArch,
                             help=("Build as if on the specified architecture. When used with --docker, build "
                                   "inside a Docker image for the specified architecture. Default is the current "
@@ -81,9 +89,56 @@ def doParseArgs():
                             help="Version name to use for development packages. Defaults to branch name.")
   build_parser.add_argument("-e", dest="environment", action="append", default=[],
                             help="KEY=VALUE binding to add to the build environment. May be specified multiple times.")
-  build_parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=multiprocessing.cpu_count(),
+  build_parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=available_cpus(),
                             help=("The number of parallel compilation processes to run. "
                                   "Default for this system: %(default)d."))
+  build_parser.add_argument("--build-memory", dest="buildMemory", type=float, default=None, metavar="GB",
+                            help=("The memory, in gigabytes, that concurrent builds (see --builders) may use "
+                                  "in total. Builds only start if the memory they are expected to need is free, and use fewer jobs "
+                                  "if needed to fit. Default: the memory available on this system, "
+                                  "respecting cgroup limits."))
+  build_parser.add_argument("--builders", dest="builders", type=int, default=1, metavar="N",
+                            help=("The number of packages to build at the same time. A package is started "
+                                  "as soon as all its dependencies have been built, and the --jobs budget "
+                                  "is split between the packages building at the same time. "
+                                  "Default %(default)d."))
+  build_parser.add_argument("--build-timeout", dest="buildTimeout", type=float, default=8 * 60, metavar="MINUTES",
+                            help=("Stop a package's build, and everything it started, if it takes longer than "
+                                  "%(metavar)s minutes. Default %(default)g."))
+  build_parser.add_argument("--idle-timeout", dest="idleTimeout", type=float, default=0, metavar="MINUTES",
+                            help=("Stop a package's build, and everything it started, if it prints nothing "
+                                  "for %(metavar)s minutes, e.g. because it waits for input. By default, "
+                                  "builds are never stopped for being quiet."))
+  build_parser.add_argument("--resume", dest="resume", action="store_true",
+                            help=("Continue from the plan saved by the previous build of the same packages, "
+                                  "skipping the packages it already finished, if the recipes and options "
+                                  "have not changed since."))
+  build_parser.add_argument("--worker", dest="worker", action="store_true",
+                            help=("Share the build with other aliBuild processes building the same packages "
+                                  "in the same work directory, possibly on other hosts. Each package is built "
+                                  "by the first process to claim it, using lock files in WORKDIR/BUILD/locks."))
+  build_parser.add_argument("--shard", dest="shard", metavar="I/N", default=None,
+                            help=("Build the I-th of N parts of the build, for splitting it over N runners "
+                                  "sharing the --write-store. Packages are split the same way by every runner, "
+                                  "balanced by their recorded build durations. Packages of other parts are "
+                                  "downloaded once another runner uploads them."))
+  build_parser.add_argument("--shard-timeout", dest="shardTimeout", metavar="MINUTES", type=float, default=120,
+                            help=("With --shard, build a package from another part here if it is not uploaded "
+                                  "within %(metavar)s minutes of being needed. Default %(default)g."))
+  build_parser.add_argument("-k", "--keep-going", dest="keepGoing", action="store_true",
+                            help=("If a package fails to build, keep building (and uploading) all packages "
+                                  "that do not depend on it, and list the failed packages and the ones "
+                                  "they blocked at the end."))
+  build_parser.add_argument("--skip-known-failures", dest="skipKnownFailures", action="store_true",
+                            help=("Do not build packages whose exact hash is known to fail to build, locally "
+                                  "or from the remote store, and share the record of failed builds through "
+                                  "the write store, if any. Such packages fail immediately, showing the end "
+                                  "of the log of the failed build (or are skipped with --keep-going)."))
+  build_parser.add_argument("--retry-failed", dest="retryFailed", action="store_true",
+                            help="With --skip-known-failures, build packages even if they are known to fail.")
+  build_parser.add_argument("--skip-build-requires", dest="skipBuildRequires", action="store_true",
+                            help=("Do not install build_requires that are only needed to build packages "
+                                  "available prebuilt from the remote store or already installed."))
   build_parser.add_argument("-u", "--fetch-repos", dest="fetchRepos", action="store_true",
                             help=("Fetch updates to repositories in MIRRORDIR. Required but nonexistent "
                                   "repositories are always cloned, even if this option is not given."))
@@ -94,6 +149,9 @@ def doParseArgs():
                                   "multiple arguments with commas."))
   build_parser.add_argument("--force-tracked", dest="forceTracked", default=False, action="store_true",
                             help=("Do not pick up any packages from a local checkout. "))
+  build_parser.add_argument("--rebuild-untracked", dest="rebuildUntracked", default=False, action="store_true",
+                            help=("Rebuild development packages with untracked files every time, instead "
+                                  "of hashing the contents of the untracked files."))
   build_parser.add_argument("--plugin", dest="plugin", default="legacy", help=("Plugin to use to do the actual build. "))
   build_parser.add_argument("--disable", dest="disable", default=[], metavar="PACKAGE", action="append",
                             help=("Do not build %(metavar)s and all its (unique) dependencies. "
@@ -156,6 +214,14 @@ def doParseArgs():
                                   "except ::rw is not recognised. Implies --no-system."))
   build_remote.add_argument("--insecure", dest="insecure", action="store_true",
                             help="Don't validate TLS certificates when connecting to an https:// remote store.")
+  build_remote.add_argument("--prefetch-workers", dest="prefetchWorkers", metavar="N", type=int, default=2,
+                            help=("Download symlinks and tarballs for upcoming packages from the remote store "
+                                  "in the background using N parallel downloads, while other packages build. "
+                                  "Use 0 to disable. Default %(default)d."))
+  build_remote.add_argument("--prefetch-budget", dest="prefetchBudget", metavar="GB", type=float, default=10,
+                            help=("Only download a tarball ahead of time if, together with the ones downloaded "
+                                  "but not used yet, it takes up at most %(metavar)s gigabytes. "
+                                  "Default %(default)g."))
 
   build_dirs = build_parser.add_argument_group(title="Customise aliBuild directories")
   build_dirs.add_argument("-C", "--chdir", metavar="DIR", dest="chdir", default=DEFAULT_CHDIR,
@@ -183,6 +249,21 @@ def doParseArgs():
   build_system.add_argument("--no-system", dest="noSystem", nargs="?", const="*", default=None, metavar="PACKAGES",
                             help="Never use system packages for the provided, command separated, PACKAGES, even if compatible.")
 
+  # The prefetch command takes the same options as the build command.
+  subparsers.add_parser("prefetch", parents=[build_parser], add_help=False,
+                        help="download what building a package needs, without building it",
+                        description=("Update the repository mirrors, download the tarballs available "
+                                     "from the remote store and check out the sources to be compiled "
+                                     "for building a package, without building anything."))
+
+  # So does the explain command.
+  subparsers.add_parser("explain", parents=[build_parser], add_help=False,
+                        help="explain why packages would be rebuilt",
+                        description=("Resolve the packages like the build command, and show, for "
+                                     "every package that would get a new revision, which of its "
+                                     "recipe fields or dependencies changed since the latest "
+                                     "revision installed."))
+
   # Options for clean subcommand
   clean_parser.add_argument("-a", "--architecture", dest="architecture", metavar="ARCH", default=detectedArch,
                             help=("Clean up build results for this architecture. Default is the current system "
@@ -240,6 +321,15 @@ def doParseArgs():
   deps_system.add_argument("--no-system", dest="noSystem", nargs="?", const="*", default=None, metavar="PACKAGES",
                            help="Never use system packages for PACKAGES, even if compatible.")
 
+  # Options for the server subcommand
+  server_parser.add_argument("--socket", dest="socket", metavar="PATH", default=None,
+                             help=("Listen on the Unix socket at %(metavar)s. Clients only find the server "
+                                   "there if ALIBUILD_SERVER_SOCKET is set to the same path. Default: "
+                                   "alibuild-<uid>.sock in XDG_RUNTIME_DIR, or in the temporary directory."))
+  server_parser.add_argument("--max-age", dest="maxAge", metavar="SECONDS", type=int, default=3600,
+                             help=("Forget the results of system checks after %(metavar)s seconds. "
+                                   "Default %(default)d."))
+
   # Options for the doctor subcommand
   doctor_parser.add_argument("packages", metavar="PACKAGE", nargs="+",
                              help=("Check whether all system requirements of %(metavar)s are satisfied. "
@@ -357,7 +447,7 @@ def doParseArgs():
   def optionOrder(x):
     if x in ["--debug", "-d", "-n", "--dry-run"]:
       return 0
-    if x in ["build", "init", "clean", "analytics", "doctor", "deps", "completion"]:
+    if x in ["build", "prefetch", "explain", "init", "clean", "analytics", "doctor", "deps", "server", "completion"]:
       return 1
     return 2
   rest.sort(key=optionOrder)
@@ -399,19 +489,33 @@ S3_SUPPORTED_ARCHS = "slc7_x86-64", "slc8_x86-64", "ubuntu2004_x86-64", "ubuntu2
 def finaliseArgs(args, parser):
 
   # Nothing to finalise for version, analytics, or completion
-  if args.action in ["version", "analytics", "architecture", "completion"]:
+  if args.action in ["version", "analytics", "architecture", "completion", "server"]:
     return args
 
   # --architecture can be specified in both clean and build.
-  if args.action in ["build", "clean"] and not args.architecture:
+  if args.action in ["build", "prefetch", "explain", "clean"] and not args.architecture:
     parser.error("Cannot determine architecture. Please pass it explicitly.\n\n"
                  + ARCHITECTURE_TABLE)
 
-  if args.action == "build" and not args.forceUnknownArch and not matchValidArch(args.architecture):
+  if args.action in ("build", "prefetch", "explain") and not args.forceUnknownArch and not matchValidArch(args.architecture):
     parser.error("Unknown / unsupported architecture: {architecture}.\n\n{table}"
                  "Alternatively, you can use the `--force-unknown-architecture' option."
                  .format(table=ARCHITECTURE_TABLE, architecture=args.architecture))
 
+  if args.action in ("build", "prefetch", "explain") and not args.pkgname and not args.allPackages:
+    parser.error("Please specify at least one PACKAGE to build, or --all")
+  if args.action in ("build", "prefetch", "explain") and args.builders < 1:
+    parser.error("--builders must be at least 1")
+  if args.action in ("build", "prefetch", "explain") and (args.buildTimeout <= 0 or args.idleTimeout < 0):
+    parser.error("--build-timeout must be positive, and --idle-timeout must not be negative")
+  if args.action in ("build", "prefetch", "explain") and args.prefetchWorkers < 0:
+    parser.error("--prefetch-workers must not be negative")
+  if args.action in ("build", "prefetch", "explain") and args.shard is not None:
+    index, _, count = args.shard.partition("/")
+    if not (index.isdigit() and count.isdigit() and 1 <= int(index) <= int(count)):
+      parser.error("--shard takes arguments of the form I/N, with 1 <= I <= N")
+    args.shard = int(index), int(count)
+
   if "noDevel" in args:
     args.noDevel = normalise_multiple_options(args.noDevel)
   if "disable" in args:
@@ -419,13 +523,13 @@ def finaliseArgs(args, parser):
   if "force_rebuild" in args:
     args.force_rebuild = normalise_multiple_options(args.force_rebuild)
 
-  if args.action in ["build", "init"]:
+  if args.action in ["build", "prefetch", "explain", "init"]:
     args.referenceSources = args.referenceSources % {"workDir": args.workDir}
     # Do this cleanup as early as possible to avoid false positives due to
     # stale git logs from previous invocations.
     cleanup_git_log(args.referenceSources)
 
-  if args.action in ("build", "doctor", "deps"):
+  if args.action in ("build", "prefetch", "explain", "doctor", "deps"):
     if args.dockerImage or args.docker_extra_args:
       args.docker = True
     # In case we build with docker / containers, we add a special
@@ -467,7 +571,7 @@ def finaliseArgs(args, parser):
       in (assignment.partition("=") for assignment in args.annotate)
     }
 
-  if args.action in ("build", "doctor"):
+  if args.action in ("build", "prefetch", "explain", "doctor"):
     args.configDir = args.configDir
 
     # On selected platforms, caching is active by default
@@ -488,7 +592,10 @@ def finaliseArgs(args, parser):
       args.remoteStore = args.remoteStore[0:-4]
       args.writeStore = args.remoteStore
 
-  if args.action in ["build", "init"]:
+  if args.action in ("build", "prefetch", "explain") and args.shard and not args.writeStore:
+    parser.error("--shard needs a --write-store shared by all runners")
+
+  if args.action in ["build", "prefetch", "explain", "init"]:
     if "develPrefix" in args and args.develPrefix is None:
       if "chdir" in args:
         args.develPrefix = basename(abspath(args.chdir))
@@ -499,7 +606,7 @@ def finaliseArgs(args, parser):
 
   if args.action == "init":
     args.configDir = args.configDir % {"prefix": args.develPrefix + "/"}
-  elif args.action == "build":
+  elif args.action in ("build", "prefetch", "explain"):
     pass
   elif args.action == "clean":
     pass
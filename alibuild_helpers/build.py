@@ -3,34 +3,51 @@ from os import makedirs, unlink, readlink, rmdir
 from pathlib import Path
 from alibuild_helpers import __version__
 from alibuild_helpers.analytics import report_event
-from alibuild_helpers.log import debug, info, banner, warning
+from alibuild_helpers.log import debug, info, banner, warning, error
 from alibuild_helpers.log import dieOnError
 from alibuild_helpers.cmd import execute, ContainerRunner, container_run_string, BASH, install_wrapper_script, getstatusoutput
 from alibuild_helpers.utilities import pruneWorkdirFromPaths, pruneVersionEnvVars, symlink, call_ignoring_oserrors, topological_sort, detectArch
-from alibuild_helpers.utilities import resolve_store_path
+from alibuild_helpers.utilities import resolve_store_path, resolve_failure_path, tarball_name
 from alibuild_helpers.utilities import parseDefaults, readDefaults
 from alibuild_helpers.utilities import getPackageList, asList
-from alibuild_helpers.utilities import validateDefaults
+from alibuild_helpers.utilities import validateDefaults, getAllPackages
 from alibuild_helpers.utilities import Hasher
 from alibuild_helpers.utilities import resolve_tag, resolve_version, short_commit_hash
 from alibuild_helpers.git import Git, git
 from alibuild_helpers.sl import Sapling
 from alibuild_helpers.scm import SCMError
-from alibuild_helpers.sync import remote_from_url
+from alibuild_helpers.sync import remote_from_url, NoRemoteSync
+from alibuild_helpers.prefetch import Prefetcher
+from alibuild_helpers.server import server_cache
+from alibuild_helpers.jobserver import Jobserver, install_make_wrapper
+from alibuild_helpers.failures import read_failure, record_failure, record_success, forget_failure
+from alibuild_helpers.failures import is_recipe_failure, known_failure_message
+from alibuild_helpers.explain import explain_rebuilds
+from alibuild_helpers.hashcache import HashCache, hash_inputs, hashes_path
+from alibuild_helpers.plan import plan_path, inputs_fingerprint, read_plan, write_plan, record_finished
+from alibuild_helpers.locks import FileLock, PackageClaims, RevisionReservations
 from alibuild_helpers.workarea import logged_scm, updateReferenceRepoSpec, checkout_sources
-from alibuild_helpers.log import ProgressPrint, log_current_package
+from alibuild_helpers.log import ProgressPrint, PackageLogPrint, log_current_package
+from alibuild_helpers.scheduler import BuildScheduler, run_builds
+from alibuild_helpers.scheduler import read_durations, record_duration, expected_durations, assign_shards
+from alibuild_helpers.scheduler import read_resource_usage, record_resource_usage, expected_needs
+from alibuild_helpers.scheduler import ResourceBudget, available_memory, GiB
 from glob import glob
 from collections import OrderedDict
+from contextlib import nullcontext
+from copy import copy
 from shlex import quote
 import tempfile
 
 import concurrent.futures
 import importlib
+import hashlib
 import json
 import socket
 import os
 import re
 import shutil
+import stat
 import sys
 import time
 
@@ -48,17 +65,39 @@ def readHashFile(fn):
     return "0"
 
 
-def update_git_repos(args, specs, buildOrder):
+class ResolutionCache:
+  """Results of slow steps in resolving packages that do not depend on the defaults.
+
+  When building with several defaults in one invocation, the packages are
+  resolved once per defaults, but system checks are only run, and repositories
+  only updated, once.
+  """
+
+  def __init__(self) -> None:
+    # Maps (package, check script) to the check's exit code and output.
+    self.checks = {}
+    # Maps (package, source) to the reference repository and the refs in it.
+    self.refs = {}
+
+
+def update_git_repos(args, specs, buildOrder, cache=None):
     """Update and/or fetch required git repositories in parallel.
 
     If any repository fails to be fetched, then it is retried, while allowing the
-    user to input their credentials if required.
+    user to input their credentials if required. Repositories already updated
+    according to CACHE (a ResolutionCache) are not updated again.
     """
 
     def update_repo(package, git_prompt):
         # Note: spec["scm"] should already be initialized before this is called
         # This function just updates the repository and fetches refs
         assert "scm" in specs[package], f"specs[{package!r}] has no scm key"
+        key = package, specs[package]["source"]
+        if cache is not None and key in cache.refs:
+            reference, specs[package]["scm_refs"] = cache.refs[key]
+            if reference:
+                specs[package]["reference"] = reference
+            return
         updateReferenceRepoSpec(args.referenceSources, package, specs[package],
                                 fetch=args.fetchRepos, allowGitPrompt=git_prompt)
 
@@ -67,6 +106,8 @@ def update_git_repos(args, specs, buildOrder):
                             specs[package]["scm"].listRefsCmd(specs[package].get("reference", specs[package]["source"])),
                             ".", prompt=git_prompt, logOutput=False)
         specs[package]["scm_refs"] = specs[package]["scm"].parseRefs(output)
+        if cache is not None:
+            cache.refs[key] = specs[package].get("reference"), specs[package]["scm_refs"]
 
     progress = ProgressPrint("Updating repositories")
     requires_auth = set()
@@ -122,10 +163,11 @@ def createDistLinks(spec, specs, args, syncHelper, repoType, requiresType):
     symlink(dep_tarball, target_dir)
 
 
-def storeHashes(package, specs, considerRelocation):
+def storeHashes(package, specs, considerRelocation, cache=None):
   """Calculate various hashes for package, and store them in specs[package].
 
   Assumes that all dependencies of the package already have a definitive hash.
+  If CACHE (a HashCache) has hashes for the same inputs, they are used instead.
   """
   spec = specs[package]
 
@@ -137,14 +179,28 @@ def storeHashes(package, specs, considerRelocation):
     # subsequent calculations.
     return
 
+  fingerprint = None
+  if cache is not None and not spec.get("force_rebuild", False):
+    fingerprint = hash_inputs(spec, specs, considerRelocation)
+    if cache.restore(spec, fingerprint):
+      debug("Inputs of %s are unchanged, reusing its hashes", package)
+      return
+
   # For now, all the hashers share data -- they'll be split below.
   h_all = Hasher()
 
+  # Record what goes into the primary hash and the deps_hash, in order, so
+  # that we can tell later why they changed.
+  manifest = OrderedDict([("hash", []), ("deps_hash", [])])
+  def feed(name, data):
+    manifest["hash"].append([name, data])
+    h_all(data)
+
   if spec.get("force_rebuild", False):
-    h_all(str(time.time()))
+    feed("force_rebuild", str(time.time()))
 
   for key in ("recipe", "version", "package"):
-    h_all(spec.get(key, "none"))
+    feed(key, spec.get(key, "none"))
 
   # commit_hash could be a commit hash (if we're not building a tag, but
   # instead e.g. a branch or particular commit specified by its hash), or it
@@ -155,6 +211,7 @@ def storeHashes(package, specs, considerRelocation):
   debug("Base git ref is %s", spec["commit_hash"])
   h_default = h_all.copy()
   h_default(spec["commit_hash"])
+  manifest["hash"].append(["commit_hash", spec["commit_hash"]])
   try:
     # If spec["commit_hash"] is a tag, get the actual git commit hash.
     real_commit_hash = spec["scm_refs"]["refs/tags/" + spec["commit_hash"]]
@@ -189,7 +246,7 @@ def storeHashes(package, specs, considerRelocation):
 
   for key in modifies_full_hash_dicts:
     if key not in spec:
-      h_all("none")
+      feed(key, "none")
     else:
       # spec["env"] is of type OrderedDict[str, str].
       # spec["*_path"] are of type OrderedDict[str, list[str]].
@@ -199,14 +256,12 @@ def storeHashes(package, specs, considerRelocation):
       # Python 3.12 changed the string representation of OrderedDicts from
       # OrderedDict([(key, value)]) to OrderedDict({key: value}), so to remain
       # compatible, we need to emulate the previous string representation.
-      h_all("OrderedDict([")
-      h_all(", ".join(
+      feed(key, "OrderedDict([" + ", ".join(
         # XXX: We still rely on repr("str") being "'str'",
         # and on repr(["a", "b"]) being "['a', 'b']".
-        f"({key!r}, {value!r})"
-        for key, value in spec[key].items()
-      ))
-      h_all("])")
+        f"({name!r}, {value!r})"
+        for name, value in spec[key].items()
+      ) + "])")
 
   for tag, commit_hash, hasher in h_alternatives:
     # If the commit hash is a real hash, and not a tag, we can safely assume
@@ -216,6 +271,10 @@ def storeHashes(package, specs, considerRelocation):
       hasher(spec.get("source", "none"))
       if "source" in spec:
         hasher(tag)
+      if hasher is h_default:
+        manifest["hash"].append(["source", spec.get("source", "none")])
+        if "source" in spec:
+          manifest["hash"].append(["tag", tag])
 
   dh = Hasher()
   for dep in spec.get("requires", []):
@@ -225,21 +284,24 @@ def storeHashes(package, specs, considerRelocation):
     # If this package is a dev package, and it depends on another dev pkg, then
     # this package's hash shouldn't change if the other dev package was
     # changed, so that we can just rebuild this one incrementally.
-    h_all(specs[dep]["hash"] if spec["is_devel_pkg"] else hash_and_devel_hash)
+    feed("dependency " + dep, specs[dep]["hash"] if spec["is_devel_pkg"] else hash_and_devel_hash)
     # The deps_hash should always change, however, so we actually rebuild the
     # dependent package (even if incrementally).
     dh(hash_and_devel_hash)
+    manifest["deps_hash"].append(["dependency " + dep, hash_and_devel_hash])
 
   if spec["is_devel_pkg"] and "incremental_recipe" in spec:
-    h_all(spec["incremental_recipe"])
+    feed("incremental_recipe", spec["incremental_recipe"])
     ih = Hasher()
     ih(spec["incremental_recipe"])
     spec["incremental_hash"] = ih.hexdigest()
   elif spec["is_devel_pkg"]:
-    h_all(spec["devel_hash"])
+    feed("devel_hash", spec["devel_hash"])
 
   if considerRelocation and "relocate_paths" in spec:
-    h_all("relocate:"+" ".join(sorted(spec["relocate_paths"])))
+    feed("relocate_paths", "relocate:"+" ".join(sorted(spec["relocate_paths"])))
+
+  spec["hash_manifest"] = manifest
 
   spec["deps_hash"] = dh.hexdigest()
   spec["remote_revision_hash"] = h_default.hexdigest()
@@ -255,20 +317,61 @@ def storeHashes(package, specs, considerRelocation):
   spec["local_revision_hash"] = h_default.hexdigest()
   spec["local_hashes"] = [spec["local_revision_hash"]] + \
     list({h.hexdigest() for _, _, h, in h_alternatives} - {spec["local_revision_hash"]})
+  if fingerprint is not None:
+    cache.remember(spec, fingerprint)
 
 
-def hash_local_changes(spec):
+def hash_untracked_files(scm, directory):
+  """Hash the path, mode and contents of untracked, non-ignored files in DIRECTORY.
+
+  Files are hashed like git hashes blobs. Raise OSError if a file cannot be
+  read, e.g. because it is a nested repository.
+  """
+  h = Hasher()
+  paths = scm.exec(scm.listUntrackedCmd(), directory=directory).split("\0")
+  for path in sorted(filter(None, paths)):
+    full_path = join(directory, path)
+    st = os.lstat(full_path)
+    blob = hashlib.sha1(b"blob %d\0" % st.st_size)
+    if stat.S_ISLNK(st.st_mode):
+      mode = "120000"
+      blob.update(os.fsencode(os.readlink(full_path)))
+    else:
+      mode = "100755" if st.st_mode & stat.S_IXUSR else "100644"
+      with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+          blob.update(chunk)
+    h(f"{mode} blob {blob.hexdigest()}\t{path}\n")
+  return h.hexdigest()
+
+
+def hash_local_changes(spec, hash_untracked=True, cache=None):
   """Produce a hash of all local changes in the given git repo.
 
-  If there are untracked files, this function returns a unique hash to force a
-  rebuild, and logs a warning, as we cannot detect changes to those files.
+  Untracked files are hashed by their contents, unless HASH_UNTRACKED is false
+  or their contents cannot be read. In that case, if there are untracked
+  files, this function returns a unique hash to force a rebuild, and logs a
+  warning, as we cannot detect changes to those files.
+
+  If `aliBuild server` watches the repository for us (through CACHE), and
+  nothing changed in it since the hash was last calculated, the hash is not
+  calculated again.
   """
   directory = spec["source"]
   scm = spec["scm"]
+  watched = getattr(cache, "local_changes", None)
+  key = None
+  if watched is not None and watched.watch(abspath(directory)):
+    key = (abspath(directory), scm.checkedOutCommitName(directory=directory).strip(),
+           tuple(spec.get("track_env", {}).items()), hash_untracked)
+    if key in watched:
+      debug("Nothing changed in %s since its local changes were hashed", directory)
+      return watched[key], []
   untrackedFilesDirectories = []
   class UntrackedChangesError(Exception):
     """Signal that we cannot detect code changes due to untracked files."""
   h = Hasher()
+  hasUntracked = False
   if "track_env" in spec:
     assert isinstance(spec["track_env"], OrderedDict), \
         "spec[{!r}] was of type {!r}".format("track_env", type(spec["track_env"]))
@@ -283,17 +386,26 @@ def hash_local_changes(spec):
         f"({key!r}, {value!r})" for key, value in spec["track_env"].items()))
     h("])")
   def hash_output(msg, args):
+    nonlocal hasUntracked
     lines = msg % args
     # `git status --porcelain` indicates untracked files using "??".
     # Lines from `git diff` never start with "??".
     if any(scm.checkUntracked(line) for line in lines.split("\n")):
-      raise UntrackedChangesError()
+      if not hash_untracked:
+        raise UntrackedChangesError()
+      hasUntracked = True
     h(lines)
   cmd = scm.diffCmd(directory)
   try:
     err = execute(cmd, hash_output)
     debug("Command %s returned %d", cmd, err)
     dieOnError(err, "Unable to detect source code changes.")
+    if hasUntracked:
+      try:
+        h(hash_untracked_files(scm, directory))
+      except (OSError, SCMError) as exc:
+        debug("Cannot hash untracked files in %s: %s", directory, exc)
+        raise UntrackedChangesError() from exc
   except UntrackedChangesError:
     untrackedFilesDirectories = [directory]
     warning("You have untracked changes in %s, so aliBuild cannot detect "
@@ -304,9 +416,118 @@ def hash_local_changes(spec):
     # and let CMake figure out what needs to be rebuilt. Force a rebuild by
     # changing the hash to something basically random.
     h(str(time.time()))
+  # A hash forcing a rebuild must not be used again.
+  if key is not None and not untrackedFilesDirectories:
+    watched[key] = h.hexdigest()
   return (h.hexdigest(), untrackedFilesDirectories)
 
 
+def devel_sources_changed(specs, hash_untracked=True, cache=None):
+  """Check if any development package changed since its devel_hash was taken."""
+  for spec in specs.values():
+    if not spec["is_devel_pkg"]:
+      continue
+    local_hash, _ = hash_local_changes(spec, hash_untracked, cache)
+    commit = spec["scm"].checkedOutCommitName(directory=spec["source"]).strip()
+    if commit + local_hash != spec["devel_hash"]:
+      debug("Development package %s changed", spec["package"])
+      return True
+  return False
+
+
+def is_installed(spec, workDir, architecture):
+  """Check if SPEC is installed in its final location with its chosen hash."""
+  if spec["is_devel_pkg"] or "hash" not in spec or "revision" not in spec:
+    return False
+  installDir = join(workDir, architecture, spec["package"],
+                    "{version}-{revision}".format(**spec))
+  # As in doBuild, we take symlinked installations (e.g. to CVMFS) for good.
+  return os.path.islink(installDir) or \
+    readHashFile(join(installDir, ".build-hash")) == spec["hash"]
+
+
+def can_upload(spec, specs, syncHelper):
+  """Return whether SPEC's build may be uploaded to the write store, if any.
+
+  Development packages, and everything depending on them, are built from
+  local changes, so they must not be shared through the store.
+  """
+  return bool(getattr(syncHelper, "writeStore", None)) and \
+    not spec["is_devel_pkg"] and \
+    not any(specs[dep]["is_devel_pkg"] for dep in spec["full_requires"])
+
+
+def build_requires_to_skip(buildOrder, specs, targets, prebuilt):
+  """Return the packages in BUILDORDER that nothing needs to be installed.
+
+  We only need to install the packages we were asked to build (TARGETS), the
+  packages nothing else in BUILDORDER depends on, and whatever these need.
+  Packages in PREBUILT are installed from a tarball or are already installed,
+  so they only need their runtime dependencies, not their build_requires.
+  """
+  needed = set(targets) & set(buildOrder)
+  needed.update(set(buildOrder) - {dep for p in buildOrder for dep in specs[p]["requires"]})
+  # Dependencies always come before the packages using them, so walking the
+  # build order backwards sees every consumer of a package before the package.
+  for p in reversed(buildOrder):
+    if p in needed:
+      needed.update(specs[p]["runtime_requires" if p in prebuilt else "requires"])
+  return {p for p in buildOrder if p not in needed}
+
+
+def format_duration(seconds):
+  """Return a short human-readable form of the given number of seconds."""
+  minutes = int(round(seconds / 60))
+  if minutes < 1:
+    return "%ds" % round(seconds)
+  return "%dh%02dm" % divmod(minutes, 60) if minutes >= 60 else "%dm" % minutes
+
+
+def format_size(size):
+  """Return a short human-readable form of the given number of bytes."""
+  for unit in ("B", "KiB", "MiB"):
+    if size < 1024:
+      return ("%d %s" if unit == "B" else "%.1f %s") % (size, unit)
+    size /= 1024
+  return "%.1f GiB" % size
+
+
+def build_estimate(buildOrder, specs, actions, sizes, durations, recorded):
+  """Return a report of what building the packages in BUILDORDER takes.
+
+  ACTIONS maps each package to "installed", "unpack" (a tarball we have
+  already), "download" or "compile". SIZES gives the size of the tarballs to
+  download, or None if unknown. DURATIONS gives the expected time to compile
+  each package; the ones not in RECORDED were never compiled at this version.
+  """
+  lines = []
+  download = unknown_sizes = compile_time = 0
+  for p in buildOrder:
+    action = actions[p]
+    detail = ""
+    if action == "download":
+      if sizes.get(p) is None:
+        unknown_sizes += 1
+        detail = "unknown size"
+      else:
+        download += sizes[p]
+        detail = format_size(sizes[p])
+    elif action == "compile":
+      compile_time += durations[p]
+      detail = "~" + format_duration(durations[p])
+      if p not in recorded:
+        detail += " (guess)"
+    lines.append("  %-40s %-10s %s" % ("%s@%s" % (p, specs[p]["version"]), action, detail))
+  downloads = sum(action == "download" for action in actions.values())
+  compiles = sum(action == "compile" for action in actions.values())
+  lines.append("")
+  lines.append("Total: %d to download (%s%s), %d to compile (~%s)." % (
+    downloads, format_size(download),
+    " and %d of unknown size" % unknown_sizes if unknown_sizes else "",
+    compiles, format_duration(compile_time)))
+  return "\n".join(lines)
+
+
 def better_tarball(spec, old, new):
   """Return which tarball we should prefer to reuse."""
   if not old: return new
@@ -322,11 +543,12 @@ def better_tarball(spec, old, new):
   return old if hashes.index(old_hash) < hashes.index(new_hash) else new
 
 
-def generate_initdotsh(package, specs, architecture, post_build=False):
+def generate_initdotsh(package, specs, architecture, post_build=False, skip=()):
   """Return the contents of the given package's etc/profile/init.sh as a string.
 
   If post_build is true, also generate variables pointing to the package
   itself; else, only generate variables pointing at it dependencies.
+  Dependencies in skip are not installed, so their environment is not loaded.
   """
   spec = specs[package]
   # Allow users to override ALIBUILD_ARCH_PREFIX if they manually source
@@ -348,7 +570,7 @@ def generate_initdotsh(package, specs, architecture, post_build=False):
     package=quote(specs[dep]["package"]),
     version=quote(specs[dep]["version"]),
     revision=quote(specs[dep]["revision"]),
-  ) for dep in spec.get("requires", ()))
+  ) for dep in spec.get("requires", ()) if dep not in skip)
 
   if post_build:
     bigpackage = package.upper().replace("-", "_")
@@ -439,6 +661,8 @@ def create_provenance_info(package, specs, args):
     "architecture": args.architecture,
     "defaults": args.defaults,
     "package": spec_info(specs[package]),
+    # What the package's hashes were calculated from; see storeHashes.
+    "hash_inputs": specs[package].get("hash_manifest"),
     "dependencies": {
       "direct": {
         "build": dependency_list("build_requires"),
@@ -452,67 +676,118 @@ def create_provenance_info(package, specs, args):
   })
 
 
-def doBuild(args, parser):
-  syncHelper = remote_from_url(args.remoteStore, args.writeStore, args.architecture,
-                               args.workDir, getattr(args, "insecure", False))
+def build_error_message(spec, specs, args, buildWorkDir):
+  """Return a message explaining that the build of the given package failed."""
+  updatablePkgs = [dep for dep in spec["requires"] if specs[dep]["is_devel_pkg"]]
+  if spec["is_devel_pkg"]:
+    updatablePkgs.append(spec["package"])
 
-  packages = args.pkgname
-  specs = {}
-  buildOrder = []
-  workDir = abspath(args.workDir)
-  pruneWorkdirFromPaths(workDir)
+  # Determine paths
+  devSuffix = "-" + args.develPrefix if "develPrefix" in args and spec["is_devel_pkg"] else ""
+  log_path = f"{buildWorkDir}/BUILD/{spec['package']}-latest{devSuffix}/log"
+  build_dir = f"{buildWorkDir}/BUILD/{spec['package']}-latest{devSuffix}/{spec['package']}"
 
-  dieOnError(not exists(args.configDir),
-             'Cannot find alidist recipes under directory "%s".\n'
-             'Maybe you need to "cd" to the right directory or '
-             'you forgot to run "aliBuild init"?' % args.configDir)
+  # Use relative paths if we're inside the work directory
+  try:
+    from os.path import relpath
+    log_path = relpath(log_path, os.getcwd())
+    build_dir = relpath(build_dir, os.getcwd())
+  except (ValueError, OSError):
+    pass  # Keep absolute paths if relpath fails
 
-  _, value = git(("symbolic-ref", "-q", "HEAD"), directory=args.configDir, check=False)
-  branch_basename = re.sub("refs/heads/", "", value)
-  branch_stream = re.sub("-patches$", "", branch_basename)
-  # In case the basename and the stream are the same,
-  # the stream becomes empty.
-  if branch_stream == branch_basename:
-    branch_stream = ""
+  # Color codes for error message (if TTY)
+  bold = "\033[1m" if sys.stderr.isatty() else ""
+  red = "\033[31m" if sys.stderr.isatty() else ""
+  reset = "\033[0m" if sys.stderr.isatty() else ""
 
-  defaultsReader = lambda : readDefaults(args.configDir, args.defaults, parser.error, args.architecture)
-  (err, overrides, taps) = parseDefaults(args.disable,
-                                         defaultsReader, debug)
-  dieOnError(err, err)
+  # Build the error message
+  devel_note = " (development package)" if spec["is_devel_pkg"] else ""
+  buildErrMsg = f"{red}{bold}BUILD FAILED:{reset} {spec['package']}@{spec['version']}{devel_note}\n"
+  buildErrMsg += "=" * 70 + "\n\n"
 
-  makedirs(join(workDir, "SPECS"), exist_ok=True)
+  buildErrMsg += f"{bold}Log File:{reset}\n"
+  buildErrMsg += f"  {log_path}\n\n"
 
-  # If the alidist workdir contains a .sl directory (or .git/sl for git repos
-  # with Sapling enabled), we use Sapling as SCM. Otherwise, we default to git
-  # (without checking for the actual presence of .git). We mustn't check for a
-  # .git directory, because some tests use a subdirectory of the alibuild source
-  # tree as the "alidist" checkout, and that won't have a .git directory.
-  config_path = Path(args.configDir)
-  has_sapling = (config_path / ".sl").exists() or (config_path / ".git" / "sl").exists()
-  if has_sapling and shutil.which("sl"):
-    scm = Sapling()
-  else:
-    scm = Git()
-  # ALIBUILD_ALIDIST_HASH is provenance only (recorded in the AC entry and logged;
-  # it is NOT part of the action hash). Normally it is the alidist checkout's
-  # commit. A caller that has the recipes without an SCM checkout -- e.g.
-  # the upcoming `aliBuild reconstruct`, which materialises archived recipes into a plain
-  # directory -- can instead pre-set it in the environment; we honour that only
-  # when there is genuinely no checkout to read (an SCMError below).
+  buildErrMsg += f"{bold}Build Directory:{reset}\n"
+  buildErrMsg += f"  {build_dir}\n"
+
+  # Gather build info for the error message
   try:
-    os.environ["ALIBUILD_ALIDIST_HASH"] = scm.checkedOutCommitName(directory=args.configDir)
-  except SCMError:
-    dieOnError("ALIBUILD_ALIDIST_HASH" not in os.environ,
-               "Cannot find SCM directory in %s. If the recipes are not a checkout, "
-               "set ALIBUILD_ALIDIST_HASH." % args.configDir)
+    detected_arch = detectArch()
 
-  debug("Building for architecture %s", args.architecture)
-  debug("Number of parallel builds: %d", args.jobs)
-  debug("Using aliBuild from alibuild@%s recipes in alidist@%s",
-        __version__ or "unknown", os.environ["ALIBUILD_ALIDIST_HASH"])
+    # Only show safe arguments (no tokens/secrets) in CLI-usable format
+    safe_args = {
+      "pkgname", "defaults", "architecture", "forceUnknownArch",
+      "develPrefix", "jobs", "noSystem", "noDevel", "forceTracked", "plugin",
+      "disable", "annotate", "onlyDeps", "docker", "builders"
+    }
+      
+    cli_args = []
+    for k, v in vars(args).items():
+      if not v or k not in safe_args:
+        continue
+        
+      # Format based on type for CLI usage
+      if isinstance(v, bool):
+        if v:  # Only show if True
+          cli_args.append(f"--{k}")
+      elif isinstance(v, list):
+        if v:  # Only show non-empty lists
+          # For lists, use multiple --flag value or --flag=val1,val2
+          for item in v:
+            cli_args.append(f"--{k}={quote(str(item))}")
+      else:
+        # Quote if needed
+        cli_args.append(f"--{k}={quote(str(v))}")
+      
+    args_str = " ".join(cli_args)
+
+    buildErrMsg += f"\n{bold}Environment:{reset}\n"
+    buildErrMsg += f"  OS: {detected_arch}\n"
+    buildErrMsg += f"  aliBuild: {__version__ or 'unknown'} (alidist@{os.environ['ALIBUILD_ALIDIST_HASH'][:10]})\n"
+
+    if detected_arch.startswith("osx"):
+      macos_version = getstatusoutput("sw_vers --productVersion")[1].strip()
+      buildErrMsg += f"  macOS: {macos_version or 'unknown'}\n"
+      xcode_info = getstatusoutput("xcodebuild -version")[1]
+      # Combine XCode version lines into one
+      xcode_lines = xcode_info.strip().split('\n')
+      if len(xcode_lines) >= 2:
+        xcode_str = f"{xcode_lines[0]} ({xcode_lines[1]})"
+      else:
+        xcode_str = xcode_lines[0] if xcode_lines else "Unknown"
+      buildErrMsg += f"  XCode: {xcode_str}\n"
 
-  install_wrapper_script("git", workDir)
+    buildErrMsg += f"  Arguments: {args_str}\n"
+
+  except Exception as exc:
+    warning("Failed to gather build info", exc_info=exc)
+
+  # Add note about development packages if applicable
+  if updatablePkgs:
+    buildErrMsg += f"\n{bold}Development Packages:{reset}\n"
+    buildErrMsg += "  Development sources are not updated automatically.\n"
+    buildErrMsg += "  This may be due to outdated sources. To update:\n"
+    buildErrMsg += "".join(f"\n    ( cd {dp} && git pull --rebase )" for dp in updatablePkgs)
+    buildErrMsg += "\n"
 
+  # Add Next Steps section
+  buildErrMsg += f"\n{bold}Next Steps:{reset}\n"
+  buildErrMsg += f"  • View error log:          cat {log_path}\n"
+  if not args.debug:
+    buildErrMsg += f"  • Rebuild with debug:      aliBuild build {spec['package']} --debug\n"
+  buildErrMsg += f"  • Please upload the full log to CERNBox/Dropbox if you intend to request support.\n"
+  return buildErrMsg.strip()
+
+
+def resolve_packages(args, overrides, taps, branch_basename, branch_stream, cache=None):
+  """Work out which packages to build, in which order, and from which sources.
+
+  This checks which packages can be taken from the system, updates the
+  packages' source repositories and resolves their tags to commits, which is
+  slow, so doBuild can skip it when resuming from a saved plan.
+  """
+  specs = {}
   extra_env = {
     "ALIBUILD_CONFIG_DIR": "/alidist" if args.docker else os.path.abspath(args.configDir),
     "ALIBUILD_VERSION": __version__ or "unknown"
@@ -521,11 +796,17 @@ def doBuild(args, parser):
 
   with ContainerRunner(args.dockerImage, args.docker_extra_args, extra_env=extra_env, extra_volumes=[f"{os.path.abspath(args.configDir)}:/alidist:ro"] if args.docker else []) as getstatusoutput_container:
     def performPreferCheckWithTempDir(pkg, cmd):
+      key = pkg["package"], cmd
+      if cache is not None and key in cache.checks:
+        return cache.checks[key]
       with tempfile.TemporaryDirectory(prefix=f"alibuild_prefer_check_{pkg['package']}_") as temp_dir:
-        return getstatusoutput_container(cmd, cwd=temp_dir)
+        result = getstatusoutput_container(cmd, cwd=temp_dir)
+      if cache is not None:
+        cache.checks[key] = result
+      return result
 
     systemPackages, ownPackages, failed, validDefaults, systemPackageSpecs = \
-      getPackageList(packages                = packages,
+      getPackageList(packages                = args.pkgname,
                      specs                   = specs,
                      configDir               = args.configDir,
                      preferSystem            = args.preferSystem,
@@ -539,7 +820,8 @@ def doBuild(args, parser):
                      performValidateDefaults = lambda spec: validateDefaults(spec, args.defaults),
                      overrides               = overrides,
                      taps                    = taps,
-                     log                     = debug)
+                     log                     = debug,
+                     recipeCache             = getattr(cache, "recipes", None))
 
   pruneVersionEnvVars()
 
@@ -622,7 +904,7 @@ def doBuild(args, parser):
   del develPkgs
 
   # Clone/update repos
-  update_git_repos(args, specs, buildOrder)
+  update_git_repos(args, specs, buildOrder, cache)
   # This is the list of packages which have untracked files in their
   # source directory, and which are rebuilt every time. We will warn
   # about them at the end of the build.
@@ -663,7 +945,8 @@ def doBuild(args, parser):
         # Devel package: we get the commit hash from the checked source, not from remote.
         out = spec["scm"].checkedOutCommitName(directory=spec["source"])
         spec["commit_hash"] = out.strip()
-        local_hash, untracked = hash_local_changes(spec)
+        local_hash, untracked = hash_local_changes(
+          spec, hash_untracked=not getattr(args, "rebuildUntracked", False), cache=cache)
         untrackedFilesDirectories.extend(untracked)
         spec["devel_hash"] = spec["commit_hash"] + local_hash
         out = spec["scm"].branchOrRef(directory=spec["source"])
@@ -686,14 +969,8 @@ def doBuild(args, parser):
   # can always extract it from it.
   # If one of the special packages is in the list of packages to be built,
   # we use it as main package, rather than the last one.
-  if not buildOrder:
-    banner("Nothing to be done.")
-    return
-  mainPackage = buildOrder[-1]
-  mainHash = specs[mainPackage]["commit_hash"]
-
-  debug("Main package is %s@%s", mainPackage, mainHash)
-  log_current_package(None, mainPackage, specs, getattr(args, "develPrefix", None))
+  if buildOrder:
+    debug("Main package is %s@%s", buildOrder[-1], specs[buildOrder[-1]]["commit_hash"])
 
   # Now that we have the main package set, we can print out Useful information
   # which we will be able to associate with this build. Also lets make sure each package
@@ -725,28 +1002,215 @@ def doBuild(args, parser):
     # pure build_requires only anymore, so we drop it from the list.
     spec["full_build_requires"] -= spec["full_runtime_requires"]
 
+  return specs, buildOrder, systemPackages, ownPackages, untrackedFilesDirectories, develPackageBranch
+
+
+def doPrefetch(args, parser):
+  """Fetch what building the requested packages needs, but build nothing.
+
+  This updates the repository mirrors, fetches the available symlinks and
+  tarballs from the remote store, and checks out the sources of the packages
+  that would have to be compiled, so that a later build needs no network.
+  """
+  args.prefetchOnly = True
+  args.fetchRepos = True
+  doBuild(args, parser)
+
+
+def doExplain(args, parser):
+  """Explain why building the requested packages would rebuild each package.
+
+  This resolves the packages and calculates their hashes like a build does,
+  then compares what each hash was calculated from with the inputs recorded
+  by the latest installed revision of the package.
+  """
+  args.explainOnly = True
+  doBuild(args, parser)
+
+
+def doBuild(args, parser, cache=None):
+  # If `aliBuild server` is running, it remembers the system checks,
+  # repository refs and parsed recipes of previous runs for us.
+  if cache is None:
+    cache = server_cache(args)
+
+  # With several comma-separated defaults, build the packages for each of them
+  # in turn. Packages that hash the same for several defaults are only built
+  # once, and CACHE avoids running the same system checks and repository
+  # updates again.
+  if "," in args.defaults:
+    cache = cache or ResolutionCache()
+    failedDefaults = []
+    for defaults in args.defaults.split(","):
+      banner("Building %s with defaults %s", ", ".join(args.pkgname) or "all packages", defaults)
+      variant = copy(args)
+      variant.defaults = defaults
+      # These lists are extended while resolving packages.
+      variant.disable = list(args.disable)
+      variant.pkgname = list(args.pkgname)
+      try:
+        doBuild(variant, parser, cache)
+      except SystemExit:
+        if not getattr(args, "keepGoing", False):
+          raise
+        failedDefaults.append(defaults)
+    dieOnError(failedDefaults, "Build failed with defaults: %s" % ", ".join(failedDefaults))
+    return
+
+  syncHelper = remote_from_url(args.remoteStore, args.writeStore, args.architecture,
+                               args.workDir, getattr(args, "insecure", False))
+
+  workDir = abspath(args.workDir)
+  pruneWorkdirFromPaths(workDir)
+
+  dieOnError(not exists(args.configDir),
+             'Cannot find alidist recipes under directory "%s".\n'
+             'Maybe you need to "cd" to the right directory or '
+             'you forgot to run "aliBuild init"?' % args.configDir)
+
+  _, value = git(("symbolic-ref", "-q", "HEAD"), directory=args.configDir, check=False)
+  branch_basename = re.sub("refs/heads/", "", value)
+  branch_stream = re.sub("-patches$", "", branch_basename)
+  # In case the basename and the stream are the same,
+  # the stream becomes empty.
+  if branch_stream == branch_basename:
+    branch_stream = ""
+
+  defaultsReader = lambda : readDefaults(args.configDir, args.defaults, parser.error, args.architecture)
+  (err, overrides, taps) = parseDefaults(args.disable,
+                                         defaultsReader, debug)
+  dieOnError(err, err)
+
+  # With --all, we build every package we have a recipe for. They are resolved
+  # together, so that the dependencies they share are only processed once.
+  if getattr(args, "allPackages", False):
+    args.pkgname = sorted(set(args.pkgname) |
+                          set(getAllPackages(args.configDir, args.defaults, args.disable)))
+    dieOnError(not args.pkgname, "No packages to build found in %s" % args.configDir)
+    banner("Building all %d packages in %s.", len(args.pkgname), args.configDir)
+
+  makedirs(join(workDir, "SPECS"), exist_ok=True)
+
+  # If the alidist workdir contains a .sl directory (or .git/sl for git repos
+  # with Sapling enabled), we use Sapling as SCM. Otherwise, we default to git
+  # (without checking for the actual presence of .git). We mustn't check for a
+  # .git directory, because some tests use a subdirectory of the alibuild source
+  # tree as the "alidist" checkout, and that won't have a .git directory.
+  config_path = Path(args.configDir)
+  has_sapling = (config_path / ".sl").exists() or (config_path / ".git" / "sl").exists()
+  if has_sapling and shutil.which("sl"):
+    scm = Sapling()
+  else:
+    scm = Git()
+  # ALIBUILD_ALIDIST_HASH is provenance only (recorded in the AC entry and logged;
+  # it is NOT part of the action hash). Normally it is the alidist checkout's
+  # commit. A caller that has the recipes without an SCM checkout -- e.g.
+  # the upcoming `aliBuild reconstruct`, which materialises archived recipes into a plain
+  # directory -- can instead pre-set it in the environment; we honour that only
+  # when there is genuinely no checkout to read (an SCMError below).
+  try:
+    os.environ["ALIBUILD_ALIDIST_HASH"] = scm.checkedOutCommitName(directory=args.configDir)
+  except SCMError:
+    dieOnError("ALIBUILD_ALIDIST_HASH" not in os.environ,
+               "Cannot find SCM directory in %s. If the recipes are not a checkout, "
+               "set ALIBUILD_ALIDIST_HASH." % args.configDir)
+
+  debug("Building for architecture %s", args.architecture)
+  debug("Number of parallel builds: %d", args.jobs)
+  debug("Using aliBuild from alibuild@%s recipes in alidist@%s",
+        __version__ or "unknown", os.environ["ALIBUILD_ALIDIST_HASH"])
+
+  install_wrapper_script("git", workDir)
+
+  # Resume from the plan saved by a previous build of the same packages, if
+  # nothing it was based on has changed since.
+  planFile = plan_path(workDir, args.architecture, args.pkgname, args.defaults)
+  inputsHash = inputs_fingerprint(args, os.environ["ALIBUILD_ALIDIST_HASH"])
+  # Workers building the same packages share one plan. Only the first one
+  # resolves the packages; the others wait for it, then use its plan. Every
+  # worker holds a shared lock on planUsers while it runs. If none does, the
+  # saved plan is from an earlier build, whose branches may have moved since.
+  worker = getattr(args, "worker", False)
+  planLock = planUsers = None
+  sharedPlan = False
+  if worker:
+    planLock = FileLock(join(workDir, "BUILD", "locks", basename(planFile) + ".lock"))
+    planLock.acquire()
+    planUsers = FileLock(join(workDir, "BUILD", "locks", basename(planFile) + ".users"))
+    sharedPlan = not planUsers.acquire(blocking=False)
+    planUsers.release()
+    planUsers.acquire(shared=True)
+  plan = read_plan(planFile, inputsHash) \
+    if getattr(args, "resume", False) or (sharedPlan and exists(planFile)) else None
+  if plan is not None and devel_sources_changed(plan["specs"], not getattr(args, "rebuildUntracked", False),
+                                                 cache):
+    warning("Development packages changed since the saved plan was made, not resuming.")
+    plan = None
+
+  if plan is not None:
+    specs, buildOrder = plan["specs"], plan["build_order"]
+    # Only skip packages that are still installed the way the plan says.
+    finishedPackages = {p for p in plan["finished"]
+                        if is_installed(specs[p], workDir, args.architecture)}
+    banner("Resuming build from saved plan; %d of %d packages are already done.",
+           len(finishedPackages), len(buildOrder))
+    systemPackages, ownPackages = plan["system_packages"], plan["own_packages"]
+    untrackedFilesDirectories = plan["untracked_directories"]
+    develPackageBranch = plan["devel_branch"]
+  else:
+    specs, buildOrder, systemPackages, ownPackages, untrackedFilesDirectories, develPackageBranch = \
+      resolve_packages(args, overrides, taps, branch_basename, branch_stream, cache)
+    finishedPackages = set()
+
+  if not buildOrder:
+    banner("Nothing to be done.")
+    if planLock:
+      planLock.release()
+      planUsers.release()
+    return
+  mainPackage = buildOrder[-1]
+  log_current_package(None, mainPackage, specs, getattr(args, "develPrefix", None))
+
   # Use the selected plugin to build, instead of the default behaviour, if a
-  # plugin was selected.
+  # plugin was selected. Plugins that run the build scripts themselves get
+  # them once we have prepared every package, below.
+  plugin = None
   if args.plugin != "legacy":
-    return importlib.import_module("alibuild_helpers.%s_plugin" % args.plugin) \
-                    .build_plugin(specs, args, buildOrder)
+    plugin = importlib.import_module("alibuild_helpers.%s_plugin" % args.plugin)
+    if not getattr(plugin, "needs_build_scripts", False):
+      if planLock:
+        planLock.release()
+        planUsers.release()
+      return plugin.build_plugin(specs, args, buildOrder)
+
+  # Save the plan now, and record every package once it is finished, so that
+  # a failed build can be resumed from where it stopped. A plan we read is
+  # already saved, and other workers may be recording their progress in it.
+  if plan is None:
+    write_plan(planFile, inputsHash, buildOrder, specs, finishedPackages,
+               systemPackages, ownPackages, untrackedFilesDirectories,
+               develPackageBranch)
+  if planLock:
+    planLock.release()
 
   debug("We will build packages in the following order: %s", " ".join(buildOrder))
-  if args.dryRun:
-    info("--dry-run / -n specified. Not building.")
-    return
 
   # We now iterate on all the packages, making sure we build correctly every
   # single one of them. This is done this way so that the second time we run we
   # can check if the build was consistent and if it is, we bail out.
-  report_event("install", "{p} disabled={dis} devel={dev} system={sys} own={own} deps={deps}".format(
-    p=args.pkgname,
-    dis=",".join(sorted(args.disable)),
-    dev=",".join(sorted(spec["package"] for spec in specs.values() if spec["is_devel_pkg"])),
-    sys=",".join(sorted(systemPackages)),
-    own=",".join(sorted(ownPackages)),
-    deps=",".join(buildOrder[:-1]),
-  ), args.architecture)
+  # With --dry-run, for aliBuild prefetch and explain, and for plugins,
+  # nothing is built.
+  buildNothing = args.dryRun or getattr(args, "prefetchOnly", False) or \
+    getattr(args, "explainOnly", False) or plugin is not None
+  if not buildNothing:
+    report_event("install", "{p} disabled={dis} devel={dev} system={sys} own={own} deps={deps}".format(
+      p=args.pkgname,
+      dis=",".join(sorted(args.disable)),
+      dev=",".join(sorted(spec["package"] for spec in specs.values() if spec["is_devel_pkg"])),
+      sys=",".join(sorted(systemPackages)),
+      own=",".join(sorted(ownPackages)),
+      deps=",".join(buildOrder[:-1]),
+    ), args.architecture)
 
   # If we are building only the dependencies, the last package in
   # the build order can be considered done.
@@ -754,11 +1218,59 @@ def doBuild(args, parser):
     mainPackage = buildOrder.pop()
     warning("Not rebuilding %s because --only-deps option provided.", mainPackage)
 
-  while buildOrder:
-    p = buildOrder[0]
+  builders = getattr(args, "builders", 1)
+  # Packages whose inputs are the same as last time keep their hashes.
+  hashCache = HashCache(hashes_path(workDir, args.architecture))
+  # When resuming, the main package might be done already.
+  mainBuildFamily = specs[mainPackage].get("build_family")
+
+  # Fetch what upcoming packages need from the remote store while we build.
+  prefetcher = None
+  if getattr(args, "prefetchWorkers", 0) and not isinstance(syncHelper, NoRemoteSync) and \
+     not buildNothing:
+    prefetcher = Prefetcher(syncHelper, workDir, args.architecture, args.prefetchWorkers,
+                            int(args.prefetchBudget * 1024**3))
+
+  # Concurrent builds share one pool of compilation jobs through a GNU make
+  # jobserver. Its pipe cannot be passed into a container.
+  jobserver = None
+  if builders > 1 and not args.docker and not buildNothing:
+    jobserver = Jobserver(args.jobs)
+    install_make_wrapper(workDir)
+
+  # We only process packages that no other aliBuild process sharing the work
+  # directory (e.g. another worker) is processing. If one is, we wait for it to
+  # install the package, then pick it up from there instead of building it.
+  claims = PackageClaims(join(workDir, "BUILD", "locks"))
+  # The revisions we reserved, until their package is finished or failed.
+  reservedRevisions = {}
+
+  def release_package(p):
+    if p in reservedRevisions:
+      directory, revision, holder = reservedRevisions.pop(p)
+      with RevisionReservations(directory) as reservations:
+        reservations.release(revision, holder)
+    claims.release(p)
+
+  def prefetch_ready():
+    """Start prefetching for packages whose dependencies have a definitive hash."""
+    for p in buildOrder:
+      if p not in prefetcher.futures and p not in finishedPackages and p not in skipped and \
+         all("hash" in specs[dep] for dep in specs[p]["requires"]):
+        storeHashes(p, specs, considerRelocation=args.architecture.startswith("osx"), cache=hashCache)
+        prefetcher.schedule(specs[p])
+
+  def choose_revision(p, reserve=True):
+    """Calculate the hashes of package P, and choose its revision.
+
+    Return True if an existing tarball (in the remote store or locally) is
+    reused, or False if P gets a new revision. All of P's dependencies must
+    have a definitive hash already. Unless RESERVE is true and we hold the
+    claim for P, a new revision is not reserved for P, so other aliBuild
+    processes might choose it too.
+    """
+    nonlocal mainBuildFamily
     spec = specs[p]
-    log_current_package(p, mainPackage, specs, getattr(args, "develPrefix", None))
-
     # Calculate the hashes. We do this in build order so that we can guarantee
     # that the hashes of the dependencies are calculated first. Do this inside
     # the main build loop to make sure that our dependencies have been assigned
@@ -766,13 +1278,14 @@ def doBuild(args, parser):
     debug("Calculating hash.")
     debug("spec = %r", spec)
     debug("develPkgs = %r", sorted(spec["package"] for spec in specs.values() if spec["is_devel_pkg"]))
-    storeHashes(p, specs, considerRelocation=args.architecture.startswith("osx"))
+    storeHashes(p, specs, considerRelocation=args.architecture.startswith("osx"), cache=hashCache)
     debug("Hashes for recipe %s are %s (remote); %s (local)", p,
           ", ".join(spec["remote_hashes"]), ", ".join(spec["local_hashes"]))
 
     if spec["is_devel_pkg"] and getattr(syncHelper, "writeStore", None):
-      warning("Disabling remote write store from now since %s is a development package.", spec["package"])
-      syncHelper.writeStore = ""
+      warning("Not uploading %s, or anything depending on it, to the remote write store "
+              "since it is a development package.", spec["package"])
+    upload = can_upload(spec, specs, syncHelper)
 
     # Since we can execute this multiple times for a given package, in order to
     # ensure consistency, we need to reset things and make them pristine.
@@ -794,7 +1307,8 @@ def doBuild(args, parser):
     # this will result in a new package which has the same binary contents of
     # the old one but where the relocation will work for the new dictory. Here
     # we simply store the fact that we can reuse the contents of cachedTarball.
-    syncHelper.fetch_symlinks(spec)
+    if not (prefetcher and prefetcher.wait(p)):
+      syncHelper.fetch_symlinks(spec)
 
     # Decide how it should be called, based on the hash and what is already
     # available.
@@ -835,11 +1349,7 @@ def doBuild(args, parser):
     # to tag all the packages incurred in the build, this way we can have
     # a latest-<buildFamily> link for all of them an we will not incur in the
     # flip - flopping described in https://github.com/alisw/alibuild/issues/325.
-    develPrefix = ""
     possibleDevelPrefix = getattr(args, "develPrefix", develPackageBranch)
-    if spec["is_devel_pkg"]:
-      develPrefix = possibleDevelPrefix
-
     if possibleDevelPrefix:
       spec["build_family"] = f"{possibleDevelPrefix}-{args.defaults}"
     else:
@@ -849,9 +1359,9 @@ def doBuild(args, parser):
 
     candidate = None
     busyRevisions = set()
-    # We can tell that the remote store is read-only if it has an empty or
-    # no writeStore property. See below for explanation of why we need this.
-    revisionPrefix = "" if getattr(syncHelper, "writeStore", "") else "local"
+    # Packages we do not upload, e.g. because the remote store is read-only,
+    # get local revisions. See below for explanation of why we need this.
+    revisionPrefix = "" if upload else "local"
     for symlink_path in packages:
       realPath = readlink(symlink_path)
       matcher = "../../{arch}/store/[0-9a-f]{{2}}/([0-9a-f]+)/{package}-{version}-((?:local)?[0-9]+).{arch}.tar.gz$" \
@@ -874,7 +1384,7 @@ def doBuild(args, parser):
 
       # Don't re-use local revisions when we have a read-write store, so that
       # packages we'll upload later don't depend on local revisions.
-      if getattr(syncHelper, "writeStore", False) and "local" in revision:
+      if upload and "local" in revision:
         debug("Skipping revision %s because we want to upload later", revision)
         continue
 
@@ -894,9 +1404,32 @@ def doBuild(args, parser):
       # conflict with our revision N.
       # The code finding busyRevisions above already ensures that revision
       # numbers start with revisionPrefix, and has left us plain ints.
-      spec["revision"] = revisionPrefix + str(
-        min(set(range(1, max(busyRevisions) + 2)) - busyRevisions)
-        if busyRevisions else 1)
+      # Other aliBuild processes sharing the work directory may have chosen
+      # revisions whose tarballs are not in TARS yet, so we take those into
+      # account too, and reuse the one chosen for our hash if there is one.
+      def next_revision():
+        return revisionPrefix + str(min(set(range(1, max(busyRevisions) + 2)) - busyRevisions)
+                                    if busyRevisions else 1)
+      newHash = spec["local_revision_hash" if revisionPrefix else "remote_revision_hash"]
+      holder = claims.lock_path(p) if reserve else None
+      if holder is None:
+        spec["revision"] = next_revision()
+      else:
+        reservationsDir = join(workDir, "BUILD", "locks", "revisions", args.architecture,
+                               spec["package"], spec["version"])
+        with RevisionReservations(reservationsDir) as reservations:
+          reserved = {int(revision[len(revisionPrefix):]): rev_hash
+                      for revision, rev_hash in reservations.reserved().items()
+                      if revision.startswith(revisionPrefix) and
+                      revision[len(revisionPrefix):].isdigit()}
+          ours = sorted(revision for revision, rev_hash in reserved.items() if rev_hash == newHash)
+          if ours:
+            spec["revision"] = revisionPrefix + str(ours[0])
+          else:
+            busyRevisions |= set(reserved)
+            spec["revision"] = next_revision()
+            reservations.reserve(spec["revision"], newHash, holder)
+        reservedRevisions[p] = reservationsDir, spec["revision"], holder
     else:
       spec["revision"] = revision
       # Remember what hash we're actually using.
@@ -907,13 +1440,6 @@ def doBuild(args, parser):
       else:
         debug("Package %s with hash %s is already found in %s. Not building.",
               p, rev_hash, symlink_path)
-        # Ignore errors here, because the path we're linking to might not
-        # exist (if this is the first run through the loop). On the second run
-        # through, the path should have been created by the build process.
-        call_ignoring_oserrors(symlink, "{version}-{revision}".format(**spec),
-                               "{wd}/{arch}/{package}/latest-{build_family}".format(wd=workDir, arch=args.architecture, **spec))
-        call_ignoring_oserrors(symlink, "{version}-{revision}".format(**spec),
-                               "{wd}/{arch}/{package}/latest".format(wd=workDir, arch=args.architecture, **spec))
 
     # Now we know whether we're using a local or remote package, so we can set
     # the proper hash and tarball directory.
@@ -921,6 +1447,61 @@ def doBuild(args, parser):
       spec["hash"] = spec["local_revision_hash"]
     else:
       spec["hash"] = spec["remote_revision_hash"]
+    return candidate is not None
+
+  def prefetch_all():
+    """Fetch everything building the packages needs from the network."""
+    def wait_for(futures):
+      for future in concurrent.futures.as_completed(futures):
+        future.result()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.prefetchWorkers)) as executor:
+      # Revisions can only be chosen in build order, so get the symlinks of
+      # all packages first. Choosing revisions then finds them up to date.
+      needed = [p for p in buildOrder if p not in otherShards]
+      info("Fetching the list of available tarballs for %d packages", len(needed))
+      wait_for([executor.submit(syncHelper.fetch_symlinks, specs[p]) for p in needed])
+      download, checkout = [], []
+      for p in needed:
+        reused = choose_revision(p, reserve=False)
+        if not is_installed(specs[p], workDir, args.architecture) and not specs[p]["is_devel_pkg"]:
+          (download if reused else checkout).append(p)
+      info("Downloading %d tarballs and checking out the sources of %d packages",
+           len(download), len(checkout))
+      wait_for([executor.submit(syncHelper.fetch_tarball, specs[p]) for p in download] +
+               [executor.submit(checkout_sources, specs[p], workDir, args.referenceSources, args.docker)
+                for p in checkout])
+    banner("Fetched everything needed to build %s.", ", ".join(args.pkgname))
+
+  def prepare_package(p, jobs):
+    """Decide how package P is to be obtained, and write its build script.
+
+    Return None if P is already installed in its final location; else return
+    the build job to run, using JOBS parallel compilation processes. This
+    relies on all of P's dependencies having a single, definitive hash, so
+    packages must be prepared in build order.
+    """
+    spec = specs[p]
+    # With several builders, there is no single package being processed.
+    if builders == 1:
+      log_current_package(p, mainPackage, specs, getattr(args, "develPrefix", None))
+
+    if choose_revision(p) and not (spec["is_devel_pkg"] and "incremental_recipe" in spec):
+      # Ignore errors here, because the path we're linking to might not
+      # exist (if this is the first run through the loop). On the second run
+      # through, the path should have been created by the build process.
+      call_ignoring_oserrors(symlink, "{version}-{revision}".format(**spec),
+                             "{wd}/{arch}/{package}/latest-{build_family}".format(wd=workDir, arch=args.architecture, **spec))
+      call_ignoring_oserrors(symlink, "{version}-{revision}".format(**spec),
+                             "{wd}/{arch}/{package}/latest".format(wd=workDir, arch=args.architecture, **spec))
+
+    # Devel packages are associated a devel prefix, either via the -z option
+    # or using their checked out branch (see choose_revision).
+    develPrefix = getattr(args, "develPrefix", develPackageBranch) if spec["is_devel_pkg"] else ""
+
+    # Packages depending on this one might now have all the hashes they need.
+    if prefetcher:
+      prefetch_ready()
 
     # We do not use the override for devel packages, because we
     # want to avoid having to rebuild things when the /tmp gets cleaned.
@@ -956,8 +1537,7 @@ def doBuild(args, parser):
       debug("Checking if devel package %s needs rebuild", spec["package"])
       if spec["devel_hash"]+spec["deps_hash"] == spec["old_devel_hash"]:
         info("Development package %s does not need rebuild", spec["package"])
-        buildOrder.pop(0)
-        continue
+        return None
 
     # Now that we have all the information about the package we want to build, let's
     # check if it wasn't built / unpacked already.
@@ -987,7 +1567,6 @@ def doBuild(args, parser):
       if "obsolete_tarball" in spec:
         unlink(realpath(spec["obsolete_tarball"]))
         unlink(spec["obsolete_tarball"])
-      buildOrder.pop(0)
       # We can now delete the INSTALLROOT and BUILD directories,
       # assuming the package is not a development one. We also can
       # delete the SOURCES in case we have aggressive-cleanup enabled.
@@ -1011,7 +1590,7 @@ def doBuild(args, parser):
           rmdir(join(workDir, "INSTALLROOT"))
         except Exception:
           pass
-      continue
+      return None
 
     if fileHash != "0":
       debug("Mismatch between local area (%s) and the one which I should build (%s). Redoing.",
@@ -1030,6 +1609,14 @@ def doBuild(args, parser):
       debug("Found tarball in %s" % spec["cachedTarball"]
             if spec["cachedTarball"] else "No cache tarballs found")
 
+    # Do not spend time on a build we know fails the same way, unless asked to.
+    if not spec["cachedTarball"] and not spec["is_devel_pkg"] and \
+       getattr(args, "skipKnownFailures", False) and not getattr(args, "retryFailed", False):
+      syncHelper.fetch_failure(spec)
+      failure = read_failure(join(workDir, resolve_failure_path(args.architecture, spec["hash"])))
+      if failure:
+        return {"known_failure": failure, "buildWorkDir": buildWorkDir, "compiling": False}
+
     # The actual build script.
     debug("spec = %r", spec)
     
@@ -1052,8 +1639,8 @@ def doBuild(args, parser):
     writeAll("{}/{}.sh".format(scriptDir, spec["package"]), spec["recipe"])
     writeAll("%s/build.sh" % scriptDir, cmd_raw % {
       "provenance": create_provenance_info(spec["package"], specs, args),
-      "initdotsh_deps": generate_initdotsh(p, specs, args.architecture, post_build=False),
-      "initdotsh_full": generate_initdotsh(p, specs, args.architecture, post_build=True),
+      "initdotsh_deps": generate_initdotsh(p, specs, args.architecture, post_build=False, skip=skipped),
+      "initdotsh_full": generate_initdotsh(p, specs, args.architecture, post_build=True, skip=skipped),
       "develPrefix": develPrefix,
       "workDir": workDir,
       "configDir": abspath(args.configDir),
@@ -1078,7 +1665,7 @@ def doBuild(args, parser):
       ("GIT_COMMITTER_NAME", "unknown"),
       ("GIT_COMMITTER_EMAIL", "unknown"),
       ("INCREMENTAL_BUILD_HASH", spec.get("incremental_hash", "0")),
-      ("JOBS", str(args.jobs)),
+      ("JOBS", str(jobs)),
       # Produce reproducible, content-stable tarballs for packages that may be
       # uploaded to the remote store. Devel packages are never uploaded, so we
       # leave their install trees untouched to avoid perturbing mtimes that
@@ -1096,6 +1683,8 @@ def doBuild(args, parser):
       ("FULL_REQUIRES", " ".join(spec["full_requires"])),
       ("ALIBUILD_PREFER_SYSTEM_KEY", spec.get("key", "")),
     ]
+    if jobserver:
+      buildEnvironment.append(("MAKEFLAGS", jobserver.makeflags()))
     # Add the extra environment as passed from the command line.
     buildEnvironment += [e.partition('=')[::2] for e in args.environment]
 
@@ -1109,20 +1698,46 @@ def doBuild(args, parser):
                                            args.docker_extra_args, spec, specs, args.volumes, buildEnvironment)
 
     else:
-      os.environ.update(buildEnvironment)
+      # Pass the environment to this build only, rather than setting it in
+      # os.environ, so that concurrent builds do not interfere.
+      buildEnv = dict(os.environ)
+      buildEnv.update(buildEnvironment)
       build_command = f"{BASH} -e -x {quote(scriptDir)}/build.sh 2>&1"
 
     debug("Build command: %s", build_command)
     progress_msg = "Unpacking %s@%s" if cachedTarball else "Compiling %s@%s"
-    if not cachedTarball and not args.debug:
+    if not cachedTarball and not args.debug and builders == 1:
       progress_msg += " (use --debug for full output)"
-    progress = ProgressPrint(
-      progress_msg %
-      (spec["package"],
-       args.develPrefix if "develPrefix" in args and spec["is_devel_pkg"] else spec["version"])
-    )
-    # 8 hour timeout per package to prevent builds from hanging forever
-    err = execute(build_command, printer=progress, timeout=8*60*60)
+    return {
+      "command": build_command,
+      "env": None if args.docker else buildEnv,
+      "message": progress_msg % (
+        spec["package"],
+        args.develPrefix if "develPrefix" in args and spec["is_devel_pkg"] else spec["version"]),
+      "buildWorkDir": buildWorkDir,
+      "compiling": not cachedTarball,
+      "jobs": jobs,
+    }
+
+  def run_build(p, job):
+    """Run the build script for P, and publish the result if it succeeded."""
+    spec = specs[p]
+    if "known_failure" in job:
+      return 1
+    # Several builds share the terminal, so we can't show a progress bar for
+    # each of them if they run concurrently.
+    progress = (ProgressPrint if builders == 1 else PackageLogPrint)(job["message"])
+    # Stop builds that hang, printing nothing or taking too long, together
+    # with everything they started, so they do not hold up the build forever.
+    start_time = time.time()
+    # Inside a container, we would only see what the container runtime used.
+    job["usage"] = None if args.docker else {}
+    with jobserver.running() if jobserver else nullcontext():
+      err = execute(job["command"], printer=progress, env=job["env"], usage=job["usage"],
+                    pass_fds=jobserver.fds if jobserver else (), new_group=True,
+                    timeout=getattr(args, "buildTimeout", 8 * 60) * 60,
+                    idle_timeout=getattr(args, "idleTimeout", 0) * 60 or None)
+    job["duration"] = time.time() - start_time
     progress.end("failed" if err else "done", err)
     report_event("BuildError" if err else "BuildSuccess", spec["package"], " ".join((
       args.architecture,
@@ -1130,109 +1745,8 @@ def doBuild(args, parser):
       spec["commit_hash"],
       os.environ["ALIBUILD_ALIDIST_HASH"][:10],
     )))
-
-    updatablePkgs = [dep for dep in spec["requires"] if specs[dep]["is_devel_pkg"]]
-    if spec["is_devel_pkg"]:
-      updatablePkgs.append(spec["package"])
-
-    # Determine paths
-    devSuffix = "-" + args.develPrefix if "develPrefix" in args and spec["is_devel_pkg"] else ""
-    log_path = f"{buildWorkDir}/BUILD/{spec['package']}-latest{devSuffix}/log"
-    build_dir = f"{buildWorkDir}/BUILD/{spec['package']}-latest{devSuffix}/{spec['package']}"
-
-    # Use relative paths if we're inside the work directory
-    try:
-      from os.path import relpath
-      log_path = relpath(log_path, os.getcwd())
-      build_dir = relpath(build_dir, os.getcwd())
-    except (ValueError, OSError):
-      pass  # Keep absolute paths if relpath fails
-
-    # Color codes for error message (if TTY)
-    bold = "\033[1m" if sys.stderr.isatty() else ""
-    red = "\033[31m" if sys.stderr.isatty() else ""
-    reset = "\033[0m" if sys.stderr.isatty() else ""
-
-    # Build the error message
-    devel_note = " (development package)" if spec["is_devel_pkg"] else ""
-    buildErrMsg = f"{red}{bold}BUILD FAILED:{reset} {spec['package']}@{spec['version']}{devel_note}\n"
-    buildErrMsg += "=" * 70 + "\n\n"
-
-    buildErrMsg += f"{bold}Log File:{reset}\n"
-    buildErrMsg += f"  {log_path}\n\n"
-
-    buildErrMsg += f"{bold}Build Directory:{reset}\n"
-    buildErrMsg += f"  {build_dir}\n"
-
-    # Gather build info for the error message
-    try:
-      detected_arch = detectArch()
-
-      # Only show safe arguments (no tokens/secrets) in CLI-usable format
-      safe_args = {
-        "pkgname", "defaults", "architecture", "forceUnknownArch",
-        "develPrefix", "jobs", "noSystem", "noDevel", "forceTracked", "plugin",
-        "disable", "annotate", "onlyDeps", "docker"
-      }
-      
-      cli_args = []
-      for k, v in vars(args).items():
-        if not v or k not in safe_args:
-          continue
-        
-        # Format based on type for CLI usage
-        if isinstance(v, bool):
-          if v:  # Only show if True
-            cli_args.append(f"--{k}")
-        elif isinstance(v, list):
-          if v:  # Only show non-empty lists
-            # For lists, use multiple --flag value or --flag=val1,val2
-            for item in v:
-              cli_args.append(f"--{k}={quote(str(item))}")
-        else:
-          # Quote if needed
-          cli_args.append(f"--{k}={quote(str(v))}")
-      
-      args_str = " ".join(cli_args)
-
-      buildErrMsg += f"\n{bold}Environment:{reset}\n"
-      buildErrMsg += f"  OS: {detected_arch}\n"
-      buildErrMsg += f"  aliBuild: {__version__ or 'unknown'} (alidist@{os.environ['ALIBUILD_ALIDIST_HASH'][:10]})\n"
-
-      if detected_arch.startswith("osx"):
-        macos_version = getstatusoutput("sw_vers --productVersion")[1].strip()
-        buildErrMsg += f"  macOS: {macos_version or 'unknown'}\n"
-        xcode_info = getstatusoutput("xcodebuild -version")[1]
-        # Combine XCode version lines into one
-        xcode_lines = xcode_info.strip().split('\n')
-        if len(xcode_lines) >= 2:
-          xcode_str = f"{xcode_lines[0]} ({xcode_lines[1]})"
-        else:
-          xcode_str = xcode_lines[0] if xcode_lines else "Unknown"
-        buildErrMsg += f"  XCode: {xcode_str}\n"
-
-      buildErrMsg += f"  Arguments: {args_str}\n"
-
-    except Exception as exc:
-      warning("Failed to gather build info", exc_info=exc)
-
-    # Add note about development packages if applicable
-    if updatablePkgs:
-      buildErrMsg += f"\n{bold}Development Packages:{reset}\n"
-      buildErrMsg += "  Development sources are not updated automatically.\n"
-      buildErrMsg += "  This may be due to outdated sources. To update:\n"
-      buildErrMsg += "".join(f"\n    ( cd {dp} && git pull --rebase )" for dp in updatablePkgs)
-      buildErrMsg += "\n"
-
-    # Add Next Steps section
-    buildErrMsg += f"\n{bold}Next Steps:{reset}\n"
-    buildErrMsg += f"  • View error log:          cat {log_path}\n"
-    if not args.debug:
-      buildErrMsg += f"  • Rebuild with debug:      aliBuild build {spec['package']} --debug\n"
-    buildErrMsg += f"  • Please upload the full log to CERNBox/Dropbox if you intend to request support.\n"
-
-
-    dieOnError(err, buildErrMsg.strip())
+    if err:
+      return err
 
     # We need to create 2 sets of links, once with the full requires,
     # once with only direct dependencies, since that's required to
@@ -1243,10 +1757,240 @@ def doBuild(args, parser):
 
     # Make sure not to upload local-only packages! These might have been
     # produced in a previous run with a read-only remote store.
-    if not spec["revision"].startswith("local"):
+    if not spec["revision"].startswith("local") and can_upload(spec, specs, syncHelper):
       syncHelper.upload_symlinks_and_tarball(spec)
+    return err
+
+  def prepare_and_save(p, jobs):
+    job = prepare_package(p, jobs)
+    if job is None:
+      finishedPackages.add(p)
+      record_finished(planFile, specs[p])
+    return job
+
+  def complete_build(p, job, err):
+    spec = specs[p]
+    failurePath = join(workDir, resolve_failure_path(args.architecture, spec["hash"]))
+    if "known_failure" in job:
+      message = known_failure_message(spec, job["known_failure"])
+    elif err:
+      message = build_error_message(spec, specs, args, job["buildWorkDir"])
+      # Remember that this hash fails to build. Failures of development
+      # packages are expected to be fixed locally, so they are not recorded,
+      # and neither are builds that were killed, as they might succeed later.
+      if job["compiling"] and not spec["is_devel_pkg"] and is_recipe_failure(err):
+        record_failure(failurePath, spec, join(job["buildWorkDir"], "BUILD", spec["hash"], "log"))
+        if getattr(args, "skipKnownFailures", False) and can_upload(spec, specs, syncHelper):
+          syncHelper.upload_failure(spec)
+    if err and getattr(args, "keepGoing", False):
+      # Report the failure now, and let the scheduler skip everything that
+      # depends on P. We summarise all failures at the end.
+      error("%s", message)
+      return False
+    if err:
+      dieOnError(err, message)
+    # If the remote store says this hash fails to build, correct it.
+    if job["compiling"] and getattr(args, "skipKnownFailures", False) and \
+       can_upload(spec, specs, syncHelper):
+      syncHelper.fetch_failure(spec)
+      if read_failure(failurePath) is not None:
+        record_success(failurePath, spec)
+        syncHelper.upload_failure(spec)
+    forget_failure(failurePath)
+    # Only remember how long compiling a package took, as unpacking a tarball
+    # says nothing about how long the next build of the package will take.
+    if job["compiling"]:
+      record_duration(durationsFile, p, specs[p]["version"], job["duration"])
+      if job["usage"]:
+        record_resource_usage(usageFile, p, job["jobs"], job["duration"], job["usage"])
+
+  # We rank the packages that can be built at any time by how long the builds
+  # depending on them took last time, so the critical path starts first.
+  durationsFile = join(workDir, "SPECS", args.architecture, "build-durations.json")
+  durations = expected_durations(read_durations(durationsFile), specs, buildOrder)
+
+  # Only start builds when they fit in the CPUs and memory we have, and
+  # choose their number of jobs accordingly, based on what each package is
+  # declared or known to need. A single builder always uses --jobs, as asked.
+  usageFile = join(workDir, "SPECS", args.architecture, "build-resources.json")
+  buildMemory = getattr(args, "buildMemory", None)
+  resources = None
+  if builders > 1:
+    resources = ResourceBudget(
+      args.jobs, buildMemory * GiB if buildMemory else available_memory(),
+      expected_needs(read_resource_usage(usageFile), specs, buildOrder))
+
+  # With --shard, every runner works out the same split of the packages, and
+  # only builds its own part. The packages from other parts that it needs are
+  # installed from the tarballs their runners upload, and the others are left
+  # out altogether.
+  otherShards, fromOtherShards = set(), set()
+  if getattr(args, "shard", None):
+    shardIndex, shardCount = args.shard
+    shards = assign_shards(buildOrder, specs, durations, shardCount)
+    needed = {p for p in buildOrder if shards[p] == shardIndex}
+    for p in reversed(buildOrder):
+      if p in needed:
+        needed.update(dep for dep in specs[p]["requires"] if dep in shards)
+    otherShards = set(buildOrder) - needed
+    # Other runners cannot upload development packages, or anything depending
+    # on them, so we build those ourselves.
+    fromOtherShards = {p for p in needed if shards[p] != shardIndex and
+                       can_upload(specs[p], specs, syncHelper)}
+    banner("Building part %d of %d of %s:\n%s",
+           shardIndex, shardCount, ", ".join(args.pkgname),
+           "\n".join("  - %s@%s%s" % (p, specs[p]["version"],
+                                      " (from part %d)" % shards[p] if p in fromOtherShards else "")
+                      for p in buildOrder if p in needed))
+
+  if getattr(args, "explainOnly", False):
+    for p in buildOrder:
+      choose_revision(p, reserve=False)
+    hashCache.save()
+    explanation = explain_rebuilds(specs, buildOrder, workDir, args.architecture)
+    if explanation:
+      banner("The following packages would get a new revision:\n%s", explanation)
+    else:
+      banner("All packages are installed already.")
+    return
 
-  if not args.onlyDeps:
+  if args.dryRun:
+    # Find out how every package would be obtained, without reserving any
+    # revision, and report what that costs.
+    actions, sizes = {}, {}
+    for p in buildOrder:
+      spec = specs[p]
+      reused = choose_revision(p, reserve=False)
+      tarball = join(workDir, resolve_store_path(args.architecture, spec["hash"]),
+                     tarball_name(spec, args.architecture))
+      if is_installed(spec, workDir, args.architecture):
+        actions[p] = "installed"
+      elif spec["is_devel_pkg"] or not reused:
+        actions[p] = "compile"
+      elif exists(tarball):
+        actions[p] = "unpack"
+      else:
+        actions[p] = "download"
+        sizes[p] = syncHelper.tarball_size(spec)
+    recorded = {p for p, versions in read_durations(durationsFile).items()
+                if p in specs and specs[p]["version"] in versions}
+    banner("Estimated cost of building %s:\n\n%s",
+           ", ".join(args.pkgname),
+           build_estimate(buildOrder, specs, actions, sizes, durations, recorded))
+    hashCache.save()
+    info("--dry-run / -n specified. Not building.")
+    return
+
+  if getattr(args, "prefetchOnly", False):
+    prefetch_all()
+    hashCache.save()
+    return
+
+  if plugin is not None:
+    # Write the build script of every package that needs to be built or
+    # unpacked, and let the plugin run them.
+    skipped = set(otherShards)
+    jobs = OrderedDict()
+    for p in buildOrder:
+      job = prepare_package(p, max(1, args.jobs // builders))
+      if job is not None and "known_failure" in job:
+        dieOnError(True, known_failure_message(specs[p], job["known_failure"]))
+      if job is not None:
+        jobs[p] = job
+    hashCache.save()
+    return plugin.build_plugin(specs, args, buildOrder, jobs)
+
+  # Packages built by another shard can only be installed once their runner
+  # has uploaded them. Until then, we keep checking the remote store.
+  waitingSince = {}
+
+  def from_other_shard_ready(p):
+    spec = specs[p]
+    if choose_revision(p, reserve=False) or is_installed(spec, workDir, args.architecture):
+      return True
+    if getattr(args, "skipKnownFailures", False) and not getattr(args, "retryFailed", False):
+      syncHelper.fetch_failure(spec)
+      if read_failure(join(workDir, resolve_failure_path(args.architecture, spec["hash"]))):
+        return True   # prepare_package reports the failure
+    if p not in waitingSince:
+      info("Waiting for %s@%s to be uploaded by the runner of part %d",
+           p, spec["version"], shards[p])
+      waitingSince[p] = time.time()
+    elif time.time() - waitingSince[p] > args.shardTimeout * 60:
+      warning("%s@%s was not uploaded within %g minutes, building it here instead",
+              p, spec["version"], args.shardTimeout)
+      fromOtherShards.discard(p)
+      return True
+    return False
+
+  def claim_package(p):
+    storeHashes(p, specs, considerRelocation=args.architecture.startswith("osx"), cache=hashCache)
+    if p in fromOtherShards and not from_other_shard_ready(p):
+      return False
+    return claims.claim(p, specs[p]["remote_revision_hash"])
+
+  # Packages are processed again once their build script has run, so that we
+  # can check if the build was consistent.
+  try:
+    # Build-only dependencies are not needed by packages we install from a
+    # tarball. To find out which packages that is, choose every revision now.
+    skipped = set(otherShards)
+    if getattr(args, "skipBuildRequires", False):
+      prebuilt = set()
+      for p in buildOrder:
+        reused = choose_revision(p)
+        if not specs[p]["is_devel_pkg"] and \
+           (reused or is_installed(specs[p], workDir, args.architecture)):
+          prebuilt.add(p)
+      skipped |= build_requires_to_skip(buildOrder, specs, args.pkgname, prebuilt)
+      if skipped - otherShards:
+        banner("Not installing the following packages, as only packages "
+               "available prebuilt need them to build:\n%s",
+               "\n".join("  - %s@%s" % (p, specs[p]["version"])
+                         for p in buildOrder if p in skipped - otherShards))
+    if prefetcher:
+      prefetch_ready()
+    scheduler = BuildScheduler(buildOrder, specs, durations)
+    for p in (finishedPackages | skipped) & set(buildOrder):
+      scheduler.finish(p)
+    run_builds(scheduler, builders, args.jobs, prepare_and_save, run_build, complete_build,
+               claim=claim_package, release=release_package, resources=resources)
+  finally:
+    hashCache.save()
+    if prefetcher:
+      prefetcher.shutdown()
+    if jobserver:
+      jobserver.close()
+    for p in list(reservedRevisions):
+      release_package(p)
+    claims.release_all()
+    if planUsers:
+      planUsers.release()
+
+  if scheduler.failed:
+    def package_list(packages):
+      return "\n".join("  - %s@%s" % (p, specs[p]["version"])
+                       for p in buildOrder if p in packages)
+    summary = "The following packages failed to build:\n" + package_list(scheduler.failed)
+    if scheduler.blocked:
+      summary += ("\n\nThe following packages were not built, as they depend on "
+                  "failed packages:\n" + package_list(scheduler.blocked))
+    error("%s", summary)
+    sys.exit(1)
+
+  if mainPackage in otherShards:
+      banner("Part %d of %d of the build of %s successfully completed on `%s'.",
+             shardIndex, shardCount, ", ".join(args.pkgname), socket.gethostname())
+  elif not args.onlyDeps and len(args.pkgname) > 1:
+      banner("Build of %d packages successfully completed on `%s'.\n"
+             "Your software installation is at:"
+             "\n\n  %s\n\n"
+             "You can use any of these packages by loading its environment, e.g.:"
+             "\n\n  alienv enter %s/latest-%s",
+             len(args.pkgname), socket.gethostname(),
+             abspath(join(args.workDir, args.architecture)),
+             mainPackage, mainBuildFamily)
+  elif not args.onlyDeps:
       banner("Build of %s successfully completed on `%s'.\n"
              "Your software installation is at:"
              "\n\n  %s\n\n"
@@ -1262,7 +2006,7 @@ def doBuild(args, parser):
   for spec in specs.values():
     if spec["is_devel_pkg"]:
       banner("Build directory for devel package %s:\n%s/BUILD/%s-latest%s/%s",
-             spec["package"], abspath(buildWorkDir), spec["package"],
+             spec["package"], abspath(args.workDir), spec["package"],
              ("-" + args.develPrefix) if "develPrefix" in args else "",
              spec["package"])
   if untrackedFilesDirectories:
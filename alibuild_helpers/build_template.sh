@@ -21,6 +21,18 @@ unset AWS_SECRET_ACCESS_KEY
 set -e
 set +h
 function hash() { true; }
+# Like ln -snf, but replace the link atomically, so that other aliBuild
+# processes sharing WORK_DIR never see it missing, and creating it never fails
+# because another process created it first.
+function publish_symlink() {
+  rm -f "$2.tmp.$$"
+  ln -sn "$1" "$2.tmp.$$"
+  if [[ $(uname) == Darwin ]]; then
+    mv -fh "$2.tmp.$$" "$2"
+  else
+    mv -fT "$2.tmp.$$" "$2"
+  fi
+}
 export WORK_DIR="${WORK_DIR_OVERRIDE:-%(workDir)s}"
 export ALIBUILD_CONFIG_DIR="${ALIBUILD_CONFIG_DIR_OVERRIDE:-%(configDir)s}"
 
@@ -125,9 +137,9 @@ unset DYLD_LIBRARY_PATH
 EOF
 
 cd "$BUILDROOT"
-ln -snf "$PKGHASH" "$ALIBUILD_BUILD_WORK_DIR/BUILD/$PKGNAME-latest"
+publish_symlink "$PKGHASH" "$ALIBUILD_BUILD_WORK_DIR/BUILD/$PKGNAME-latest"
 if [[ $DEVEL_PREFIX ]]; then
-  ln -snf "$PKGHASH" "$ALIBUILD_BUILD_WORK_DIR/BUILD/$PKGNAME-latest-$DEVEL_PREFIX"
+  publish_symlink "$PKGHASH" "$ALIBUILD_BUILD_WORK_DIR/BUILD/$PKGNAME-latest-$DEVEL_PREFIX"
 fi
 
 cd "$BUILDDIR"
@@ -348,8 +360,8 @@ elif [ -z "$CACHED_TARBALL" ]; then
   fi
   mv "$WORK_DIR/TARS/$HASH_PATH/$PACKAGE_WITH_REV.processing" \
      "$WORK_DIR/TARS/$HASH_PATH/$PACKAGE_WITH_REV"
-  ln -nfs "../../$HASH_PATH/$PACKAGE_WITH_REV" \
-     "$WORK_DIR/TARS/$ARCHITECTURE/$PKGNAME/$PACKAGE_WITH_REV"
+  publish_symlink "../../$HASH_PATH/$PACKAGE_WITH_REV" \
+                  "$WORK_DIR/TARS/$ARCHITECTURE/$PKGNAME/$PACKAGE_WITH_REV"
 fi
 wait "$rsync_pid"
 
@@ -359,11 +371,11 @@ if [ -w "$WORK_DIR/$ARCHITECTURE/$PKGNAME/$PKGVERSION-$PKGREVISION" ]; then
   bash -ex "$ARCHITECTURE/$PKGNAME/$PKGVERSION-$PKGREVISION/relocate-me.sh"
 fi
 # Last package built gets a "latest" mark.
-ln -snf $PKGVERSION-$PKGREVISION $ARCHITECTURE/$PKGNAME/latest
+publish_symlink $PKGVERSION-$PKGREVISION $ARCHITECTURE/$PKGNAME/latest
 
 # Latest package built for a given devel prefix gets latest-$BUILD_FAMILY
 if [[ $BUILD_FAMILY ]]; then
-  ln -snf $PKGVERSION-$PKGREVISION $ARCHITECTURE/$PKGNAME/latest-$BUILD_FAMILY
+  publish_symlink $PKGVERSION-$PKGREVISION $ARCHITECTURE/$PKGNAME/latest-$BUILD_FAMILY
 fi
 
 # When the package is definitely fully installed, install the file that marks
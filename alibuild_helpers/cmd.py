@@ -1,5 +1,8 @@
 import os
 import os.path
+import selectors
+import signal
+import threading
 import time
 from subprocess import Popen, PIPE, STDOUT
 from textwrap import dedent
@@ -55,18 +58,230 @@ def getstatusoutput(command, timeout=None, cwd=None):
   return proc.returncode, merged_output
 
 
-def execute(command, printer=debug, timeout=None):
-  popen = Popen(command, shell=isinstance(command, str), stdout=PIPE, stderr=STDOUT)
-  start_time = time.time()
-  for line in iter(popen.stdout.readline, b""):
-    printer("%s", decode_with_fallback(line).strip("\n"))
-    if timeout is not None and time.time() > start_time + timeout:
-      popen.terminate()
-      break
-  out = decode_with_fallback(popen.communicate()[0]).strip("\n")
-  if out:
-    printer("%s", out)
-  return popen.returncode
+# The process groups of the commands running in their own group. They do not
+# get the Ctrl-C typed in the terminal, so terminate_process_groups must be
+# called instead.
+_process_groups = set()
+_process_groups_lock = threading.Lock()
+
+
+def terminate_process_groups() -> None:
+  """Terminate all commands started in their own process group."""
+  with _process_groups_lock:
+    groups = list(_process_groups)
+  for pgid in groups:
+    try:
+      os.killpg(pgid, signal.SIGTERM)
+    except OSError:
+      pass
+
+
+class Child:
+  """A command run by a Supervisor, and what we know about it so far."""
+
+  def __init__(self, command, popen, printer, log, timeout, idle_timeout, usage, new_group) -> None:
+    self.command = command
+    self.popen = popen
+    self.printer = printer
+    self.log = log
+    self.last_output = time.monotonic()
+    self.deadline = None if timeout is None else self.last_output + timeout
+    self.idle_timeout = idle_timeout
+    self.usage = usage
+    self.new_group = new_group
+    self.returncode = None
+    # Why the command was stopped, if it was.
+    self.timed_out = None
+    self.killed_at = None
+    self.force_killed = False
+    self._partial = b""
+
+  def expiry(self):
+    """Return when the command is to be stopped, or None if never."""
+    limits = [self.deadline]
+    if self.idle_timeout:
+      limits.append(self.last_output + self.idle_timeout)
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+  def signal(self, signum) -> None:
+    """Send SIGNUM to the command, and to its process group if it has one."""
+    try:
+      if self.new_group:
+        os.killpg(self.popen.pid, signum)
+      else:
+        self.popen.send_signal(signum)
+    except OSError:
+      pass   # it exited already
+
+  def feed(self, data) -> None:
+    """Pass a chunk of output on to the log and, line by line, to the printer."""
+    self.last_output = time.monotonic()
+    if self.log is not None:
+      self.log.write(data)
+      self.log.flush()
+    lines = (self._partial + data).split(b"\n")
+    self._partial = lines.pop()
+    for line in lines:
+      self.printer("%s", decode_with_fallback(line))
+
+  def finish(self) -> None:
+    """Pass on the last, unterminated line, and reap the process."""
+    if self._partial:
+      self.printer("%s", decode_with_fallback(self._partial))
+      self._partial = b""
+    self.popen.stdout.close()
+    if self.usage is None:
+      self.returncode = self.popen.wait()
+    else:
+      # Popen.wait() does not report resource usage, so reap the child ourselves.
+      _, status, rusage = os.wait4(self.popen.pid, 0)
+      self.returncode = self.popen.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+        else os.WEXITSTATUS(status)
+      # Linux reports kilobytes, macOS bytes.
+      self.usage["max_rss"] = rusage.ru_maxrss * (1 if platform.system() == "Darwin" else 1024)
+      self.usage["cpu_time"] = rusage.ru_utime + rusage.ru_stime
+    if self.new_group:
+      # Make sure nothing the command started is left behind.
+      if self.timed_out:
+        self.signal(signal.SIGKILL)
+      with _process_groups_lock:
+        _process_groups.discard(self.popen.pid)
+
+
+class Supervisor:
+  """Run several commands at once, and pass on their output as it comes.
+
+  Output is read in chunks from all commands without blocking, so one command
+  never holds up the others, and each command's deadlines are checked even
+  while it prints nothing.
+  """
+
+  # How many bytes we read from a command at a time.
+  CHUNK_SIZE = 64 * 1024
+  # How many seconds commands that timed out get to exit after SIGTERM, before
+  # we send SIGKILL, and after that before we stop waiting for the rest of
+  # their output.
+  GRACE_PERIOD = 10
+
+  def __init__(self) -> None:
+    self.selector = selectors.DefaultSelector()
+    self.running = []
+
+  def start(self, command, printer=debug, timeout=None, env=None, usage=None, pass_fds=(), log=None,
+            idle_timeout=None, new_group=False):
+    """Start COMMAND, and return its Child.
+
+    Each line of output is passed to PRINTER, and all output is written as it
+    comes to LOG, a binary file, if given. The command is stopped TIMEOUT
+    seconds after it started, or once it printed nothing for IDLE_TIMEOUT
+    seconds. The file descriptors in PASS_FDS are left open in the command.
+    If USAGE is a dict, the resources used by the command are stored in it
+    once it finished: "max_rss" is the peak memory in bytes of its largest
+    process, and "cpu_time" the CPU time in seconds used by all its processes.
+
+    With NEW_GROUP, the command runs in its own process group, and everything
+    in that group is stopped along with it.
+    """
+    popen = Popen(command, shell=isinstance(command, str), stdout=PIPE, stderr=STDOUT, env=env,
+                  pass_fds=pass_fds, start_new_session=new_group)
+    if new_group:
+      with _process_groups_lock:
+        _process_groups.add(popen.pid)
+    os.set_blocking(popen.stdout.fileno(), False)
+    child = Child(command, popen, printer, log, timeout, idle_timeout, usage, new_group)
+    self.selector.register(popen.stdout, selectors.EVENT_READ, child)
+    self.running.append(child)
+    return child
+
+  def _stop_reading(self, child) -> None:
+    self.selector.unregister(child.popen.stdout)
+    self.running.remove(child)
+    child.finish()
+
+  def _check_deadlines(self, now):
+    """Stop the children that took too long, and return the ones we gave up on."""
+    given_up = []
+    for child in list(self.running):
+      expiry = child.expiry()
+      if child.killed_at is None and expiry is not None and now > expiry:
+        child.timed_out = "idle" if child.deadline is None or expiry < child.deadline else "deadline"
+        warning("Stopping %r, as it %s", child.command,
+                "printed nothing for %d seconds" % child.idle_timeout
+                if child.timed_out == "idle" else "did not finish in time")
+        child.killed_at = now
+        child.signal(signal.SIGTERM)
+      elif child.killed_at is not None and not child.force_killed and \
+           now > child.killed_at + self.GRACE_PERIOD:
+        child.force_killed = True
+        child.signal(signal.SIGKILL)
+      elif child.killed_at is not None and now > child.killed_at + 2 * self.GRACE_PERIOD:
+        # Processes that left the command's process group may keep its
+        # output open.
+        warning("Not waiting for the rest of the output of %r", child.command)
+        self._stop_reading(child)
+        given_up.append(child)
+    return given_up
+
+  def _next_check(self, child):
+    if child.killed_at is None:
+      return child.expiry()
+    return child.killed_at + self.GRACE_PERIOD * (2 if child.force_killed else 1)
+
+  def poll(self, timeout=None):
+    """Pass on the output that arrives within TIMEOUT seconds.
+
+    Return the children that finished in the meantime, or as soon as one
+    finishes. With no TIMEOUT, wait until at least one child finishes.
+    """
+    finished = []
+    end = None if timeout is None else time.monotonic() + timeout
+    while self.running and not finished:
+      now = time.monotonic()
+      finished += self._check_deadlines(now)
+      if finished:
+        break
+      wakeups = [end] + [self._next_check(child) for child in self.running]
+      wakeups = [wakeup for wakeup in wakeups if wakeup is not None]
+      wait = max(0, min(wakeups) - now) if wakeups else None
+      for key, _ in self.selector.select(wait):
+        child = key.data
+        try:
+          data = os.read(key.fd, self.CHUNK_SIZE)
+        except BlockingIOError:
+          continue
+        if data:
+          child.feed(data)
+        else:
+          self._stop_reading(child)
+          finished.append(child)
+      if end is not None and time.monotonic() >= end:
+        break
+    return finished
+
+  def run(self) -> None:
+    """Wait for all children to finish, passing on their output."""
+    try:
+      while self.running:
+        self.poll()
+    except BaseException:
+      for child in self.running:
+        child.signal(signal.SIGTERM)
+      raise
+
+
+def execute(command, printer=debug, timeout=None, env=None, usage=None, pass_fds=(), log=None,
+            idle_timeout=None, new_group=False):
+  """Run command, passing its output to printer line by line.
+
+  Return the command's exit code. See Supervisor.start for the arguments.
+  """
+  supervisor = Supervisor()
+  child = supervisor.start(command, printer=printer, timeout=timeout, env=env, usage=usage,
+                           pass_fds=pass_fds, log=log, idle_timeout=idle_timeout,
+                           new_group=new_group)
+  supervisor.run()
+  return child.returncode
 
 
 def stream_pull(runtime, image):
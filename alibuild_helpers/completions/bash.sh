@@ -53,7 +53,7 @@ _aliBuild_complete() {
   local subcmd=""
   for (( i=1; i < cword; i++ )); do
     case "${words[i]}" in
-      build|clean|deps|doctor|init|analytics|architecture|version|completion)
+      build|prefetch|explain|clean|deps|doctor|server|init|analytics|architecture|version|completion)
         subcmd="${words[i]}"
         break
         ;;
@@ -64,16 +64,16 @@ _aliBuild_complete() {
   if [[ -z "$subcmd" ]]; then
     COMPREPLY=( $(compgen -W "
       -d --debug -n --dry-run
-      build clean deps doctor init analytics architecture version completion
+      build prefetch explain clean deps doctor server init analytics architecture version completion
     " -- "$cur") )
     return
   fi
 
   # Complete subcommand-specific options
   case "$subcmd" in
-    build)
+    build|prefetch|explain)
       case "$prev" in
-        -a|--architecture|-z|--devel-prefix|-e|-j|--jobs|--plugin|--docker-image|--docker-extra-args|-v|--remote-store|--write-store)
+        -a|--architecture|-z|--devel-prefix|-e|-j|--jobs|--build-memory|--builders|--build-timeout|--idle-timeout|--shard|--shard-timeout|--plugin|--docker-image|--docker-extra-args|-v|--remote-store|--write-store|--prefetch-workers|--prefetch-budget)
           return ;;
         --defaults)
           _alibuild_defaults; return ;;
@@ -87,11 +87,12 @@ _aliBuild_complete() {
       if [[ "$cur" == -* ]]; then
         COMPREPLY=( $(compgen -W "
           -a --architecture --defaults --force-unknown-architecture
-          -z --devel-prefix -e -j --jobs -u --fetch-repos
-          --no-local --force-tracked --plugin --disable --force-rebuild
-          --annotate --only-deps
+          -z --devel-prefix -e -j --jobs --build-memory --builders --build-timeout --idle-timeout --resume --worker --shard --shard-timeout -k --keep-going --skip-known-failures --retry-failed --skip-build-requires -u --fetch-repos
+          --no-local --force-tracked --rebuild-untracked --plugin --disable --force-rebuild
+          --annotate --only-deps --all
           --docker --docker-image --docker-extra-args -v
           --no-remote-store --remote-store --write-store --insecure
+          --prefetch-workers --prefetch-budget
           -C --chdir -w --work-dir -c --config-dir --reference-sources
           --aggressive-cleanup --no-auto-cleanup
           --always-prefer-system --no-system
@@ -109,6 +110,13 @@ _aliBuild_complete() {
         -a --architecture --aggressive-cleanup -C --chdir -w --work-dir
       " -- "$cur") )
       ;;
+    server)
+      case "$prev" in
+        --max-age) return ;;
+        --socket) _filedir; return ;;
+      esac
+      COMPREPLY=( $(compgen -W "--socket --max-age" -- "$cur") )
+      ;;
     deps)
       case "$prev" in
         -a|--architecture|-e|--docker-image|--docker-extra-args)
@@ -54,14 +54,28 @@ _aliBuild_cmd_build() {
     '(-z --devel-prefix)'{-z,--devel-prefix}'[Version name for development packages]:prefix: ' \
     '*-e[KEY=VALUE to add to the build environment]:env binding: ' \
     '(-j --jobs)'{-j,--jobs}'[Number of parallel compilation processes]:jobs: ' \
+    '--build-memory[Memory in gigabytes that builds may use]:gigabytes: ' \
+    '--builders[Number of packages to build at the same time]:builders: ' \
+    '--build-timeout[Minutes after which a build is stopped]:minutes: ' \
+    '--idle-timeout[Minutes without output after which a build is stopped]:minutes: ' \
+    '--resume[Continue from the saved plan of the previous build]' \
+    '--worker[Share the build with other aliBuild processes]' \
+    '--shard[Build one part of a build split over several runners]:part (I/N): ' \
+    '--shard-timeout[Minutes to wait for packages from other parts]:minutes: ' \
+    '(-k --keep-going)'{-k,--keep-going}'[Keep building packages unaffected by a failure]' \
+    '--skip-known-failures[Do not build packages whose hash is known to fail]' \
+    '--retry-failed[Build packages even if they are known to fail]' \
+    '--skip-build-requires[Do not install build dependencies of prebuilt packages]' \
     '(-u --fetch-repos)'{-u,--fetch-repos}'[Fetch updates to repositories in MIRRORDIR]' \
     '*--no-local[Do not pick up package from local checkout]:package:_alibuild_packages' \
     '--force-tracked[Do not pick up any packages from a local checkout]' \
+    '--rebuild-untracked[Rebuild development packages with untracked files every time]' \
     '--plugin[Plugin to use for the actual build]:plugin: ' \
     '*--disable[Do not build package and its unique dependencies]:package:_alibuild_packages' \
     '*--force-rebuild[Always rebuild package from scratch]:package:_alibuild_packages' \
     '*--annotate[Store comment in build metadata for package]:PACKAGE=COMMENT: ' \
     '--only-deps[Only build dependencies, not the main package]' \
+    '--all[Build all packages in the recipes directory]' \
     '--docker[Build inside a Docker container]' \
     '--docker-image[Docker image to build inside of]:image: ' \
     '--docker-extra-args[Arguments to pass to docker run]:args: ' \
@@ -70,6 +84,8 @@ _aliBuild_cmd_build() {
     '--remote-store[Where to find prebuilt tarballs to reuse]:store: ' \
     '--write-store[Where to upload newly built packages]:store: ' \
     '--insecure[Do not validate TLS certificates for remote store]' \
+    '--prefetch-workers[Number of parallel downloads ahead of the build]:workers: ' \
+    '--prefetch-budget[Gigabytes of tarballs to download ahead of the build]:gigabytes: ' \
     '(-C --chdir)'{-C,--chdir}'[Change to directory before building]:directory:_directories' \
     '(-w --work-dir)'{-w,--work-dir}'[Toplevel directory for builds]:directory:_directories' \
     '(-c --config-dir)'{-c,--config-dir}'[Directory containing build recipes]:directory:_directories' \
@@ -81,6 +97,16 @@ _aliBuild_cmd_build() {
     '*:package:_alibuild_packages'
 }
 
+# The prefetch command takes the same options as the build command.
+_aliBuild_cmd_prefetch() {
+  _aliBuild_cmd_build "$@"
+}
+
+# So does the explain command.
+_aliBuild_cmd_explain() {
+  _aliBuild_cmd_build "$@"
+}
+
 _aliBuild_cmd_clean() {
   _arguments -s -S \
     '(-a --architecture)'{-a,--architecture}'[Clean up build results for this architecture]:architecture: ' \
@@ -89,6 +115,12 @@ _aliBuild_cmd_clean() {
     '(-w --work-dir)'{-w,--work-dir}'[Toplevel directory used in previous builds]:directory:_directories'
 }
 
+_aliBuild_cmd_server() {
+  _arguments -s -S \
+    '--socket[Unix socket to listen on]:socket:_files' \
+    '--max-age[Seconds to keep system check results]:seconds: '
+}
+
 _aliBuild_cmd_deps() {
   _arguments -s -S \
     '(-a --architecture)'{-a,--architecture}'[Resolve dependencies as if on the specified architecture]:architecture: ' \
@@ -180,7 +212,10 @@ _aliBuild() {
         'clean:Clean up build artifacts'
         'deps:Show dependency tree for a package'
         'doctor:Check system requirements for a package'
+        'server:Keep resolved state warm between runs'
         'init:Initialise a local development area'
+        'prefetch:Download what building a package needs, without building it'
+        'explain:Explain why packages would be rebuilt'
         'analytics:Turn analysis data reporting on or off'
         'architecture:Display detected architecture'
         'version:Display aliBuild version'
@@ -3,6 +3,7 @@
 from alibuild_helpers.log import debug, dieOnError
 from alibuild_helpers.utilities import parseDefaults, readDefaults, getPackageList, validateDefaults
 from alibuild_helpers.cmd import ContainerRunner, execute
+from alibuild_helpers.server import server_cache
 from os import path
 import sys
 
@@ -15,9 +16,17 @@ def doDeps(args, parser):
   extra_env = {"ALIBUILD_CONFIG_DIR": "/alidist" if args.docker else path.abspath(args.configDir)}
   extra_env.update(dict([e.partition('=')[::2] for e in args.environment]))
   
+  # If `aliBuild server` is running, reuse the checks and recipes it knows.
+  cache = server_cache(args)
   with ContainerRunner(args.dockerImage, args.docker_extra_args, extra_env=extra_env, extra_volumes=[f"{path.abspath(args.configDir)}:/alidist:ro"] if args.docker else []) as getstatusoutput_docker:
     def performCheck(pkg, cmd):
-      return getstatusoutput_docker(cmd)
+      key = pkg["package"], cmd
+      if cache is not None and key in cache.checks:
+        return cache.checks[key]
+      result = getstatusoutput_docker(cmd)
+      if cache is not None:
+        cache.checks[key] = result
+      return result
     
     systemPackages, ownPackages, failed, validDefaults, _systemSpecs = \
       getPackageList(packages                = [args.package],
@@ -33,7 +42,8 @@ def doDeps(args, parser):
                      performValidateDefaults = lambda spec: validateDefaults(spec, args.defaults),
                      overrides               = overrides,
                      taps                    = taps,
-                     log                     = debug)
+                     log                     = debug,
+                     recipeCache             = cache and cache.recipes)
 
   dieOnError(validDefaults and args.defaults not in validDefaults,
              "Specified default `%s' is not compatible with the packages you want to build.\n" % args.defaults +
@@ -8,6 +8,7 @@ from alibuild_helpers.log import debug, error, banner, info, success, warning
 from alibuild_helpers.log import logger
 from alibuild_helpers.utilities import getPackageList, parseDefaults, readDefaults, validateDefaults
 from alibuild_helpers.cmd import getstatusoutput, ContainerRunner
+from alibuild_helpers.server import server_cache
 import tempfile
 
 def prunePaths(workDir) -> None:
@@ -164,7 +165,10 @@ def doDoctor(args, parser):
                      performValidateDefaults = performValidateDefaults,
                      overrides               = overrides,
                      taps                    = taps,
-                     log                     = info)
+                     log                     = info,
+                     # The checks are what we want to diagnose, so we only
+                     # reuse the recipes parsed by `aliBuild server`, if any.
+                     recipeCache             = getattr(server_cache(args), "recipes", None))
 
   alwaysBuilt = {x for x in specs} - fromSystem - own - failed
   if alwaysBuilt:
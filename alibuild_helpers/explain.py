@@ -0,0 +1,89 @@
+"""Explain why packages get a new hash, and therefore need to be rebuilt.
+
+storeHashes records what it calculates the hashes of a package from, in order,
+in the package's hash_manifest. This is saved in the .meta.json file of every
+installed package. `aliBuild explain` resolves the packages like `aliBuild
+build` would, and compares these inputs with the ones of the latest installed
+revision of each package, naming the recipe fields and dependencies that
+changed.
+"""
+
+import difflib
+import json
+from collections import OrderedDict
+from os.path import join
+
+# The hashes recorded in a hash_manifest.
+MANIFEST_HASHES = ("hash", "deps_hash")
+
+
+def installed_inputs(work_dir, architecture, package):
+  """Return the hash and the hash inputs of the latest installed PACKAGE.
+
+  Either is None if unknown, e.g. because the package was never installed, or
+  was built before aliBuild recorded the inputs of its hashes.
+  """
+  install_dir = join(work_dir, architecture, package, "latest")
+  try:
+    with open(join(install_dir, ".build-hash")) as f:
+      installed_hash = f.read().strip("\n")
+  except OSError:
+    return None, None
+  try:
+    with open(join(install_dir, ".meta.json")) as f:
+      meta = json.load(f, object_pairs_hook=OrderedDict)
+  except (OSError, ValueError):
+    return installed_hash, None
+  return installed_hash, meta.get("hash_inputs")
+
+
+def describe_change(name, old, new):
+  """Return a line (or more) explaining that input NAME changed from OLD to NEW."""
+  if "\n" in old or "\n" in new:
+    diff = difflib.unified_diff(old.splitlines(), new.splitlines(), "installed", "current",
+                                lineterm="", n=1)
+    return "%s changed:\n%s" % (name, "\n".join("    " + line for line in diff))
+  return "%s changed from %s to %s" % (name, old, new)
+
+
+def changed_inputs(old, new):
+  """Describe how the hash inputs in manifest NEW differ from those in OLD."""
+  changes = []
+  reported = set()
+  for hasher in MANIFEST_HASHES:
+    before = OrderedDict(old.get(hasher, ()))
+    after = OrderedDict(new.get(hasher, ()))
+    for name in list(before) + [name for name in after if name not in before]:
+      if name in reported or before.get(name) == after.get(name):
+        continue
+      reported.add(name)
+      if name not in after:
+        changes.append("%s was removed" % name)
+      elif name not in before:
+        changes.append("%s was added" % name)
+      else:
+        changes.append(describe_change(name, before[name], after[name]))
+  return changes
+
+
+def explain_rebuilds(specs, build_order, work_dir, architecture):
+  """Return why each package in BUILD_ORDER would get a new revision.
+
+  All packages must have their hashes calculated already.
+  """
+  lines = []
+  for p in build_order:
+    spec = specs[p]
+    installed_hash, manifest = installed_inputs(work_dir, architecture, p)
+    if installed_hash in spec["remote_hashes"] + spec["local_hashes"]:
+      continue
+    if installed_hash is None:
+      reasons = ["not installed yet"]
+    elif manifest is None:
+      reasons = ["the installed revision does not record what its hash was calculated from"]
+    else:
+      reasons = changed_inputs(manifest, spec["hash_manifest"]) or [
+        "same inputs, but the installed revision has hash %s instead of %s"
+        % (installed_hash, spec["hash"])]
+    lines.append("  - %s@%s: %s" % (p, spec["version"], "\n    ".join(reasons)))
+  return "\n".join(lines)
@@ -0,0 +1,112 @@
+"""Remember which builds failed, so they are not retried in vain.
+
+A build with a given hash fails the same way every time it is retried, e.g. by
+several CI jobs. When a package fails to build, we save a record of it, with
+the end of its build log, under TARS/<arch>/failures in the work directory.
+With --skip-known-failures, these records are also shared through the remote
+store, and builds whose hash is known to fail are not attempted again.
+
+Builds that were killed (e.g. because they timed out or ran out of memory)
+may well succeed next time, so they are not recorded. If a build that failed
+before succeeds after all, its record is overwritten with one saying so, as
+remote stores do not let us delete files.
+"""
+
+import json
+import os
+import socket
+import tempfile
+import time
+
+from alibuild_helpers.log import warning
+
+# How many lines from the end of the build log to keep in a failure record.
+LOG_TAIL_LINES = 50
+
+
+def log_tail(path, lines=LOG_TAIL_LINES):
+  """Return the last LINES lines of the file at PATH, or "" if unreadable."""
+  try:
+    with open(path, "rb") as f:
+      f.seek(0, os.SEEK_END)
+      # Only read as much as the tail of the file could reasonably take up.
+      f.seek(max(0, f.tell() - lines * 1024))
+      data = f.read()
+  except OSError:
+    return ""
+  return "\n".join(data.decode("utf-8", "replace").splitlines()[-lines:])
+
+
+def is_recipe_failure(exit_code):
+  """Return whether a build exiting with EXIT_CODE failed by itself.
+
+  Negative codes mean the build was killed by a signal, and codes from 128 on
+  that a command it ran was.
+  """
+  return 0 < exit_code < 128
+
+
+def read_failure(path):
+  """Return the failure record saved in PATH by record_failure, if any."""
+  try:
+    with open(path) as f:
+      record = json.load(f)
+  except (OSError, ValueError):
+    return None
+  if not isinstance(record, dict) or record.get("succeeded"):
+    return None
+  return record
+
+
+def record_failure(path, spec, log_path) -> None:
+  """Save in PATH that the build of SPEC failed, as logged in LOG_PATH."""
+  _write_record(path, spec, log=log_tail(log_path))
+
+
+def record_success(path, spec) -> None:
+  """Save in PATH that the build of SPEC succeeded, replacing any failure record."""
+  _write_record(path, spec, succeeded=True)
+
+
+def _write_record(path, spec, **fields) -> None:
+  record = {
+    "package": spec["package"],
+    "version": spec["version"],
+    "hash": spec["hash"],
+    "host": socket.gethostname(),
+    "time": int(time.time()),
+  }
+  record.update(fields)
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first, so a concurrent reader never sees a
+    # partially written record.
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path),
+                                     prefix=".failure.", delete=False) as f:
+      json.dump(record, f, indent=2, sort_keys=True)
+    os.replace(f.name, path)
+  except OSError as exc:
+    warning("Could not record build failure of %s: %s", spec["package"], exc)
+
+
+def forget_failure(path) -> None:
+  """Remove the failure record in PATH, e.g. once the build succeeded."""
+  try:
+    os.unlink(path)
+  except FileNotFoundError:
+    pass
+
+
+def known_failure_message(spec, record):
+  """Return a message explaining that SPEC's build is known to fail."""
+  return ("{package}@{version} is not built, as the build of the same hash ({hash}) "
+          "already failed on {host} at {when}. The end of its build log was:\n\n"
+          "{log}\n\n"
+          "Use --retry-failed to build it anyway.").format(
+    package=spec["package"],
+    version=spec["version"],
+    hash=spec["hash"],
+    host=record.get("host", "an unknown host"),
+    when=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.get("time", 0))),
+    log=record.get("log") or "(not available)",
+  )
@@ -80,11 +80,16 @@ class Git(SCM):
     return ["remote", "set-url", "--push", "origin", url]
 
   def diffCmd(self, directory):
-    return "cd %s && git diff HEAD && git status --porcelain" % directory
+    # Without optional locks, git status does not rewrite the index, which
+    # would look like a change to the repository to `aliBuild server`.
+    return "cd %s && git diff HEAD && GIT_OPTIONAL_LOCKS=0 git status --porcelain" % directory
 
   def checkUntracked(self, line):
     return line.startswith("?? ")
 
+  def listUntrackedCmd(self):
+    return ["ls-files", "-z", "--others", "--exclude-standard"]
+
 
 def git(args, directory=".", check=True, prompt=True, timeout=None):
   baseGitOverride = int(os.environ.get("GIT_CONFIG_COUNT", "0"))
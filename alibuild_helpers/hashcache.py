@@ -0,0 +1,118 @@
+"""Remember the hashes of every package between builds.
+
+storeHashes works out the hashes of a package from its recipe, version,
+commit, environment, dependencies and a few other inputs. These inputs are
+fingerprinted, and the resulting hashes saved together with the fingerprint in
+a JSON file under SPECS. If the fingerprint of a package is unchanged in a
+later build, its hashes are taken from there, and the packages whose inputs
+did change can be listed straight away.
+"""
+
+import json
+import os
+import tempfile
+
+from alibuild_helpers.log import debug, info, warning
+from alibuild_helpers.utilities import Hasher
+
+# Increase this whenever storeHashes changes how it calculates the hashes, or
+# what it sets in the spec, so that entries saved before are not reused.
+HASHES_FORMAT = 2
+
+# What storeHashes sets in a spec.
+HASH_KEYS = ("remote_revision_hash", "remote_hashes", "local_revision_hash",
+             "local_hashes", "deps_hash", "incremental_hash", "hash_manifest")
+
+
+def hashes_path(work_dir, architecture):
+  """Return where the hashes of packages built for ARCHITECTURE are saved."""
+  return os.path.join(work_dir, "SPECS", architecture, "package-hashes.json")
+
+
+def hash_inputs(spec, specs, considerRelocation):
+  """Fingerprint everything storeHashes uses to calculate the hashes of SPEC.
+
+  All dependencies of the package must have a definitive hash already.
+  """
+  commit_hash = spec["commit_hash"]
+  real_commit_hash = spec.get("scm_refs", {}).get("refs/tags/" + commit_hash, commit_hash)
+  inputs = [
+    HASHES_FORMAT,
+    [spec.get(key, "none") for key in ("recipe", "version", "package")],
+    [commit_hash, real_commit_hash, spec.get("tag", "0"), spec.get("source")],
+    # Other tags pointing to the same commit add alternative hashes.
+    sorted(ref for ref, git_hash in spec.get("scm_refs", {}).items()
+           if ref.startswith("refs/tags/") and git_hash == real_commit_hash),
+    [[key, list(spec[key].items()) if key in spec else None]
+     for key in ("env", "append_path", "prepend_path", "track_env")],
+    [[dep, specs[dep]["hash"], specs[dep].get("devel_hash", "")]
+     for dep in spec.get("requires", [])],
+    [spec["is_devel_pkg"], spec.get("devel_hash"), spec.get("incremental_recipe")],
+    sorted(spec["relocate_paths"]) if considerRelocation and "relocate_paths" in spec else None,
+  ]
+  h = Hasher()
+  h(json.dumps(inputs, default=repr))
+  return h.hexdigest()
+
+
+class HashCache:
+  """The hashes saved in PATH, and those calculated by this build.
+
+  Maps package names to the fingerprint of their inputs and the hashes these
+  gave.
+  """
+
+  def __init__(self, path) -> None:
+    self.path = path
+    self.entries = self._read()
+    self.updated = {}
+    # Packages whose hashes had been saved before, but from other inputs.
+    self.changed = []
+
+  def _read(self):
+    try:
+      with open(self.path) as f:
+        entries = json.load(f)
+    except (OSError, ValueError):
+      return {}
+    return entries if isinstance(entries, dict) else {}
+
+  def restore(self, spec, fingerprint):
+    """Set the saved hashes in SPEC if they match FINGERPRINT, and return if they did."""
+    entry = self.entries.get(spec["package"])
+    if entry and entry.get("inputs") == fingerprint:
+      spec.update(entry["hashes"])
+      return True
+    if entry and spec["package"] not in self.changed:
+      debug("Inputs of %s changed since its hashes were last calculated", spec["package"])
+      self.changed.append(spec["package"])
+    return False
+
+  def remember(self, spec, fingerprint) -> None:
+    """Save the hashes storeHashes calculated for SPEC from FINGERPRINT."""
+    self.entries[spec["package"]] = self.updated[spec["package"]] = {
+      "inputs": fingerprint,
+      "hashes": {key: spec[key] for key in HASH_KEYS if key in spec},
+    }
+
+  def save(self) -> None:
+    """Write the hashes calculated by this build to PATH."""
+    if self.changed:
+      info("Packages whose inputs changed since their last build: %s",
+           ", ".join(self.changed))
+      self.changed = []
+    if not self.updated:
+      return
+    # Other aliBuild processes may have saved other packages meanwhile.
+    entries = self._read()
+    entries.update(self.updated)
+    try:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.path),
+                                       prefix=".package-hashes.", delete=False) as f:
+        json.dump(entries, f, indent=2, sort_keys=True)
+      os.replace(f.name, self.path)
+    except OSError as exc:
+      warning("Could not save package hashes to %s: %s", self.path, exc)
+      return
+    self.updated = {}
@@ -0,0 +1,128 @@
+"""Share parallel compilation jobs between concurrent builds.
+
+When several packages build at the same time, each would otherwise run as
+many compilation processes as it was told to, regardless of what the others
+are doing. Instead, we act as a GNU make jobserver: every build gets the same
+pool of job tokens through MAKEFLAGS, so that all the make (and other
+jobserver-aware) processes together never run more jobs than the pool holds.
+
+Recipes usually run `make -j$JOBS`, but an explicit -j makes GNU make leave the
+jobserver and run that many jobs on its own. Builds therefore find a `make`
+wrapper first in $PATH, which drops -j options whenever MAKEFLAGS points make
+to a jobserver.
+"""
+
+import fcntl
+import os
+import struct
+import termios
+import threading
+from contextlib import contextmanager
+from textwrap import dedent
+
+from alibuild_helpers.log import debug
+
+# Runs the next make in $PATH, without any -j option if MAKEFLAGS points it to
+# a jobserver.
+MAKE_WRAPPER = dedent("""\
+  #!/bin/sh
+  case "$MAKEFLAGS" in
+    *--jobserver-auth=*|*--jobserver-fds=*)
+      drop_count=
+      for arg do
+        shift
+        if [ -n "$drop_count" ]; then
+          drop_count=
+          case $arg in
+            *[!0-9]*|'') ;;
+            *) continue ;;
+          esac
+        fi
+        case $arg in
+          -j|--jobs) drop_count=1; continue ;;
+          -j*|--jobs=*) continue ;;
+        esac
+        set -- "$@" "$arg"
+      done ;;
+  esac
+  exec "$(which -a "$(basename "$0")" | grep -Fxv "$0" | head -1)" "$@"
+  """)
+
+
+def install_make_wrapper(work_dir):
+  """Put a make wrapper dropping -j options into WORK_DIR/wrapper-scripts.
+
+  build.sh adds this directory to the start of $PATH.
+  """
+  script_dir = os.path.join(work_dir, "wrapper-scripts")
+  os.makedirs(script_dir, exist_ok=True)
+  with open(os.path.join(script_dir, "make"), "w") as scriptf:
+    scriptf.write(MAKE_WRAPPER)
+    os.fchmod(scriptf.fileno(), 0o755)
+
+
+class Jobserver:
+  """A GNU make jobserver handing out JOBS parallel jobs.
+
+  Tokens are kept in a pipe, which make processes read a token from before
+  starting an extra job, and write it back to when that job is done. Every
+  make started by a build runs one job without a token, so the pool holds one
+  token fewer than JOBS.
+
+  We use the pipe-based protocol rather than a named fifo, as all versions of
+  GNU make understand it. Its file descriptors must be inherited by the build
+  process (see fds), which is not possible inside a container.
+
+  A make killed while holding tokens never writes them back. Builds must
+  therefore run inside running(), which refills the pool whenever no build is
+  running, and so no tokens can be taken.
+  """
+
+  def __init__(self, jobs) -> None:
+    self.jobs = jobs
+    self.read_fd, self.write_fd = os.pipe()
+    os.write(self.write_fd, b"+" * (jobs - 1))
+    self.lock = threading.Lock()
+    self.builds = 0
+    debug("Started jobserver with %d jobs", jobs)
+
+  @property
+  def fds(self):
+    """The file descriptors build processes must inherit."""
+    return self.read_fd, self.write_fd
+
+  def makeflags(self):
+    """Return the MAKEFLAGS that let make processes use this jobserver.
+
+    make 4.2 renamed --jobserver-fds to --jobserver-auth, so we pass both.
+    """
+    return "-j%d --jobserver-auth=%d,%d --jobserver-fds=%d,%d" % (
+      (self.jobs,) + self.fds + self.fds)
+
+  def available(self):
+    """Return how many tokens are in the pool."""
+    return struct.unpack("i", fcntl.ioctl(self.read_fd, termios.FIONREAD, b"\0" * 4))[0]
+
+  @contextmanager
+  def running(self):
+    """Account for a build using the jobserver while in this context."""
+    with self.lock:
+      self.builds += 1
+    try:
+      yield
+    finally:
+      with self.lock:
+        self.builds -= 1
+        if not self.builds:
+          self._refill()
+
+  def _refill(self) -> None:
+    """Put back the tokens that killed builds took with them."""
+    missing = self.jobs - 1 - self.available()
+    if missing > 0:
+      debug("Returning %d job tokens lost by killed builds to the jobserver", missing)
+      os.write(self.write_fd, b"+" * missing)
+
+  def close(self) -> None:
+    os.close(self.read_fd)
+    os.close(self.write_fd)
@@ -0,0 +1,193 @@
+"""Coordinate several aliBuild processes sharing a work directory.
+
+We use flock(2) on lock files, so that a lock is released automatically if the
+process holding it dies. On Linux, this also works across hosts on NFS.
+"""
+
+import fcntl
+import os
+import socket
+
+from alibuild_helpers.log import debug
+
+
+class FileLock:
+  """A lock on the file at PATH, which is created if needed.
+
+  The lock is exclusive, unless taken as a shared one, which any number of
+  processes can hold at the same time, but not together with an exclusive one.
+  """
+
+  def __init__(self, path) -> None:
+    self.path = path
+    self.fd = None
+
+  def acquire(self, blocking=True, shared=False):
+    """Take the lock and return True, or return False if it is held elsewhere.
+
+    If BLOCKING, wait until the lock is free instead of returning False. If
+    SHARED, take a shared lock instead of an exclusive one.
+    """
+    assert self.fd is None, "lock %s is already held" % self.path
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    while True:
+      fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) |
+                    (0 if blocking else fcntl.LOCK_NB))
+      except BlockingIOError:
+        os.close(fd)
+        return False
+      # Whoever held the lock before us might have deleted the file while we
+      # were waiting, in which case we locked a file nobody else will see.
+      try:
+        if os.stat(self.path).st_ino == os.fstat(fd).st_ino:
+          break
+      except FileNotFoundError:
+        pass
+      os.close(fd)
+    # Record who holds the lock, to help debugging stuck builds.
+    if not shared:
+      os.ftruncate(fd, 0)
+      os.write(fd, ("%s %d\n" % (socket.gethostname(), os.getpid())).encode())
+    self.fd = fd
+    return True
+
+  def holder(self):
+    """Return who last took the lock, as "HOST PID"."""
+    try:
+      with open(self.path) as f:
+        return f.read().strip()
+    except OSError:
+      return "unknown"
+
+  def release(self, remove=False) -> None:
+    """Release the lock. If REMOVE, delete the lock file as well."""
+    if self.fd is None:
+      return
+    if remove:
+      try:
+        os.unlink(self.path)
+      except OSError:
+        pass
+    os.close(self.fd)
+    self.fd = None
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.release()
+    return False
+
+
+class PackageClaims:
+  """Claim packages for building, so no other process builds them as well.
+
+  Claims are lock files in DIRECTORY, named after the package and its hash.
+  """
+
+  def __init__(self, directory) -> None:
+    self.directory = directory
+    self.held = {}
+
+  def claim(self, package, pkg_hash):
+    """Return True if we hold the claim for PACKAGE with PKG_HASH."""
+    if package in self.held:
+      return True
+    lock = FileLock(os.path.join(self.directory, "%s-%s.lock" % (package, pkg_hash)))
+    if not lock.acquire(blocking=False):
+      debug("%s is being processed by %s", package, lock.holder())
+      return False
+    self.held[package] = lock
+    return True
+
+  def lock_path(self, package):
+    """Return the lock file of our claim for PACKAGE, or None if we hold none."""
+    lock = self.held.get(package)
+    return lock.path if lock is not None else None
+
+  def release(self, package) -> None:
+    lock = self.held.pop(package, None)
+    if lock is not None:
+      lock.release(remove=True)
+
+  def release_all(self) -> None:
+    for package in list(self.held):
+      self.release(package)
+
+
+class RevisionReservations:
+  """Revisions chosen for new builds of one version of a package.
+
+  A package's revisions are only visible in TARS once its tarball has been
+  built. Until then, the revision is recorded here, as a file named after it
+  in DIRECTORY containing the hash it was chosen for, so that a concurrent
+  aliBuild process does not pick the same revision for another hash. Use this
+  as a context manager, to hold a lock while choosing and reserving.
+
+  Every reservation names the lock file its holder keeps locked while it
+  builds the package (see PackageClaims). It should be released once the
+  tarball is in TARS, or the build failed. Reservations whose holder died
+  before doing so are dropped, as their lock is not held any more.
+  """
+
+  def __init__(self, directory) -> None:
+    self.directory = directory
+    self.lock = FileLock(directory + ".lock")
+
+  def __enter__(self):
+    self.lock.acquire()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.lock.release()
+    return False
+
+  def _read(self, revision):
+    """Return the hash REVISION is reserved for and its holder, or None."""
+    try:
+      with open(os.path.join(self.directory, revision)) as f:
+        pkg_hash, _, holder = f.read().partition("\n")
+    except OSError:
+      return None
+    return pkg_hash.strip(), holder.strip()
+
+  def reserved(self):
+    """Return a dictionary mapping reserved revisions to their hash."""
+    reserved = {}
+    try:
+      names = os.listdir(self.directory)
+    except OSError:
+      return reserved
+    for revision in names:
+      reservation = self._read(revision)
+      if reservation is None:
+        continue
+      pkg_hash, holder = reservation
+      lock = FileLock(holder) if holder else None
+      if lock is None or lock.acquire(blocking=False):
+        debug("Dropping reservation of revision %s for %s, as its holder is gone",
+              revision, pkg_hash)
+        if lock is not None:
+          lock.release(remove=True)
+        self.release(revision, holder)
+        continue
+      reserved[revision] = pkg_hash
+    return reserved
+
+  def reserve(self, revision, pkg_hash, holder) -> None:
+    """Reserve REVISION for PKG_HASH, for as long as lock file HOLDER is locked."""
+    os.makedirs(self.directory, exist_ok=True)
+    with open(os.path.join(self.directory, revision), "w") as f:
+      f.write("%s\n%s\n" % (pkg_hash, holder))
+
+  def release(self, revision, holder) -> None:
+    """Delete the reservation of REVISION, if HOLDER made it."""
+    reservation = self._read(revision)
+    if reservation is not None and reservation[1] == holder:
+      try:
+        os.unlink(os.path.join(self.directory, revision))
+      except OSError:
+        pass
@@ -19,19 +19,20 @@ class LogFormatter(logging.Formatter):
                           logging.CRITICAL: "\033[1;37;41m",
                           logging.SUCCESS:  "\033[1;32m" } if sys.stdout.isatty() else {}
   def format(self, record):
-    record.msg = record.msg % record.args
+    # Don't modify the record, as other handlers may format it too.
+    msg = record.getMessage()
     if record.levelno == logging.BANNER and sys.stdout.isatty():
-      lines = record.msg.split("\n")
+      lines = msg.split("\n")
       return "\n\033[1;34m==>\033[m \033[1m%s\033[m" % lines[0] + \
              "".join("\n    \033[1m%s\033[m" % x for x in lines[1:])
     elif record.levelno == logging.INFO or record.levelno == logging.BANNER:
-      return record.msg
+      return msg
     return "\n".join(self.fmtstr % {
       "asctime": datetime.datetime.now().strftime("%Y-%m-%d@%H:%M:%S"),
       "levelname": (self.LEVEL_COLORS.get(record.levelno, self.COLOR_RESET) +
                     record.levelname + self.COLOR_RESET),
       "message": x,
-    } for x in record.msg.split("\n"))
+    } for x in msg.split("\n"))
 
 
 def log_current_package(package, main_package, specs, devel_prefix) -> None:
@@ -111,6 +112,23 @@ class ProgressPrint:
     sys.stderr.flush()
 
 
+class PackageLogPrint:
+  """Log the output of a build running concurrently with others.
+
+  This can be used instead of ProgressPrint, which would garble the terminal
+  if several builds updated their progress bars at the same time.
+  """
+  def __init__(self, begin_msg="") -> None:
+    self.begin_msg = begin_msg
+    info("%s...", begin_msg)
+
+  def __call__(self, txt, *args) -> None:
+    debug("%s: %s", self.begin_msg, txt % args)
+
+  def end(self, msg="", error=False):
+    (logger.error if error else info)("%s: %s", self.begin_msg, msg)
+
+
 # Add loglevel BANNER (same as INFO but with more emphasis on ttys)
 logging.BANNER = 25
 logging.addLevelName(logging.BANNER, "BANNER")
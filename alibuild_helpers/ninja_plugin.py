@@ -0,0 +1,103 @@
+"""A plugin writing the build as a build.ninja file.
+
+aliBuild resolves the packages to build and writes their build scripts as
+usual, but instead of running them itself, it writes a build.ninja file in the
+work directory, in which every package that needs to be built (or unpacked) is
+a build statement running its build script. Each statement depends on the ones
+of the package's dependencies, so ninja can run them in parallel, in the right
+order. Nothing is uploaded to the write store.
+"""
+
+import os
+from os.path import abspath, join
+from shlex import quote
+
+from alibuild_helpers.log import banner
+
+# Ask doBuild for the build scripts of the packages to build.
+needs_build_scripts = True
+
+
+def ninja_escape(value):
+  """Escape VALUE for use in a ninja variable."""
+  return value.replace("$", "$$").replace("\n", "$\n")
+
+
+def ninja_path(path):
+  """Escape PATH for use as an input or output of a ninja build statement."""
+  return ninja_escape(path).replace(" ", "$ ").replace(":", "$:")
+
+
+def installed_marker(spec, work_dir, architecture):
+  """Return the file that a successful build of SPEC writes last."""
+  return join(work_dir, architecture, spec["package"],
+              "{version}-{revision}".format(**spec), ".build-hash")
+
+
+def job_command(job):
+  """Return the shell command running JOB, with the environment it needs."""
+  if job["env"] is None:   # the build runs in a container
+    return job["command"]
+  # Only pass what differs from the environment ninja will run in.
+  env = sorted((key, value) for key, value in job["env"].items()
+               if os.environ.get(key) != value)
+  if not env:
+    return job["command"]
+  return "env %s %s" % (" ".join(quote(f"{key}={value}") for key, value in env),
+                        job["command"])
+
+
+def generate_ninja(specs, args, build_order, jobs):
+  """Return the contents of a build.ninja file running JOBS.
+
+  JOBS maps the packages in BUILD_ORDER that need to be built to the job that
+  doBuild would have run for them.
+  """
+  work_dir = abspath(args.workDir)
+  builders = getattr(args, "builders", 1)
+  outputs = {p: installed_marker(specs[p], work_dir, args.architecture) for p in jobs}
+  lines = [
+    "# Generated by aliBuild for %s." % ", ".join(args.pkgname),
+    "ninja_required_version = 1.5",
+    "",
+    "pool builders",
+    "  depth = %d" % builders,
+    "",
+    "rule alibuild",
+    "  command = $command",
+    "  description = $description",
+    "  restat = 1",
+    "",
+  ]
+  # Development packages are rebuilt every time, like aliBuild does.
+  if any(specs[p]["is_devel_pkg"] for p in jobs):
+    lines += ["build always: phony", ""]
+  for p in build_order:
+    if p not in jobs:
+      continue
+    deps = [ninja_path(outputs[dep]) for dep in specs[p]["requires"] if dep in jobs]
+    if specs[p]["is_devel_pkg"]:
+      deps.append("always")
+    lines += [
+      "build %s: alibuild%s" % (ninja_path(outputs[p]), " | " + " ".join(deps) if deps else ""),
+      "  command = %s" % ninja_escape(job_command(jobs[p])),
+      "  description = %s" % ninja_escape(jobs[p]["message"]),
+      # With a single builder, show the build's output as it runs.
+      "  pool = %s" % ("console" if builders == 1 else "builders"),
+      "build %s: phony %s" % (ninja_path(p), ninja_path(outputs[p])),
+      "",
+    ]
+  lines.append("default %s" % " ".join(ninja_path(outputs[p]) for p in build_order if p in jobs))
+  return "\n".join(lines) + "\n"
+
+
+def build_plugin(specs, args, build_order, jobs) -> None:
+  """Write build.ninja in the work directory, running the build scripts in JOBS."""
+  if not jobs:
+    banner("Nothing to be done.")
+    return
+  path = join(abspath(args.workDir), "build.ninja")
+  with open(path, "w") as f:
+    f.write(generate_ninja(specs, args, build_order, jobs))
+  banner("Wrote the build of %d packages to %s. Run it using:\n\n  ninja -f %s",
+         len(jobs), path, quote(path))
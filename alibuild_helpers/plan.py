@@ -0,0 +1,170 @@
+"""Save the resolved build plan, so that a later build can resume from it.
+
+Before building anything, aliBuild has to check which packages can be taken
+from the system, update their source repositories and resolve their tags to
+commits. The result of this, the specs and the build order, is saved in a
+JSON file under SPECS, together with the hashes and revisions chosen for each
+package and which packages have been installed already. As packages are
+finished, their final spec is appended to a progress file next to the plan, so
+that the whole plan is only written once. If the build is then run again with
+--resume, and nothing the plan was based on has changed, it continues from the
+first package that was not finished.
+"""
+
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from glob import glob
+
+from alibuild_helpers import __version__
+from alibuild_helpers.git import Git
+from alibuild_helpers.log import debug, warning
+from alibuild_helpers.sl import Sapling
+from alibuild_helpers.utilities import Hasher
+
+# Increase this when the layout of the plan changes incompatibly.
+PLAN_FORMAT = 2
+
+# Spec keys holding sets, which JSON stores as lists.
+SET_KEYS = ("full_requires", "full_runtime_requires", "full_build_requires")
+
+# Command-line options that influence how packages are resolved.
+INPUT_ARGS = ("pkgname", "allPackages", "defaults", "architecture", "disable", "force_rebuild",
+              "noDevel", "forceTracked", "preferSystem", "noSystem",
+              "environment", "develPrefix", "docker", "dockerImage",
+              "remoteStore", "writeStore", "onlyDeps", "configDir",
+              "referenceSources")
+
+
+def plan_path(work_dir, architecture, packages, defaults=None):
+  """Return where the plan for building PACKAGES with DEFAULTS is saved."""
+  name = ",".join(packages)
+  # File names are limited in length, and with --all we build hundreds of
+  # packages at once.
+  if len(name) > 200:
+    h = Hasher()
+    h(name)
+    name = "%d-packages-%s" % (len(packages), h.hexdigest()[:12])
+  if defaults:
+    name += "@" + defaults
+  return os.path.join(work_dir, "SPECS", architecture, "plans", name + ".json")
+
+
+def progress_path(path):
+  """Return where packages finished since the plan in PATH was saved are recorded."""
+  return os.path.splitext(path)[0] + ".progress"
+
+
+def inputs_fingerprint(args, alidist_hash):
+  """Hash everything that resolving the packages to build depends on.
+
+  This covers the recipes (including uncommitted changes), the relevant
+  command-line options, the aliBuild version and which directories in the
+  current directory could be development packages. The state of development
+  packages' sources is checked separately.
+  """
+  h = Hasher()
+  h(__version__ or "unknown")
+  h(alidist_hash)
+  for key in INPUT_ARGS:
+    h("{}={!r};".format(key, getattr(args, key, None)))
+  for recipe in sorted(glob(os.path.join(args.configDir, "*.sh"))):
+    with open(recipe, "rb") as f:
+      h(f.read())
+  h(repr(sorted(d for d in glob("*") if os.path.isdir(d))))
+  return h.hexdigest()
+
+
+def _encode(obj):
+  if isinstance(obj, (set, frozenset)):
+    return sorted(obj)
+  if isinstance(obj, (Git, Sapling)):
+    return obj.name
+  raise TypeError("cannot save %r in the build plan" % (obj,))
+
+
+def write_plan(path, inputs, build_order, specs, finished, system_packages,
+               own_packages, untracked_directories, devel_branch) -> None:
+  """Save the plan to PATH, replacing any previous one atomically."""
+  try:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path),
+                                     prefix=".plan.", delete=False) as f:
+      try:
+        json.dump({
+          "format": PLAN_FORMAT,
+          "inputs": inputs,
+          "build_order": build_order,
+          "specs": specs,
+          "finished": sorted(finished),
+          "system_packages": system_packages,
+          "own_packages": own_packages,
+          "untracked_directories": untracked_directories,
+          "devel_branch": devel_branch,
+        }, f, default=_encode)
+      except (TypeError, ValueError):
+        os.unlink(f.name)
+        raise
+    # Progress recorded for an earlier plan does not apply to this one.
+    try:
+      os.unlink(progress_path(path))
+    except FileNotFoundError:
+      pass
+    os.replace(f.name, path)
+  except (OSError, TypeError, ValueError) as exc:
+    warning("Could not save the build plan to %s: %s", path, exc)
+
+
+def record_finished(path, spec) -> None:
+  """Record that the package of SPEC was finished, for the plan saved in PATH."""
+  try:
+    line = json.dumps(spec, default=_encode) + "\n"
+    # Other workers sharing the plan may append at the same time, so write
+    # each line in one go.
+    fd = os.open(progress_path(path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, line.encode())
+    finally:
+      os.close(fd)
+  except (OSError, TypeError, ValueError) as exc:
+    warning("Could not record progress of the build plan in %s: %s", path, exc)
+
+
+def read_plan(path, inputs):
+  """Load the plan saved in PATH, if it is still valid for INPUTS.
+
+  Return None if there is no usable plan, in which case the packages to build
+  must be resolved from scratch.
+  """
+  try:
+    with open(path) as f:
+      plan = json.load(f, object_pairs_hook=OrderedDict)
+  except (OSError, ValueError) as exc:
+    warning("Cannot resume, no usable build plan in %s: %s", path, exc)
+    return None
+  if plan.get("format") != PLAN_FORMAT or plan.get("inputs") != inputs:
+    warning("Recipes or options changed since the build plan in %s was made, "
+            "not resuming.", path)
+    return None
+  plan["finished"] = set(plan["finished"])
+  try:
+    with open(progress_path(path)) as f:
+      lines = f.readlines()
+  except OSError:
+    lines = []
+  for line in lines:
+    try:
+      spec = json.loads(line, object_pairs_hook=OrderedDict)
+    except ValueError:
+      continue   # cut short by a crash
+    if isinstance(spec, dict) and spec.get("package") in plan["specs"]:
+      plan["specs"][spec["package"]] = spec
+      plan["finished"].add(spec["package"])
+  for spec in plan["specs"].values():
+    for key in SET_KEYS:
+      spec[key] = set(spec.get(key, ()))
+    spec["scm"] = Sapling() if spec.get("scm") == Sapling.name else Git()
+  debug("Loaded build plan from %s; finished packages: %s", path,
+        ", ".join(sorted(plan["finished"])) or "none")
+  return plan
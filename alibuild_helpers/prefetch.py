@@ -0,0 +1,135 @@
+"""Download symlinks and tarballs from the remote store ahead of time.
+
+While one package compiles, the network would otherwise be idle, so we fetch
+what later packages will need in the background. Every package still fetches
+its own tarball when its turn comes, which is quick if the prefetch already
+got it, and which retries anything the prefetch failed to get. Its symlinks
+are only fetched again if the prefetch failed to get them.
+"""
+
+import concurrent.futures
+import glob
+import os
+import threading
+
+from alibuild_helpers.log import debug
+from alibuild_helpers.utilities import resolve_store_path, resolve_links_path
+
+
+class Prefetcher:
+  """Fetch remote store contents for packages using a pool of WORKERS threads.
+
+  Tarballs are only fetched ahead while the ones already fetched ahead (and not
+  used yet), together with the one to fetch, take up no more than DISK_BUDGET
+  bytes. The space for a tarball is reserved before downloading it, so that
+  concurrent downloads cannot exceed the budget together.
+  """
+
+  def __init__(self, sync_helper, work_dir, architecture, workers, disk_budget) -> None:
+    self.sync_helper = sync_helper
+    self.work_dir = work_dir
+    self.architecture = architecture
+    self.disk_budget = disk_budget
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    self.futures = {}
+    self.prefetched_bytes = {}
+    self.symlinks_fetched = set()
+    self.lock = threading.Lock()
+
+  def schedule(self, spec) -> None:
+    """Start fetching what SPEC needs, unless that was already started."""
+    if spec["package"] not in self.futures:
+      debug("Prefetching remote store contents for %s", spec["package"])
+      self.futures[spec["package"]] = self.executor.submit(self._fetch, spec)
+
+  def wait(self, package):
+    """Wait until prefetching for PACKAGE (if any) has finished.
+
+    Return whether the symlinks of PACKAGE were fetched, and have not been
+    reported as such by an earlier call yet.
+    """
+    future = self.futures.get(package)
+    if future is None:
+      return False
+    try:
+      future.result()
+    # The backends call sys.exit() on errors, which must not kill the build
+    # here. We fetch everything again anyway, reporting any errors then.
+    except (Exception, SystemExit) as exc:
+      debug("Prefetching for %s failed, fetching it again: %s", package, exc)
+    with self.lock:
+      self.prefetched_bytes.pop(package, None)
+      fetched = package in self.symlinks_fetched
+      self.symlinks_fetched.discard(package)
+    return fetched
+
+  def shutdown(self) -> None:
+    for future in self.futures.values():
+      future.cancel()
+    self.executor.shutdown(wait=False)
+
+  def _tarball_size(self, spec):
+    return sum(os.path.getsize(tarball)
+               for pkg_hash in spec["remote_hashes"]
+               for tarball in glob.glob(os.path.join(
+                 self.work_dir, resolve_store_path(self.architecture, pkg_hash),
+                 "%s-%s-*.tar.gz" % (spec["package"], spec["version"]))))
+
+  def _remote_size(self, spec):
+    """Return the size of the tarball of SPEC in the remote store, or None if unknown.
+
+    The symlinks of SPEC must have been fetched, as they tell us its revision.
+    """
+    suffix = ".%s.tar.gz" % self.architecture
+    prefix = "%s-%s-" % (spec["package"], spec["version"])
+    for link in glob.glob(os.path.join(
+        self.work_dir, resolve_links_path(self.architecture, spec["package"]),
+        glob.escape(prefix) + "*" + suffix)):
+      try:
+        target = os.readlink(link)
+      except OSError:
+        continue
+      for pkg_hash in spec["remote_hashes"]:
+        if "/%s/" % pkg_hash in target:
+          revision = os.path.basename(link)[len(prefix):-len(suffix)]
+          return self.sync_helper.tarball_size(dict(spec, hash=pkg_hash, revision=revision))
+    return None
+
+  def _installed(self, spec):
+    for build_hash in glob.glob(os.path.join(
+        self.work_dir, self.architecture, spec["package"],
+        spec["version"] + "-*", ".build-hash")):
+      try:
+        with open(build_hash) as f:
+          if f.read().strip() in spec["remote_hashes"] + spec["local_hashes"]:
+            return True
+      except OSError:
+        pass
+    return False
+
+  def _fetch(self, spec) -> None:
+    self.sync_helper.fetch_symlinks(spec)
+    with self.lock:
+      self.symlinks_fetched.add(spec["package"])
+    # Development packages are never taken from the remote store, and there is
+    # no point in downloading a tarball for a package we have installed.
+    if spec["is_devel_pkg"] or self._installed(spec):
+      return
+    if self._tarball_size(spec):
+      return   # already downloaded before
+    size = self._remote_size(spec) or 0
+    with self.lock:
+      used = sum(self.prefetched_bytes.values())
+      if used >= self.disk_budget or used + size > self.disk_budget:
+        debug("Prefetch disk budget used up, not fetching tarball for %s ahead",
+              spec["package"])
+        return
+      self.prefetched_bytes[spec["package"]] = size
+    try:
+      self.sync_helper.fetch_tarball(spec)
+    except BaseException:
+      with self.lock:
+        self.prefetched_bytes.pop(spec["package"], None)
+      raise
+    with self.lock:
+      self.prefetched_bytes[spec["package"]] = self._tarball_size(spec)
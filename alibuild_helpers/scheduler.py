@@ -0,0 +1,471 @@
+"""Schedule package builds over the dependency graph.
+
+Packages whose dependencies have all finished can be built at the same time as
+each other, so that independent branches of the dependency tree do not have to
+wait for one another.
+"""
+
+import concurrent.futures
+import json
+import math
+import os
+import signal
+import tempfile
+import threading
+import time
+
+from alibuild_helpers.cmd import terminate_process_groups
+from alibuild_helpers.log import debug, warning
+
+GiB = 1024 ** 3
+
+
+def _read_json(path):
+  try:
+    with open(path) as f:
+      data = json.load(f)
+  except (OSError, ValueError):
+    return {}
+  return data if isinstance(data, dict) else {}
+
+
+def _write_json(path, data) -> None:
+  # Write to a temporary file first, so a concurrent reader never sees a
+  # partially written file.
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path),
+                                   prefix=".build-stats.", delete=False) as f:
+    json.dump(data, f, indent=2, sort_keys=True)
+  os.replace(f.name, path)
+
+
+def read_durations(path):
+  """Read the build durations recorded in PATH by record_duration.
+
+  The result maps package names to a dictionary mapping versions to the number
+  of seconds their last build took. If PATH is missing or unreadable, nothing
+  is known yet.
+  """
+  return _read_json(path)
+
+
+def record_duration(path, package, version, seconds) -> None:
+  """Remember in PATH that building PACKAGE at VERSION took SECONDS."""
+  durations = read_durations(path)
+  durations.setdefault(package, {})[version] = round(seconds, 1)
+  try:
+    _write_json(path, durations)
+  except OSError as exc:
+    warning("Could not record build duration of %s: %s", package, exc)
+
+
+def expected_durations(durations, specs, build_order):
+  """Guess how long each package in BUILD_ORDER will take to build.
+
+  We use the duration recorded for the same version of a package if we have
+  it, or else the one recorded for any other version. Packages that were never
+  built are assumed to take as long as the average package we know about.
+  """
+  expected = {}
+  for p in build_order:
+    known = durations.get(p, {})
+    if specs[p]["version"] in known:
+      expected[p] = known[specs[p]["version"]]
+    elif known:
+      expected[p] = max(known.values())
+  average = sum(expected.values()) / len(expected) if expected else 0
+  return {p: expected.get(p, average) for p in build_order}
+
+
+def assign_shards(build_order, specs, durations, shards):
+  """Split the packages in BUILD_ORDER between SHARDS runners.
+
+  We go through the packages in build order, and give each one to the runner
+  that would finish it first, given when its dependencies are expected to be
+  ready and what that runner was given before. If that is a tie, the runner
+  building the dependency finishing last gets it, so fewer tarballs need to go
+  through the remote store. DURATIONS maps packages to how long they are
+  expected to take; packages not known to take any time count as one second.
+
+  The result only depends on the arguments, so runners called with the same
+  ones agree on it. Return a dictionary mapping each package to its shard,
+  counting from 1.
+  """
+  position = {p: i for i, p in enumerate(build_order)}
+  shard_of, finish = {}, {}
+  free = [0.0] * shards
+  for p in build_order:
+    deps = [dep for dep in specs[p]["requires"] if dep in position]
+    ready = max((finish[dep] for dep in deps), default=0.0)
+    last = max(deps, key=lambda dep: (finish[dep], position[dep]), default=None)
+    cost = max(durations.get(p, 0), 1)
+    shard = min(range(shards), key=lambda s: (max(free[s], ready) + cost,
+                                              last is None or shard_of[last] != s, s))
+    shard_of[p] = shard
+    finish[p] = free[shard] = max(free[shard], ready) + cost
+  return {p: shard + 1 for p, shard in shard_of.items()}
+
+
+def read_resource_usage(path):
+  """Read the resource usage recorded in PATH by record_resource_usage."""
+  return _read_json(path)
+
+
+def record_resource_usage(path, package, jobs, seconds, usage) -> None:
+  """Remember in PATH what building PACKAGE with JOBS parallel jobs used.
+
+  USAGE is filled in by alibuild_helpers.cmd.execute. We keep the peak memory
+  of the largest process, which is about what every parallel job needs, and
+  how many CPUs the build kept busy on average.
+
+  A build with fewer jobs than recorded before cannot tell whether the package
+  would keep more jobs busy, so we keep how many CPUs the build with the most
+  jobs kept busy.
+  """
+  stats = read_resource_usage(path)
+  known = stats.get(package, {})
+  if known.get("jobs", 0) > jobs:
+    jobs, parallelism = known["jobs"], known["parallelism"]
+  else:
+    parallelism = round(usage["cpu_time"] / seconds, 2) if seconds > 0 else jobs
+  stats[package] = {
+    "jobs": jobs,
+    "memory_per_job": usage["max_rss"],
+    "parallelism": parallelism,
+  }
+  try:
+    _write_json(path, stats)
+  except OSError as exc:
+    warning("Could not record resource usage of %s: %s", package, exc)
+
+
+def expected_needs(stats, specs, build_order):
+  """Work out how much memory per job and how many jobs each package can use.
+
+  Recipes can declare the peak memory of each parallel compilation process in
+  GiB as memory_per_job, and the number of jobs the build stops getting faster
+  at as max_jobs. If we measured more memory than declared in past builds, we
+  use that instead. If a past build kept far fewer CPUs busy than it had jobs,
+  we do not give it more than it could use next time. Only a build with more
+  jobs than that limit shows the package cannot use them, so builds limited
+  this way do not lower it any further (see record_resource_usage).
+  """
+  needs = {}
+  for p in build_order:
+    known = stats.get(p, {})
+    memory = max(float(specs[p].get("memory_per_job", 0)) * GiB,
+                 known.get("memory_per_job", 0))
+    max_jobs = specs[p].get("max_jobs")
+    if known and known["parallelism"] < 0.8 * known["jobs"]:
+      learned = max(1, math.ceil(known["parallelism"] * 1.25))
+      if learned < known["jobs"]:
+        max_jobs = min(int(max_jobs), learned) if max_jobs else learned
+    needs[p] = memory, max_jobs and int(max_jobs)
+  return needs
+
+
+def _cgroup_file(v2_name, v1_name):
+  """Read a file from this process's cgroup, trying cgroup v2 first."""
+  paths = []
+  try:
+    with open("/proc/self/cgroup") as f:
+      for line in f:
+        _, controllers, path = line.rstrip("\n").split(":", 2)
+        if not controllers:
+          paths.append(os.path.join("/sys/fs/cgroup", path.lstrip("/"), v2_name))
+        elif v1_name.split("/")[0] in controllers.split(","):
+          paths.append(os.path.join("/sys/fs/cgroup", v1_name.split("/")[0],
+                                    path.lstrip("/"), v1_name.split("/")[1]))
+  except (OSError, ValueError):
+    pass
+  # Inside containers, the cgroup is usually mounted at the root.
+  paths += [os.path.join("/sys/fs/cgroup", v2_name), os.path.join("/sys/fs/cgroup", v1_name)]
+  for path in paths:
+    try:
+      with open(path) as f:
+        return f.read().strip()
+    except OSError:
+      continue
+  return None
+
+
+def available_cpus():
+  """Return how many CPUs we may use, respecting affinity and cgroup limits."""
+  try:
+    cpus = len(os.sched_getaffinity(0))
+  except AttributeError:   # not available on macOS
+    cpus = os.cpu_count() or 1
+  quota = _cgroup_file("cpu.max", "cpu/cpu.cfs_quota_us")
+  try:
+    if quota and " " in quota:   # cgroup v2: "QUOTA PERIOD" or "max PERIOD"
+      limit, period = quota.split()
+      if limit != "max":
+        cpus = min(cpus, math.ceil(int(limit) / int(period)))
+    elif quota and int(quota) > 0:
+      period = _cgroup_file("cpu.max", "cpu/cpu.cfs_period_us")
+      cpus = min(cpus, math.ceil(int(quota) / int(period)))
+  except (TypeError, ValueError, ZeroDivisionError):
+    pass
+  return max(1, cpus)
+
+
+def available_memory():
+  """Return how many bytes of memory builds may use, or None if unknown.
+
+  This is the memory available on the system, limited by our cgroup.
+  """
+  memory = None
+  try:
+    with open("/proc/meminfo") as f:
+      for line in f:
+        if line.startswith("MemAvailable:"):
+          memory = int(line.split()[1]) * 1024
+  except (OSError, ValueError, IndexError):
+    pass
+  if memory is None:
+    try:
+      memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+      pass
+  limit = _cgroup_file("memory.max", "memory/memory.limit_in_bytes")
+  usage = _cgroup_file("memory.current", "memory/memory.usage_in_bytes")
+  try:
+    # cgroup v1 reports a huge number if there is no limit.
+    if limit and limit != "max" and int(limit) < 2**60:
+      free = int(limit) - int(usage or 0)
+      memory = free if memory is None else min(memory, free)
+  except ValueError:
+    pass
+  return memory
+
+
+class ResourceBudget:
+  """Decide whether a build fits into the CPUs and memory left, and with how many jobs.
+
+  NEEDS maps packages to their memory per job in bytes (0 if unknown) and the
+  maximum number of jobs they can use (None if unlimited), as returned by
+  expected_needs. If MEMORY is None, memory is not limited.
+  """
+
+  def __init__(self, cpus, memory, needs) -> None:
+    self.cpus = cpus
+    self.memory = memory
+    self.needs = needs
+    self.reserved = {}
+
+  def reserve(self, package, share):
+    """Reserve resources for building PACKAGE with up to SHARE jobs.
+
+    Return the number of jobs to use, or None if the build must wait for others
+    to finish first. If nothing else is running, the build always starts, with
+    at least one job.
+    """
+    memory_per_job, max_jobs = self.needs.get(package, (0, None))
+    jobs = min(share, self.cpus - sum(j for j, _ in self.reserved.values()))
+    if max_jobs:
+      jobs = min(jobs, max_jobs)
+    if memory_per_job and self.memory is not None:
+      free = self.memory - sum(m for _, m in self.reserved.values())
+      jobs = min(jobs, int(free // memory_per_job))
+    if jobs < 1:
+      if self.reserved:
+        debug("Not enough resources to start %s yet", package)
+        return None
+      jobs = 1
+    self.reserved[package] = jobs, jobs * memory_per_job
+    return jobs
+
+  def release(self, package) -> None:
+    self.reserved.pop(package, None)
+
+
+class BuildScheduler:
+  """Keep track of which packages in a build order are ready to be processed.
+
+  Every package starts out pending. It is ready once all its dependencies
+  (among those in the build order) have finished. While its build script runs,
+  it is running, and it is finished once it is installed in its final location.
+
+  If DURATIONS (mapping packages to how long we expect them to take) is given,
+  ready packages are ranked by the longest chain of builds that depends on
+  them, so that the slowest path through the dependency graph starts first.
+  """
+
+  def __init__(self, build_order, specs, durations=None) -> None:
+    self.pending = list(build_order)
+    self.running = set()
+    self.finished = set()
+    self.built = set()
+    self.failed = set()
+    self.blocked = set()
+    in_order = frozenset(build_order)
+    self.requires = {p: {dep for dep in specs[p]["requires"] if dep in in_order}
+                     for p in build_order}
+    self.position = {p: i for i, p in enumerate(build_order)}
+    self.critical_path = dict.fromkeys(build_order, 0)
+    durations = durations or {}
+    # Every package comes after its dependencies in the build order, so going
+    # backwards we see all packages depending on P before P itself.
+    for p in reversed(build_order):
+      self.critical_path[p] += durations.get(p, 0)
+      for dep in self.requires[p]:
+        self.critical_path[dep] = max(self.critical_path[dep], self.critical_path[p])
+
+  def ready(self):
+    """Return the pending packages whose dependencies have all finished.
+
+    Packages whose build script already ran come first, as they only need to be
+    checked. The others are sorted by the length of their critical path, then
+    by build order.
+    """
+    return sorted((p for p in self.pending if self.requires[p] <= self.finished),
+                  key=lambda p: (p not in self.built, -self.critical_path[p],
+                                 self.position[p]))
+
+  def start(self, package) -> None:
+    self.pending.remove(package)
+    self.running.add(package)
+
+  def retry(self, package) -> None:
+    """Queue a package whose build script has run to be processed again."""
+    self.running.discard(package)
+    self.built.add(package)
+    self.pending.append(package)
+
+  def finish(self, package) -> None:
+    if package in self.pending:
+      self.pending.remove(package)
+    self.running.discard(package)
+    self.finished.add(package)
+
+  def fail(self, package) -> None:
+    """Give up on PACKAGE, and on all packages depending on it."""
+    self.running.discard(package)
+    self.failed.add(package)
+    while True:
+      blocked = [p for p in self.pending if self.requires[p] & (self.failed | self.blocked)]
+      if not blocked:
+        break
+      for p in blocked:
+        self.pending.remove(p)
+        self.blocked.add(p)
+
+  def done(self):
+    return not self.pending and not self.running
+
+
+# Signals that stop the build like Ctrl-C does, e.g. when a CI job is
+# cancelled or the terminal is closed.
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGHUP)
+
+
+def _interrupt(signum, frame):
+  raise KeyboardInterrupt("Stopped by signal %d" % signum)
+
+
+def run_builds(scheduler, builders, jobs, prepare, build, complete,
+               claim=None, release=None, poll_interval=10, resources=None) -> None:
+  """Process every package known to SCHEDULER, running up to BUILDERS builds at once.
+
+  prepare(package, jobs) is called in the calling thread for every package
+  that is ready, and returns None if nothing needs to be built for it, or a job
+  to be passed to build(package, job). JOBS is the number of parallel
+  compilation processes, which is split between the builds running at the same
+  time. build() runs in a worker thread; once it returns, complete(package,
+  job, result) is called in the calling thread and the package is prepared
+  again, so prepare() can check that it was installed correctly.
+
+  If claim(package) is given, it is called before preparing a package, and
+  returns False if someone else (e.g. another aliBuild process) is processing
+  it at the moment. We then try again every POLL_INTERVAL seconds. Once a
+  package is finished, release(package) is called.
+
+  If RESOURCES (a ResourceBudget) is given, a build only starts once it fits
+  into the resources left over by the running ones, and the number of jobs it
+  gets is chosen from them.
+
+  If complete() raises (e.g. because a build failed), the builds that are still
+  running are allowed to finish before the exception is propagated. If it
+  returns False instead, the package and everything depending on it are
+  skipped, and all other packages are still built.
+
+  SIGTERM and SIGHUP are turned into a KeyboardInterrupt while this runs, so
+  that the running builds are stopped in any of these cases.
+  """
+  previous_handlers = {}
+  if threading.current_thread() is threading.main_thread():
+    for signum in STOP_SIGNALS:
+      previous_handlers[signum] = signal.signal(signum, _interrupt)
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=builders)
+  try:
+    futures = {}
+    claimed_elsewhere = set()
+    while not scheduler.done():
+      while len(futures) < builders:
+        ready = [p for p in scheduler.ready() if p not in claimed_elsewhere]
+        if not ready:
+          break
+        package = ready[0]
+        if claim is not None and not claim(package):
+          claimed_elsewhere.add(package)
+          continue
+        share = max(1, jobs // min(builders, len(futures) + len(ready)))
+        # Packages whose build already ran are only checked, which needs no
+        # resources to speak of.
+        if resources is not None and package not in scheduler.built:
+          share = resources.reserve(package, share)
+          if share is None:
+            # Let other workers build it meanwhile, if they have the resources.
+            if release is not None:
+              release(package)
+            break   # wait for a running build to free up resources
+        job = prepare(package, share)
+        if job is None:
+          scheduler.finish(package)
+          if resources is not None:
+            resources.release(package)
+          if release is not None:
+            release(package)
+          continue
+        debug("Starting build of %s with %d jobs", package, share)
+        scheduler.start(package)
+        futures[executor.submit(build, package, job)] = package, job
+
+      if not futures and claimed_elsewhere:
+        debug("Waiting for %s, being processed elsewhere", ", ".join(sorted(claimed_elsewhere)))
+        time.sleep(poll_interval)
+        claimed_elsewhere.clear()
+        continue
+      if not futures:
+        assert scheduler.done(), "no package is ready, but none is running either"
+        break
+      finished, _ = concurrent.futures.wait(
+        futures, timeout=poll_interval if claimed_elsewhere else None,
+        return_when=concurrent.futures.FIRST_COMPLETED)
+      claimed_elsewhere.clear()
+      for future in finished:
+        package, job = futures.pop(future)
+        if resources is not None:
+          resources.release(package)
+        try:
+          succeeded = complete(package, job, future.result())
+        except BaseException:
+          if futures:
+            warning("Waiting for unfinished builds of %s...",
+                    ", ".join(sorted(p for p, _ in futures.values())))
+          raise
+        if succeeded is False:
+          scheduler.fail(package)
+          if release is not None:
+            release(package)
+        else:
+          scheduler.retry(package)
+  except KeyboardInterrupt:
+    # Builds run in their own process groups, so they did not get the
+    # interrupt from the terminal, and would keep us waiting for them.
+    terminate_process_groups()
+    raise
+  finally:
+    executor.shutdown(wait=True)
+    for signum, handler in previous_handlers.items():
+      signal.signal(signum, handler)
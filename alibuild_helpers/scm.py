@@ -29,3 +29,5 @@ class SCM:
     raise NotImplementedError
   def checkUntracked(self, line):
     raise NotImplementedError
+  def listUntrackedCmd(self):
+    raise NotImplementedError
@@ -0,0 +1,322 @@
+"""Keep the slow parts of resolving packages warm between aliBuild runs.
+
+`aliBuild server` keeps parsed recipes, the results of system checks and the
+refs of source repositories in memory. While it runs, aliBuild build, deps and
+doctor ask it for them over a Unix socket instead of working them out again.
+
+Every entry is saved with a stamp describing what it was computed from (e.g.
+the size and modification time of a recipe, or of the refs in a repository
+mirror), and is only returned to clients computing the same stamp, so changing
+a recipe or fetching new refs invalidates it. Entries that do not depend on
+any files, like the results of system checks, expire after a while instead.
+The refs of repositories without a mirror are not kept at all, as nothing
+tells us when they change.
+
+The server also watches the sources of development packages (see watch.py), so
+that their local changes only need to be hashed again once something changed.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from os.path import join
+
+from alibuild_helpers.log import debug, info, warning, dieOnError
+from alibuild_helpers.watch import SourceWatcher
+
+# How many seconds entries that depend on the system are kept by default.
+DEFAULT_MAX_AGE = 3600
+
+
+def server_socket_path():
+  """Return where the server of the current user listens."""
+  return os.environ.get("ALIBUILD_SERVER_SOCKET") or join(
+    os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(),
+    "alibuild-%d.sock" % os.getuid())
+
+
+def file_stamp(*paths):
+  """Return a stamp that changes whenever one of PATHS is modified."""
+  stamp = []
+  for path in paths:
+    try:
+      st = os.stat(path)
+    except OSError:
+      stamp.append(None)
+    else:
+      stamp.append([st.st_mtime_ns, st.st_size])
+  return stamp
+
+
+def mirror_stamp(mirror):
+  """Return a stamp that changes whenever the refs in the repository MIRROR do.
+
+  If there is no such repository, return None.
+  """
+  if not os.path.isdir(mirror):
+    return None
+  return file_stamp(mirror, join(mirror, "packed-refs"), join(mirror, "FETCH_HEAD"),
+                    join(mirror, "refs", "heads"), join(mirror, "refs", "tags"))
+
+
+def _plain(value):
+  """Return VALUE as it comes back from a JSON round trip, or raise TypeError."""
+  return json.loads(json.dumps(value))
+
+
+def _same(value, plain):
+  """Check that PLAIN, from a JSON round trip, is VALUE, except for tuples."""
+  if isinstance(value, (list, tuple)):
+    return isinstance(plain, list) and len(value) == len(plain) and \
+      all(_same(v, p) for v, p in zip(value, plain))
+  if isinstance(value, dict):
+    return isinstance(plain, dict) and value.keys() == plain.keys() and \
+      all(_same(v, plain[k]) for k, v in value.items())
+  return type(value) is type(plain) and value == plain
+
+
+class ResolutionStore:
+  """The entries kept by the server, with their stamps."""
+
+  def __init__(self, max_age=DEFAULT_MAX_AGE) -> None:
+    self.max_age = max_age
+    self.entries = {}
+    self.lock = threading.Lock()
+    self.watcher = SourceWatcher()
+
+  def handle(self, request):
+    """Answer a REQUEST from a client, and return the response."""
+    if request["op"] == "watch":
+      return {"generation": self.watcher.generation(request["directory"])}
+    entry_key = request["kind"], json.dumps(request["key"])
+    with self.lock:
+      if request["op"] == "put":
+        self.entries[entry_key] = request["stamp"], time.time(), request["value"]
+        return {"ok": True}
+      if request["op"] != "get":
+        return {"error": "unknown operation %r" % request["op"]}
+      stamp, created, value = self.entries.get(entry_key, (None, 0, None))
+      if entry_key not in self.entries or stamp != request["stamp"] or \
+         (stamp is None and time.time() - created > self.max_age):
+        self.entries.pop(entry_key, None)
+        return {"found": False}
+      return {"found": True, "value": value}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+  def handle(self) -> None:
+    for line in self.rfile:
+      try:
+        response = self.server.store.handle(json.loads(line))
+      except (ValueError, KeyError, TypeError) as exc:
+        response = {"error": str(exc)}
+      self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+      self.wfile.flush()
+
+
+def _peer_uid(sock):
+  """Return the user running the process at the other end of SOCK, if known."""
+  if not hasattr(socket, "SO_PEERCRED"):
+    return None
+  creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+  return struct.unpack("3i", creds)[1]
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+class ServerClient:
+  """A connection to a running `aliBuild server`."""
+
+  def __init__(self, sock) -> None:
+    self.sock = sock
+    self.file = sock.makefile("rwb")
+    # Repositories are updated from several threads at once.
+    self.lock = threading.Lock()
+
+  @classmethod
+  def connect(cls, path=None):
+    """Connect to the server listening on PATH, and return None if none is."""
+    path = path or server_socket_path()
+    try:
+      owner = os.lstat(path).st_uid
+    except OSError:
+      return None
+    # The socket may be in a directory anyone can write to, so make sure it
+    # belongs to a server of the current user before trusting its answers.
+    if owner != os.getuid():
+      warning("Not using aliBuild server at %s, as it belongs to another user", path)
+      return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(10)
+    try:
+      sock.connect(path)
+    except OSError as exc:
+      debug("Not using aliBuild server at %s: %s", path, exc)
+      sock.close()
+      return None
+    if _peer_uid(sock) not in (None, os.getuid()):
+      warning("Not using aliBuild server at %s, as it runs as another user", path)
+      sock.close()
+      return None
+    debug("Using aliBuild server at %s", path)
+    return cls(sock)
+
+  def request(self, **request):
+    with self.lock:
+      self.file.write(json.dumps(request).encode("utf-8") + b"\n")
+      self.file.flush()
+      line = self.file.readline()
+    if not line:
+      raise OSError("connection closed by server")
+    # Recipes are parsed into OrderedDicts, so we return those too.
+    return json.loads(line, object_pairs_hook=OrderedDict)
+
+  def close(self) -> None:
+    self.file.close()
+    self.sock.close()
+
+
+class ServerMapping:
+  """A dictionary-like view on one kind of the server's entries.
+
+  STAMP(key) returns what the entry for key was computed from; entries whose
+  stamp is None expire after a while or, without EXPIRE, are not kept at all.
+  CONTEXT is added to all keys, for things the entries depend on that are not
+  part of the keys themselves. With REFRESH, existing entries are ignored, but
+  new ones are still saved.
+  """
+
+  def __init__(self, client, kind, stamp=lambda key: None, context=(), refresh=False,
+               expire=True) -> None:
+    self.client = client
+    self.kind = kind
+    self.stamp = stamp
+    self.context = list(context)
+    self.refresh = refresh
+    self.expire = expire
+    self.found = {}
+
+  def _request(self, **request):
+    if self.client is None:
+      return {}
+    try:
+      return self.client.request(kind=self.kind, **request)
+    except (OSError, ValueError) as exc:
+      warning("Lost connection to aliBuild server, continuing without it: %s", exc)
+      self.client = None
+      return {}
+
+  def __contains__(self, key):
+    if self.refresh:
+      return False
+    stamp = self.stamp(key)
+    if stamp is None and not self.expire:
+      return False
+    response = self._request(op="get", key=self.context + [key], stamp=stamp)
+    if response.get("found"):
+      self.found[key] = response["value"]
+    return bool(response.get("found"))
+
+  def __getitem__(self, key):
+    if key not in self.found and key not in self:
+      raise KeyError(key)
+    return self.found.pop(key)
+
+  def __setitem__(self, key, value) -> None:
+    try:
+      plain = _plain(value)
+    except (TypeError, ValueError):
+      plain = None
+    if plain is None or not _same(value, plain):
+      debug("Not saving %s entry for %r in aliBuild server", self.kind, key)
+      return
+    stamp = self.stamp(key)
+    if stamp is None and not self.expire:
+      return
+    self._request(op="put", key=self.context + [key], stamp=stamp, value=plain)
+
+
+class LocalChanges(ServerMapping):
+  """The hashes of the local changes of development packages.
+
+  Entries are only found while the server watches the sources they were
+  calculated from, and nothing changed in them since. Call watch before
+  calculating a hash to save, as changes made meanwhile must invalidate it.
+  """
+
+  def __init__(self, client) -> None:
+    super().__init__(client, "local_changes", stamp=lambda key: self.generations.get(key[0]))
+    self.generations = {}
+
+  def watch(self, directory):
+    """Ask the server to watch DIRECTORY, and return if it does."""
+    generation = self._request(op="watch", directory=directory).get("generation")
+    if generation is None:
+      self.generations.pop(directory, None)
+      return False
+    self.generations[directory] = generation
+    return True
+
+
+class ServerCache:
+  """Like build.ResolutionCache, but with the entries kept by `aliBuild server`.
+
+  The entries for recipes are the result of parseRecipe for each recipe file.
+  """
+
+  def __init__(self, client, args) -> None:
+    docker = getattr(args, "dockerImage", None) if getattr(args, "docker", False) else None
+    mirrors = getattr(args, "referenceSources", None)
+    mirrors = mirrors and os.path.abspath(mirrors)
+    environment = sorted(getattr(args, "environment", []))
+    self.checks = ServerMapping(client, "checks", context=[docker, environment])
+    # Without a mirror, nothing tells us when the refs of the remote
+    # repository change, so we must list them again every time.
+    self.refs = ServerMapping(
+      client, "refs", context=[mirrors], expire=False,
+      stamp=lambda key: mirror_stamp(join(mirrors, key[0].lower())) if mirrors else None,
+      refresh=getattr(args, "fetchRepos", False))
+    self.recipes = ServerMapping(client, "recipes", stamp=file_stamp)
+    # Keys start with the (absolute) source directory of the package.
+    self.local_changes = LocalChanges(client)
+
+
+def server_cache(args):
+  """Return a ServerCache if an `aliBuild server` is running, else None."""
+  client = ServerClient.connect()
+  return ServerCache(client, args) if client else None
+
+
+def doServer(args) -> None:
+  """Serve entries to aliBuild processes until interrupted."""
+  path = args.socket or server_socket_path()
+  if os.path.exists(path):
+    dieOnError(os.lstat(path).st_uid != os.getuid(),
+               "%s belongs to another user, pass --socket to listen elsewhere" % path)
+    client = ServerClient.connect(path)
+    dieOnError(client, "An aliBuild server is already listening on %s" % path)
+    # Left over by a server that did not exit cleanly.
+    os.unlink(path)
+  # Only the current user may use the server.
+  umask = os.umask(0o077)
+  try:
+    server = _Server(path, _RequestHandler)
+  finally:
+    os.umask(umask)
+  server.store = ResolutionStore(args.maxAge)
+  info("aliBuild server listening on %s. Stop it with Ctrl-C.", path)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    os.unlink(path)
@@ -55,6 +55,9 @@ class Sapling(SCM):
   def checkUntracked(self, line):
     return line.startswith("? ")
 
+  def listUntrackedCmd(self):
+    return ["status", "--unknown", "--no-status", "--print0"]
+
 
 def sapling(args, directory=".", check=True, prompt=True):
   debug("Executing sl %s (in directory %s)", " ".join(args), directory)
@@ -11,9 +11,10 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from requests.exceptions import RequestException
 from urllib.parse import quote
 
-from alibuild_helpers.cmd import execute
+from alibuild_helpers.cmd import execute, getstatusoutput
 from alibuild_helpers.log import debug, info, warning, error, dieOnError, ProgressPrint, byte_progress
-from alibuild_helpers.utilities import resolve_store_path, resolve_links_path, symlink
+from alibuild_helpers.utilities import resolve_store_path, resolve_links_path, resolve_failure_path, symlink
+from alibuild_helpers.utilities import tarball_name
 
 
 def remote_from_url(read_url, write_url, architecture, work_dir, insecure=False):
@@ -39,6 +40,12 @@ class NoRemoteSync:
     pass
   def upload_symlinks_and_tarball(self, spec) -> None:
     pass
+  def fetch_failure(self, spec) -> None:
+    pass
+  def upload_failure(self, spec) -> None:
+    pass
+  def tarball_size(self, spec):
+    return None
 
 class PartialDownloadError(Exception):
   def __init__(self, downloaded, size) -> None:
@@ -238,6 +245,36 @@ class HttpRemoteSync:
   def upload_symlinks_and_tarball(self, spec) -> None:
     pass
 
+  def tarball_size(self, spec):
+    url = quote("{}/{}/{}".format(self.remoteStore, resolve_store_path(self.architecture, spec["hash"]),
+                                  tarball_name(spec, self.architecture)), safe=":/")
+    try:
+      resp = requests.head(url, verify=not self.insecure, timeout=self.httpTimeoutSec,
+                           allow_redirects=True)
+    except RequestException as exc:
+      debug("HEAD %s failed: %s", url, exc)
+      return None
+    if resp.status_code != 200 or "content-length" not in resp.headers:
+      return None
+    return int(resp.headers["content-length"])
+
+  def fetch_failure(self, spec) -> None:
+    failure_path = resolve_failure_path(self.architecture, spec["hash"])
+    url = quote(f"{self.remoteStore}/{failure_path}", safe=":/")
+    try:
+      resp = requests.get(url, verify=not self.insecure, timeout=self.httpTimeoutSec)
+    except RequestException as exc:
+      debug("GET %s failed: %s", url, exc)
+      return
+    if resp.status_code != 200:
+      return
+    os.makedirs(os.path.dirname(os.path.join(self.workdir, failure_path)), exist_ok=True)
+    with open(os.path.join(self.workdir, failure_path), "wb") as f:
+      f.write(resp.content)
+
+  def upload_failure(self, spec) -> None:
+    pass
+
 
 class RsyncRemoteSync:
   """Helper class to sync package build directory using RSync."""
@@ -309,6 +346,39 @@ class RsyncRemoteSync:
       revision=spec["revision"],
     )), "Unable to upload tarball.")
 
+  def tarball_size(self, spec):
+    err, out = getstatusoutput("rsync --list-only --no-human-readable {remote}/{store_path}/{tarball}".format(
+      remote=self.remoteStore,
+      store_path=resolve_store_path(self.architecture, spec["hash"]),
+      tarball=tarball_name(spec, self.architecture),
+    ))
+    # The listing looks like: -rw-r--r-- 123456 2024/01/01 12:00:00 name
+    fields = out.split()
+    return int(fields[1]) if not err and len(fields) > 1 and fields[1].isdigit() else None
+
+  def fetch_failure(self, spec) -> None:
+    # The failure record is usually missing, so ignore errors here.
+    execute("""\
+    mkdir -p "{workdir}/{failure_dir}"
+    rsync -q "{remote}/{failure_path}" "{workdir}/{failure_path}" 2>/dev/null || :
+    """.format(
+      workdir=self.workdir,
+      remote=self.remoteStore,
+      failure_path=resolve_failure_path(self.architecture, spec["hash"]),
+      failure_dir=os.path.dirname(resolve_failure_path(self.architecture, spec["hash"])),
+    ))
+
+  def upload_failure(self, spec) -> None:
+    if not self.writeStore:
+      return
+    err = execute("cd {workdir} && rsync -aR {failure_path} {remote}/".format(
+      workdir=self.workdir,
+      remote=self.remoteStore,
+      failure_path=resolve_failure_path(self.architecture, spec["hash"]),
+    ))
+    if err:
+      warning("Unable to upload failure record for %s", spec["package"])
+
 class CVMFSRemoteSync:
   """ Sync packages build directory from CVMFS or similar
       FS based deployment. The tarball will be created on the fly with a single
@@ -378,6 +448,16 @@ class CVMFSRemoteSync:
   def upload_symlinks_and_tarball(self, spec) -> None:
     dieOnError(True, "CVMFS backend does not support uploading directly")
 
+  def tarball_size(self, spec):
+    # Packages are only symlinked to CVMFS, so there is nothing to download.
+    return 0
+
+  def fetch_failure(self, spec) -> None:
+    pass
+
+  def upload_failure(self, spec) -> None:
+    pass
+
 class S3RemoteSync:
   """Sync package build directory from and to S3 using s3cmd.
 
@@ -476,6 +556,42 @@ https://s3.cern.ch/swift/v1/{bucket}/$hashedurl" \\
       revision=spec["revision"],
     )), "Unable to upload tarball.")
 
+  def tarball_size(self, spec):
+    err, out = getstatusoutput("""\
+    s3cmd ls -s --host s3.cern.ch --host-bucket {b}.s3.cern.ch "s3://{b}/{store_path}/{tarball}"
+    """.format(
+      b=self.remoteStore,
+      store_path=resolve_store_path(self.architecture, spec["hash"]),
+      tarball=tarball_name(spec, self.architecture),
+    ))
+    # The listing looks like: 2024-01-01 12:00 123456 s3://bucket/key
+    fields = out.split()
+    return int(fields[2]) if not err and len(fields) > 2 and fields[2].isdigit() else None
+
+  def fetch_failure(self, spec) -> None:
+    # The failure record is usually missing, so ignore errors here.
+    execute("""\
+    mkdir -p "{workdir}/{failure_dir}"
+    s3cmd get --force -s -v --host s3.cern.ch --host-bucket {b}.s3.cern.ch \
+          "s3://{b}/{failure_path}" "{workdir}/{failure_path}" >/dev/null 2>&1 || :
+    """.format(
+      workdir=self.workdir,
+      b=self.remoteStore,
+      failure_path=resolve_failure_path(self.architecture, spec["hash"]),
+      failure_dir=os.path.dirname(resolve_failure_path(self.architecture, spec["hash"])),
+    ))
+
+  def upload_failure(self, spec) -> None:
+    if not self.writeStore:
+      return
+    failure_path = resolve_failure_path(self.architecture, spec["hash"])
+    err = execute("""\
+    s3cmd put -s -v --host s3.cern.ch --host-bucket {b}.s3.cern.ch \
+          "{workdir}/{failure_path}" "s3://{b}/{failure_path}" 2>&1
+    """.format(workdir=self.workdir, b=self.writeStore, failure_path=failure_path))
+    if err:
+      warning("Unable to upload failure record for %s", spec["package"])
+
 
 class Boto3RemoteSync:
   """Sync package build directory from and to S3 using boto3.
@@ -754,3 +870,36 @@ class Boto3RemoteSync:
     """
     self.s3.upload_file(Bucket=self.writeStore, Key=tar_path,
                         Filename=os.path.join(self.workdir, tar_path))
+
+  def tarball_size(self, spec):
+    from botocore.exceptions import ClientError
+    key = "/".join((resolve_store_path(self.architecture, spec["hash"]),
+                    tarball_name(spec, self.architecture)))
+    try:
+      meta = self.s3.head_object(Bucket=self.remoteStore, Key=key)
+      redirect = meta.get("WebsiteRedirectLocation")
+      if redirect:
+        meta = self.s3.head_object(Bucket=self.remoteStore, Key=redirect.lstrip("/"))
+    except ClientError as err:
+      if err.response["Error"]["Code"] in ("404", "NoSuchKey"):
+        return None
+      raise
+    return int(meta.get("ContentLength", 0))
+
+  def fetch_failure(self, spec) -> None:
+    from botocore.exceptions import ClientError
+    failure_path = resolve_failure_path(self.architecture, spec["hash"])
+    os.makedirs(os.path.dirname(os.path.join(self.workdir, failure_path)), exist_ok=True)
+    try:
+      self.s3.download_file(Bucket=self.remoteStore, Key=failure_path,
+                            Filename=os.path.join(self.workdir, failure_path))
+    except ClientError as err:
+      if err.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+        raise
+
+  def upload_failure(self, spec) -> None:
+    if not self.writeStore:
+      return
+    failure_path = resolve_failure_path(self.architecture, spec["hash"])
+    self.s3.upload_file(Bucket=self.writeStore, Key=failure_path,
+                        Filename=os.path.join(self.workdir, failure_path))
@@ -8,6 +8,7 @@ import sys
 import os
 import re
 import platform
+import threading
 
 from datetime import datetime
 from collections import OrderedDict
@@ -39,8 +40,12 @@ def symlink(link_target, link_name):
   # If link_name is a symlink pointing to a directory, isdir() will return True.
   if isdir(link_name) and not islink(link_name):
     link_name = join(link_name, basename(link_target))
-  call_ignoring_oserrors(os.unlink, link_name)
-  os.symlink(link_target, link_name)
+  # Replace any existing link atomically, as other aliBuild processes or
+  # threads may be looking at it, or replacing it too.
+  tmp_name = "%s.tmp.%d.%d" % (link_name, os.getpid(), threading.get_ident())
+  call_ignoring_oserrors(os.unlink, tmp_name)
+  os.symlink(link_target, tmp_name)
+  os.replace(tmp_name, link_name)
 
 
 asList = lambda x : x if type(x) == list else [x]
@@ -97,6 +102,20 @@ def resolve_store_path(architecture, spec_hash):
   return "/".join(("TARS", architecture, "store", spec_hash[:2], spec_hash))
 
 
+def tarball_name(spec, architecture):
+  """Return the file name of the tarball of the given package and revision."""
+  return "{package}-{version}-{revision}.{arch}.tar.gz".format(arch=architecture, **spec)
+
+
+def resolve_failure_path(architecture, spec_hash):
+  """Return the path where the failure record for the given hash is stored.
+
+  The returned path is relative to the working directory (normally sw/) or the
+  root of the remote store.
+  """
+  return "/".join(("TARS", architecture, "failures", spec_hash[:2], spec_hash + ".json"))
+
+
 def resolve_links_path(architecture, package):
   """Return the path where symlinks for the given package are to be stored.
 
@@ -487,9 +506,34 @@ def resolveDefaultsFilename(defaults, configDir) -> Optional[str]:
     if os.path.exists(filename):
       return filename
 
+def getAllPackages(configDir, defaults, disable=()):
+  """Return the names of all packages with a recipe in configDir.
+
+  Defaults, system requirements (which are only checked when something needs
+  them), disabled packages and packages that cannot be built with the given
+  defaults are left out. Recipes that cannot be parsed are skipped with a
+  warning.
+  """
+  packages = set()
+  for pkgdir in getPkgDirs(configDir):
+    for filename in sorted(glob(join(pkgdir, "*.sh"))):
+      if basename(filename).startswith("defaults-"):
+        continue
+      err, spec, _ = parseRecipe(getRecipeReader(filename, configDir))
+      if err:
+        warning("Skipping %s: %s", filename, err)
+        continue
+      if spec["package"] in disable or spec.get("system_requirement") or \
+         not validateDefaults(spec, defaults)[0]:
+        continue
+      packages.add(spec["package"])
+  return sorted(packages)
+
+
 def getPackageList(packages, specs, configDir, preferSystem, noSystem,
                    architecture, disable, defaults, performPreferCheck, performRequirementCheck,
-                   performValidateDefaults, overrides, taps: dict, log, force_rebuild=()):
+                   performValidateDefaults, overrides, taps: dict, log, force_rebuild=(),
+                   recipeCache=None):
   systemPackages = set()
   ownPackages = set()
   failedRequirements = set()
@@ -525,7 +569,14 @@ def getPackageList(packages, specs, configDir, preferSystem, noSystem,
     dieOnError(not filename, f"Package {p} not found in {configDir}")
     assert(filename is not None)
 
-    err, spec, recipe = parseRecipe(getRecipeReader(filename, configDir))
+    # RECIPECACHE maps recipe files to what parseRecipe returned for them.
+    recipeKey = os.path.abspath(filename) if os.path.isfile(filename) else None
+    if recipeCache is not None and recipeKey and recipeKey in recipeCache:
+      err, spec, recipe = recipeCache[recipeKey]
+    else:
+      err, spec, recipe = parseRecipe(getRecipeReader(filename, configDir))
+      if recipeCache is not None and recipeKey and not err:
+        recipeCache[recipeKey] = err, spec, recipe
     dieOnError(err, err)
     # Unless there was an error, both spec and recipe should be valid.
     # otherwise the error should have been caught above.
@@ -0,0 +1,185 @@
+"""Watch the sources of development packages for changes, using inotify.
+
+Finding out what changed in a development package runs `git diff HEAD` and
+`git status`, which look at every file in the checkout. `aliBuild server`
+instead watches the checkouts it is asked about, and counts the changes made
+to their files. As long as this count is the same, so are the local changes,
+and the hash calculated from them last time can be used again.
+
+inotify is only available on Linux. Elsewhere, or if a checkout cannot be
+watched (e.g. because it has more directories than fs.inotify.max_user_watches
+allows), nothing is watched and the sources are scanned as usual.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+import threading
+
+from alibuild_helpers.log import debug, warning
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# Reading files, e.g. when git scans the checkout, is not a change.
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event, followed by the name of the file concerned.
+EVENT = struct.Struct("iIII")
+
+# Only the top level of these is watched, where e.g. the index and HEAD are.
+# The commit checked out is part of what the server is asked about anyway.
+SCM_DIRS = (".git", ".sl", ".hg")
+
+
+def _inotify():
+  """Return the C library, if it supports inotify."""
+  if not sys.platform.startswith("linux"):
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+  except OSError:
+    return None
+  return libc if hasattr(libc, "inotify_init1") else None
+
+
+class SourceWatcher:
+  """Count the changes to files in the directory trees it is asked about."""
+
+  def __init__(self) -> None:
+    self.libc = _inotify()
+    self.fd = None
+    self.lock = threading.Lock()
+    # Maps watched directory trees to the number of changes seen in them.
+    self.generations = {}
+    # Maps inotify watch descriptors to their directory tree, their directory
+    # and whether that is the metadata directory of a repository.
+    self.watches = {}
+    # Directory trees we could not watch.
+    self.failed = set()
+
+  def generation(self, directory):
+    """Return a number that changes whenever anything in DIRECTORY does.
+
+    DIRECTORY is watched from the first time it is asked about. Return None if
+    it cannot be watched.
+    """
+    directory = os.path.realpath(directory)
+    with self.lock:
+      if directory in self.generations:
+        return self.generations[directory]
+      if self.libc is None or directory in self.failed or not os.path.isdir(directory) or \
+         not self._start():
+        return None
+      self.generations[directory] = 0
+      try:
+        self._watch_tree(directory, directory)
+      except OSError as exc:
+        warning("Cannot watch %s for changes, scanning it every time instead: %s",
+                directory, exc)
+        self._forget(directory)
+        return None
+      debug("Watching %s for changes", directory)
+      return 0
+
+  def _start(self):
+    if self.fd is not None:
+      return True
+    fd = self.libc.inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+      warning("Cannot watch sources for changes: %s", os.strerror(ctypes.get_errno()))
+      self.libc = None
+      return False
+    self.fd = fd
+    threading.Thread(target=self._read_events, daemon=True).start()
+    return True
+
+  def _add_watch(self, root, path, scm_dir=False) -> None:
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      if err == errno.ENOENT:   # deleted meanwhile
+        return
+      raise OSError(err, os.strerror(err), path)
+    self.watches[wd] = root, path, scm_dir
+
+  def _watch_tree(self, root, top) -> None:
+    for path, dirnames, filenames in os.walk(top):
+      self._add_watch(root, path)
+      for name in [name for name in dirnames if name in SCM_DIRS]:
+        dirnames.remove(name)
+        self._add_watch(root, os.path.join(path, name), scm_dir=True)
+      # In git worktrees and submodules, .git is a file pointing to the
+      # repository's real directory.
+      if ".git" in filenames:
+        with open(os.path.join(path, ".git")) as f:
+          gitdir = f.read().strip()
+        if gitdir.startswith("gitdir: "):
+          self._add_watch(root, os.path.join(path, gitdir[len("gitdir: "):]), scm_dir=True)
+
+  def _forget(self, root) -> None:
+    """Stop watching ROOT, and never watch it again."""
+    for wd, (watched_root, _, _) in list(self.watches.items()):
+      if watched_root == root:
+        self.libc.inotify_rm_watch(self.fd, wd)
+        del self.watches[wd]
+    self.generations.pop(root, None)
+    self.failed.add(root)
+
+  def _read_events(self) -> None:
+    while True:
+      try:
+        data = os.read(self.fd, 64 * 1024)
+      except InterruptedError:
+        continue
+      with self.lock:
+        offset = 0
+        while offset < len(data):
+          wd, mask, _, length = EVENT.unpack_from(data, offset)
+          name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+          offset += EVENT.size + length
+          self._handle_event(wd, mask, os.fsdecode(name))
+
+  def _handle_event(self, wd, mask, name) -> None:
+    if mask & IN_Q_OVERFLOW:
+      # We missed some events, so anything might have changed.
+      for root in self.generations:
+        self.generations[root] += 1
+      return
+    if wd not in self.watches:
+      return
+    root, path, scm_dir = self.watches[wd]
+    if mask & IN_IGNORED:
+      del self.watches[wd]
+      return
+    # Git takes a lock on the index even when only reading the checkout.
+    if scm_dir and name.endswith(".lock"):
+      return
+    if root not in self.generations:
+      return
+    self.generations[root] += 1
+    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not scm_dir:
+      try:
+        if name in SCM_DIRS:
+          self._add_watch(root, os.path.join(path, name), scm_dir=True)
+        else:
+          self._watch_tree(root, os.path.join(path, name))
+      except OSError as exc:
+        warning("Stopped watching %s for changes: %s", root, exc)
+        self._forget(root)
@@ -12,13 +12,14 @@ import re
 import unittest
 import shlex
 
-BUILD_MISSING_PKG_ERROR = "the following arguments are required: PACKAGE"
+BUILD_MISSING_PKG_ERROR = "Please specify at least one PACKAGE to build, or --all"
 ANALYTICS_MISSING_STATE_ERROR = "the following arguments are required: state"
 
 # A few errors we should handle, together with the expected result
 ARCHITECTURE_ERROR = "Unknown / unsupported architecture: foo.\n\n.*"
 PARSER_ERRORS = {
   "build --force-unknown-architecture": BUILD_MISSING_PKG_ERROR,
+  "prefetch --force-unknown-architecture": BUILD_MISSING_PKG_ERROR,
   "build --force-unknown-architecture zlib --foo": 'unrecognized arguments: --foo',
   "init --docker-image": 'unrecognized arguments: --docker-image',
   "builda --force-unknown-architecture zlib" : "argument action: invalid choice: 'builda'.*",
@@ -27,6 +28,8 @@ PARSER_ERRORS = {
   "build --force-unknown-architecture zlib --remote-store rsync://test1.local/::rw --write-store rsync://test2.local/::rw ": 'cannot specify ::rw and --write-store at the same time',
   "build zlib -a osx_x86-64 --docker-image foo": 'cannot use `-a osx_x86-64` and --docker',
   "build zlib -a slc7_x86-64 --annotate foobar": "--annotate takes arguments of the form PACKAGE=COMMENT",
+  "build zlib -a slc7_x86-64 --shard 3/2 --write-store rsync://test.local/": "--shard takes arguments of the form I/N, with 1 <= I <= N",
+  "build zlib -a slc7_x86-64 --shard 1/2": "--shard needs a --write-store shared by all runners",
   "analytics": ANALYTICS_MISSING_STATE_ERROR
 }
 
@@ -43,6 +46,10 @@ CORRECT_BEHAVIOR = [
   ((), "version"                                                                       , [("action", "version")]),
   ((), "clean"                                                                         , [("action", "clean"), ("workDir", "sw")]),
   ((), "build --force-unknown-architecture -j 10 zlib"                                 , [("action", "build"), ("jobs", 10), ("pkgname", ["zlib"])]),
+  ((), "build --force-unknown-architecture --all"                                      , [("action", "build"), ("allPackages", True), ("pkgname", [])]),
+  ((), "prefetch zlib -a slc7_x86-64 --defaults o2"                                   , [("action", "prefetch"), ("pkgname", ["zlib"]), ("defaults", "o2"), ("referenceSources", "sw/MIRROR"), ("remoteStore", "https://s3.cern.ch/swift/v1/alibuild-repo")]),
+  ((), "explain zlib -a slc7_x86-64 --defaults o2"                                    , [("action", "explain"), ("pkgname", ["zlib"]), ("defaults", "o2"), ("referenceSources", "sw/MIRROR")]),
+  ((), "build zlib -a slc7_x86-64 --shard 2/3 --remote-store rsync://test.local/::rw" , [("shard", (2, 3)), ("shardTimeout", 120)]),
   ((), "build --force-unknown-architecture -j 10 zlib --disable gcc --disable foo"     , [("disable", ["gcc", "foo"])]),
   ((), "build --force-unknown-architecture -j 10 zlib --disable gcc --disable foo,bar" , [("disable", ["gcc", "foo", "bar"])]),
   ((), "init zlib --dist master"                                                       , [("dist", {"repo": "alisw/alidist", "ver": "master"})]),
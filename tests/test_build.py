@@ -3,15 +3,19 @@ import os
 import os.path
 import platform
 import re
+import subprocess
 import sys
+import tempfile
 import unittest
 # Assuming you are using the mock library to ... mock things
 from unittest.mock import call, patch, MagicMock, DEFAULT
 from io import StringIO
 from collections import OrderedDict
 
-from alibuild_helpers.utilities import parseRecipe, resolve_tag
-from alibuild_helpers.build import doBuild, storeHashes, generate_initdotsh
+from alibuild_helpers.utilities import parseRecipe, resolve_tag, Hasher
+from alibuild_helpers.build import doBuild, storeHashes, generate_initdotsh, build_requires_to_skip, can_upload, build_estimate
+from alibuild_helpers.build import hash_local_changes, hash_untracked_files
+from alibuild_helpers.git import Git
 
 # Determine architecture based on platform
 def get_test_architecture():
@@ -209,52 +213,70 @@ def dummy_exists(x):
     }.get(path_str, DEFAULT)
 
 
-# A few errors we should handle, together with the expected result
-@patch("alibuild_helpers.git.clone_speedup_options",
-       new=MagicMock(return_value=["--filter=blob:none"]))
-@patch("alibuild_helpers.build.BASH", new="/bin/bash")
-class BuildTestCase(unittest.TestCase):
-    @patch("alibuild_helpers.analytics", new=MagicMock())
-    @patch("requests.Session.get", new=MagicMock())
-    @patch("alibuild_helpers.sync.execute", new=dummy_execute)
-    @patch("alibuild_helpers.git.git")
-    @patch("alibuild_helpers.build.exists", new=MagicMock(side_effect=dummy_exists))
-    @patch("os.path.exists", new=MagicMock(side_effect=dummy_exists))
-    @patch("alibuild_helpers.build.dieOnError", new=MagicMock())
-    @patch("alibuild_helpers.utilities.dieOnError", new=MagicMock())
-    @patch("alibuild_helpers.utilities.warning")
-    @patch("alibuild_helpers.build.readDefaults",
-           new=MagicMock(return_value=(OrderedDict({"package": "defaults-release", "disable": []}), "")))
-    @patch("shutil.rmtree", new=MagicMock(return_value=None))
-    @patch("os.makedirs", new=MagicMock(return_value=None))
-    @patch("alibuild_helpers.build.makedirs", new=MagicMock(return_value=None))
-    @patch("alibuild_helpers.build.symlink", new=MagicMock(return_value=None))
-    @patch("alibuild_helpers.workarea.symlink", new=MagicMock(return_value=None))
-    @patch("alibuild_helpers.utilities.open", new=lambda x: {
+# Let doBuild run without touching /sw, the network or the real recipes.
+# Tests using them get the mocks for debug, os.listdir, utilities.warning
+# and git.git as arguments, in this order.
+DO_BUILD_PATCHES = [
+    patch("alibuild_helpers.analytics", new=MagicMock()),
+    patch("requests.Session.get", new=MagicMock()),
+    patch("alibuild_helpers.sync.execute", new=dummy_execute),
+    patch("alibuild_helpers.git.git"),
+    patch("alibuild_helpers.build.exists", new=MagicMock(side_effect=dummy_exists)),
+    patch("os.path.exists", new=MagicMock(side_effect=dummy_exists)),
+    patch("alibuild_helpers.build.dieOnError", new=MagicMock()),
+    patch("alibuild_helpers.utilities.dieOnError", new=MagicMock()),
+    patch("alibuild_helpers.utilities.warning"),
+    patch("alibuild_helpers.build.readDefaults",
+          new=MagicMock(return_value=(OrderedDict({"package": "defaults-release", "disable": []}), ""))),
+    patch("shutil.rmtree", new=MagicMock(return_value=None)),
+    patch("os.makedirs", new=MagicMock(return_value=None)),
+    patch("alibuild_helpers.build.makedirs", new=MagicMock(return_value=None)),
+    patch("alibuild_helpers.build.symlink", new=MagicMock(return_value=None)),
+    patch("alibuild_helpers.workarea.symlink", new=MagicMock(return_value=None)),
+    patch("alibuild_helpers.utilities.open", new=lambda x: {
         "/alidist/root.sh": StringIO(TEST_ROOT_RECIPE),
         "/alidist/zlib.sh": StringIO(TEST_ZLIB_RECIPE),
         "/alidist/defaults-release.sh": StringIO(TEST_DEFAULT_RELEASE)
-    }[x])
-    @patch("alibuild_helpers.sync.open", new=MagicMock(side_effect=dummy_open))
-    @patch("alibuild_helpers.build.open", new=MagicMock(side_effect=dummy_open))
-    @patch("codecs.open", new=MagicMock(side_effect=dummy_open))
-    @patch("alibuild_helpers.build.shutil", new=MagicMock())
-    @patch("os.listdir")
-    @patch("alibuild_helpers.build.glob", new=lambda pattern: {
+    }[x]),
+    patch("alibuild_helpers.sync.open", new=MagicMock(side_effect=dummy_open)),
+    patch("alibuild_helpers.build.open", new=MagicMock(side_effect=dummy_open)),
+    patch("codecs.open", new=MagicMock(side_effect=dummy_open)),
+    patch("alibuild_helpers.build.shutil", new=MagicMock()),
+    patch("os.listdir"),
+    patch("alibuild_helpers.build.glob", new=lambda pattern: {
         "*": ["zlib"],
         f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_DEFAULT_RELEASE_BUILD_HASH[:2]}/{TEST_DEFAULT_RELEASE_BUILD_HASH}/*gz": [],
         f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_ZLIB_BUILD_HASH[:2]}/{TEST_ZLIB_BUILD_HASH}/*gz": [],
         f"/sw/TARS/{TEST_ARCHITECTURE}/store/{TEST_ROOT_BUILD_HASH[:2]}/{TEST_ROOT_BUILD_HASH}/*gz": [],
         f"/sw/TARS/{TEST_ARCHITECTURE}/defaults-release/defaults-release-v1-1.{TEST_ARCHITECTURE}.tar.gz":
         [f"../../{TEST_ARCHITECTURE}/store/{TEST_DEFAULT_RELEASE_BUILD_HASH[:2]}/{TEST_DEFAULT_RELEASE_BUILD_HASH}/defaults-release-v1-1.{TEST_ARCHITECTURE}.tar.gz"],
-    }[pattern])
-    @patch("alibuild_helpers.build.readlink", new=dummy_readlink)
-    @patch("alibuild_helpers.build.banner", new=MagicMock(return_value=None))
-    @patch("alibuild_helpers.build.debug")
-    @patch("alibuild_helpers.workarea.is_writeable", new=MagicMock(return_value=True))
-    @patch("alibuild_helpers.build.basename", new=MagicMock(return_value="aliBuild"))
-    @patch("alibuild_helpers.build.install_wrapper_script", new=MagicMock())
-    def test_coverDoBuild(self, mock_debug, mock_listdir, mock_warning, mock_git_git) -> None:
+    }[pattern]),
+    patch("alibuild_helpers.build.readlink", new=dummy_readlink),
+    patch("alibuild_helpers.build.banner", new=MagicMock(return_value=None)),
+    patch("alibuild_helpers.build.debug"),
+    patch("alibuild_helpers.workarea.is_writeable", new=MagicMock(return_value=True)),
+    patch("alibuild_helpers.build.basename", new=MagicMock(return_value="aliBuild")),
+    patch("alibuild_helpers.build.install_wrapper_script", new=MagicMock()),
+    patch("alibuild_helpers.build.PackageClaims", new=MagicMock()),
+    patch("alibuild_helpers.build.RevisionReservations", new=MagicMock()),
+]
+
+
+def with_do_build_patches(test):
+    for patcher in reversed(DO_BUILD_PATCHES):
+        test = patcher(test)
+    return test
+
+
+# A few errors we should handle, together with the expected result
+@patch("alibuild_helpers.git.clone_speedup_options",
+       new=MagicMock(return_value=["--filter=blob:none"]))
+@patch("alibuild_helpers.build.BASH", new="/bin/bash")
+class BuildTestCase(unittest.TestCase):
+    def setup_do_build(self, mock_debug, mock_listdir, mock_warning, mock_git_git, **kwds):
+        """Set up the mocks from DO_BUILD_PATCHES, and return the arguments to build ROOT."""
+        # Nothing is installed yet.
+        TIMES_ASKED.clear()
         mock_git_git.side_effect = dummy_git
         mock_debug.side_effect = lambda *args: None
         mock_warning.side_effect = lambda *args: None
@@ -264,8 +286,6 @@ class BuildTestCase(unittest.TestCase):
             f"/sw/TARS/{TEST_ARCHITECTURE}/ROOT": [],
         }.get(directory, DEFAULT)
         os.environ["ALIBUILD_NO_ANALYTICS"] = "1"
-
-        mock_parser = MagicMock()
         args = Namespace(
             remoteStore="",
             writeStore="",
@@ -295,6 +315,13 @@ class BuildTestCase(unittest.TestCase):
             forceTracked=False,
             plugin="legacy"
         )
+        vars(args).update(kwds)
+        return args
+
+    @with_do_build_patches
+    def test_coverDoBuild(self, mock_debug, mock_listdir, mock_warning, mock_git_git) -> None:
+        args = self.setup_do_build(mock_debug, mock_listdir, mock_warning, mock_git_git)
+        mock_parser = MagicMock()
 
         def mkcall(args):
             cmd, directory, check = args
@@ -343,6 +370,39 @@ class BuildTestCase(unittest.TestCase):
         ], any_order=True)
         self.assertEqual(mock_git_git.call_count, len(common_calls) + 1)
 
+    @with_do_build_patches
+    def test_ninja_plugin(self, mock_debug, mock_listdir, mock_warning, mock_git_git) -> None:
+        """Check that --plugin ninja writes build.ninja, running every build script."""
+        args = self.setup_do_build(mock_debug, mock_listdir, mock_warning, mock_git_git,
+                                   plugin="ninja", builders=2)
+        ninja = StringIO()
+        ninja.close = lambda: None
+        with patch("alibuild_helpers.ninja_plugin.open",
+                   new=MagicMock(return_value=MagicMock(__enter__=lambda _: ninja))) as mock_open, \
+             patch("alibuild_helpers.ninja_plugin.banner"):
+            doBuild(args, MagicMock())
+        mock_open.assert_called_once_with("/sw/build.ninja", "w")
+        self.assertIn(f"/sw/SPECS/{TEST_ARCHITECTURE}/ROOT/", ninja.getvalue())
+        self.assertIn(f"/sw/SPECS/{TEST_ARCHITECTURE}/zlib/", ninja.getvalue())
+
+    @with_do_build_patches
+    def test_saved_plan_kept(self, mock_debug, mock_listdir, mock_warning, mock_git_git) -> None:
+        """Check that a plan read from disk is not saved again over its progress."""
+        args = self.setup_do_build(mock_debug, mock_listdir, mock_warning, mock_git_git)
+        with patch("alibuild_helpers.build.write_plan") as mock_write_plan:
+            doBuild(args, MagicMock())
+        mock_write_plan.assert_called_once()
+        (_, _, build_order, specs, finished, system_packages, own_packages,
+         untracked_directories, devel_branch), _ = mock_write_plan.call_args
+        plan = {"build_order": build_order, "specs": specs, "finished": finished,
+                "system_packages": system_packages, "own_packages": own_packages,
+                "untracked_directories": untracked_directories, "devel_branch": devel_branch}
+        args.resume = True
+        with patch("alibuild_helpers.build.read_plan", return_value=plan), \
+             patch("alibuild_helpers.build.write_plan") as mock_write_plan:
+            doBuild(args, MagicMock())
+        mock_write_plan.assert_not_called()
+
     def setup_spec(self, script):
         """Parse the alidist recipe in SCRIPT and return its spec."""
         err, spec, recipe = parseRecipe(lambda: script)
@@ -437,6 +497,66 @@ class BuildTestCase(unittest.TestCase):
         self.assertIn("export APPEND_ROOT_1=", complete_initdotsh)
         self.assertIn("export PREPEND_ROOT_1=", complete_initdotsh)
 
+        # Skipped dependencies are not loaded.
+        skip_initdotsh = generate_initdotsh("ROOT", specs, "slc7_x86-64", post_build=True, skip={"zlib"})
+        self.assertNotIn("/zlib/", skip_initdotsh)
+
+    def test_build_requires_to_skip(self) -> None:
+        def spec(runtime=(), build=()):
+            return {"runtime_requires": list(runtime), "requires": list(runtime) + list(build)}
+        specs = {
+            "CMake": spec(),
+            "protobuf-compiler": spec(build=["CMake"]),
+            "zlib": spec(build=["CMake"]),
+            "ROOT": spec(runtime=["zlib"], build=["CMake"]),
+            "O2": spec(runtime=["ROOT"], build=["CMake", "protobuf-compiler"]),
+        }
+        buildOrder = ["CMake", "protobuf-compiler", "zlib", "ROOT", "O2"]
+        # Nothing is skipped if everything has to be built.
+        self.assertEqual(build_requires_to_skip(buildOrder, specs, ["O2"], set()), set())
+        # ROOT still has to be built, so it needs CMake, but nothing needs
+        # protobuf-compiler any more.
+        self.assertEqual(build_requires_to_skip(buildOrder, specs, ["O2"], {"O2", "zlib"}),
+                         {"protobuf-compiler"})
+        self.assertEqual(build_requires_to_skip(buildOrder, specs, ["O2"], {"O2", "ROOT", "zlib"}),
+                         {"CMake", "protobuf-compiler"})
+        # Packages we were asked to build are always installed.
+        self.assertEqual(build_requires_to_skip(buildOrder, specs, ["O2", "CMake"], {"O2", "ROOT", "zlib"}),
+                         {"protobuf-compiler"})
+
+    def test_can_upload(self) -> None:
+        specs = {
+            "zlib": {"is_devel_pkg": False, "full_requires": set()},
+            "O2": {"is_devel_pkg": True, "full_requires": {"zlib"}},
+            "QualityControl": {"is_devel_pkg": False, "full_requires": {"O2", "zlib"}},
+            "GEANT4": {"is_devel_pkg": False, "full_requires": {"zlib"}},
+        }
+        store = MagicMock(writeStore="b3://alibuild-repo")
+        # Only packages not built from development packages are shared.
+        self.assertEqual([p for p in specs if can_upload(specs[p], specs, store)],
+                         ["zlib", "GEANT4"])
+        self.assertFalse(can_upload(specs["zlib"], specs, MagicMock(writeStore="")))
+
+    def test_build_estimate(self) -> None:
+        buildOrder = ["zlib", "CMake", "GEANT4", "ROOT", "O2"]
+        specs = {p: {"version": "v1"} for p in buildOrder}
+        actions = {"zlib": "installed", "CMake": "unpack", "GEANT4": "download",
+                   "ROOT": "download", "O2": "compile"}
+        report = build_estimate(buildOrder, specs, actions,
+                                {"GEANT4": 3 * 1024**3, "ROOT": None},
+                                {"O2": 3900}, recorded=set())
+        lines = [line.split() for line in report.splitlines()]
+        self.assertEqual(lines[:5], [
+            ["zlib@v1", "installed"],
+            ["CMake@v1", "unpack"],
+            ["GEANT4@v1", "download", "3.0", "GiB"],
+            ["ROOT@v1", "download", "unknown", "size"],
+            ["O2@v1", "compile", "~1h05m", "(guess)"],
+        ])
+        self.assertEqual(report.splitlines()[-1],
+                         "Total: 2 to download (3.0 GiB and 1 of unknown size), "
+                         "1 to compile (~1h05m).")
+
     def test_build_template_percent_format(self) -> None:
         """build_template.sh is interpolated via printf-style % formatting in
         doBuild(), so every literal '%' in it must be doubled. A stray '%'
@@ -505,5 +625,95 @@ class AlidistHashFallbackTestCase(unittest.TestCase):
             self._run_reaching_scm_block()
 
 
+class SeveralDefaultsTestCase(unittest.TestCase):
+    """With comma-separated defaults, doBuild builds for each of them in turn."""
+
+    def run_build(self, keep_going, side_effect=None):
+        args = Namespace(defaults="o2,o2-epn", pkgname=["O2"], disable=["GEANT4"],
+                         keepGoing=keep_going)
+        with patch("alibuild_helpers.build.doBuild", side_effect=side_effect) as mock_build, \
+             patch("alibuild_helpers.build.banner"):
+            try:
+                doBuild(args, MagicMock())
+            finally:
+                self.variants = [c.args[0] for c in mock_build.call_args_list]
+                self.caches = [c.args[2] for c in mock_build.call_args_list]
+
+    def test_each_defaults(self) -> None:
+        self.run_build(keep_going=False)
+        self.assertEqual([v.defaults for v in self.variants], ["o2", "o2-epn"])
+        # Resolving packages extends the list of disabled packages, so every
+        # variant needs its own.
+        self.assertIsNot(self.variants[0].disable, self.variants[1].disable)
+        self.assertEqual(self.variants[1].disable, ["GEANT4"])
+        # System checks and repository updates are shared.
+        self.assertIs(self.caches[0], self.caches[1])
+
+    def test_failure_stops(self) -> None:
+        with self.assertRaises(SystemExit):
+            self.run_build(keep_going=False, side_effect=SystemExit(1))
+        self.assertEqual(len(self.variants), 1)
+
+    def test_keep_going(self) -> None:
+        with self.assertRaises(SystemExit):
+            self.run_build(keep_going=True, side_effect=[SystemExit(1), None])
+        self.assertEqual([v.defaults for v in self.variants], ["o2", "o2-epn"])
+
+
+
+class HashLocalChangesTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = self.tmp.name
+        for args in (["init", "-q"], ["-c", "user.name=test", "-c", "user.email=test@test",
+                                      "commit", "-q", "--allow-empty", "-m", "init"]):
+            subprocess.check_call(["git"] + args, cwd=self.repo)
+        self.write(".git/info/exclude", "*.o\n")
+        self.spec = {"source": self.repo, "scm": Git()}
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def write(self, path, contents) -> None:
+        os.makedirs(os.path.dirname(os.path.join(self.repo, path)), exist_ok=True)
+        with open(os.path.join(self.repo, path), "w") as f:
+            f.write(contents)
+
+    @patch("alibuild_helpers.build.warning", new=MagicMock())
+    def test_untracked_contents(self) -> None:
+        self.write("src/new.cxx", "int main() {}\n")
+        first, untracked = hash_local_changes(self.spec)
+        self.assertEqual(untracked, [])
+        self.assertEqual(hash_local_changes(self.spec), (first, []))
+        # Ignored files do not count.
+        self.write("src/new.o", "\x7fELF")
+        self.assertEqual(hash_local_changes(self.spec), (first, []))
+        self.write("src/new.cxx", "int main() { return 1; }\n")
+        second, _ = hash_local_changes(self.spec)
+        self.assertNotEqual(second, first)
+        os.chmod(os.path.join(self.repo, "src", "new.cxx"), 0o755)
+        self.assertNotEqual(hash_local_changes(self.spec)[0], second)
+
+    def test_blob_hashes(self) -> None:
+        self.write("README", "hello\n")
+        blob = subprocess.check_output(["git", "hash-object", "README"], cwd=self.repo,
+                                       universal_newlines=True).strip()
+        expected = Hasher()
+        expected("100644 blob %s\tREADME\n" % blob)
+        self.assertEqual(hash_untracked_files(Git(), self.repo), expected.hexdigest())
+
+    @patch("alibuild_helpers.build.warning")
+    def test_fallback(self, mock_warning) -> None:
+        self.write("src/new.cxx", "int main() {}\n")
+        self.assertEqual(hash_local_changes(self.spec, hash_untracked=False)[1], [self.repo])
+        self.assertEqual(mock_warning.call_count, 1)
+        # Nested repositories cannot be hashed by contents.
+        subprocess.check_call(["git", "init", "-q", "nested"], cwd=self.repo)
+        self.write("nested/file", "x")
+        self.assertEqual(hash_local_changes(self.spec)[1], [self.repo])
+        self.assertEqual(mock_warning.call_count, 2)
+
+
+
 if __name__ == '__main__':
     unittest.main()
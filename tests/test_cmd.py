@@ -1,11 +1,27 @@
 # Assuming you are using the mock library to ... mock things
 from unittest import mock
 
-from alibuild_helpers.cmd import execute, DockerRunner, AppleContainerRunner
+from alibuild_helpers.cmd import execute, Supervisor, DockerRunner, AppleContainerRunner
+
+import io
+import os
+import tempfile
+import time
 
 import unittest
 
 
+def process_running(pid):
+    """Check if PID is running, and not just waiting to be reaped."""
+    if not os.path.isdir("/proc/self"):   # e.g. on macOS
+        return os.system("ps -o stat= -p %d | grep -qv Z" % pid) == 0
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rpartition(")")[2].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
 @mock.patch("alibuild_helpers.cmd.BASH", new="/bin/bash")
 class CmdTestCase(unittest.TestCase):
     @mock.patch("alibuild_helpers.cmd.debug")
@@ -18,6 +34,57 @@ class CmdTestCase(unittest.TestCase):
         self.assertEqual(err, 127)
         self.assertEqual(mock_debug.mock_calls, [])
 
+    def test_execute_usage(self):
+        usage = {}
+        err = execute("python3 -c 'x = bytearray(64 * 1024 * 1024)'; exit 3",
+                      lambda *args: None, usage=usage)
+        self.assertEqual(err, 3)
+        self.assertGreater(usage["max_rss"], 64 * 1024 * 1024)
+        self.assertGreaterEqual(usage["cpu_time"], 0)
+
+    def test_execute_timeout(self):
+        # The deadline applies even if the command prints nothing.
+        lines = []
+        start = time.monotonic()
+        err = execute("echo start; exec sleep 30", lambda fmt, line: lines.append(line), timeout=0.5)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(err, -15)
+        self.assertEqual(lines, ["start"])
+
+    def test_execute_idle_timeout(self):
+        # Printing something regularly keeps the command alive.
+        err = execute("for i in 1 2 3 4; do echo $i; sleep 0.3; done",
+                      lambda *args: None, idle_timeout=1, new_group=True)
+        self.assertEqual(err, 0)
+        # Processes started by the command are stopped along with it.
+        with tempfile.TemporaryDirectory() as tmp:
+            pidfile = os.path.join(tmp, "pid")
+            start = time.monotonic()
+            err = execute("sleep 30 & echo $! > %s; echo start; sleep 30" % pidfile,
+                          lambda *args: None, idle_timeout=0.5, new_group=True)
+            self.assertLess(time.monotonic() - start, 10)
+            self.assertEqual(err, -15)
+            with open(pidfile) as f:
+                pid = int(f.read())
+            time.sleep(0.1)
+            self.assertFalse(process_running(pid))
+
+    def test_supervisor(self):
+        supervisor = Supervisor()
+        output = {"a": [], "b": []}
+        log = io.BytesIO()
+        a = supervisor.start("sleep 0.5; echo a1; printf a2", lambda fmt, line: output["a"].append(line),
+                             log=log)
+        b = supervisor.start("echo b1; exit 2", lambda fmt, line: output["b"].append(line))
+        # b finishes first, even though a started first and prints nothing yet.
+        self.assertEqual(supervisor.poll(), [b])
+        self.assertEqual(b.returncode, 2)
+        self.assertEqual(supervisor.running, [a])
+        supervisor.run()
+        self.assertEqual(a.returncode, 0)
+        self.assertEqual(output, {"a": ["a1", "a2"], "b": ["b1"]})
+        self.assertEqual(log.getvalue(), b"a1\na2")
+
     @mock.patch("alibuild_helpers.cmd.getoutput")
     @mock.patch("alibuild_helpers.cmd.getstatusoutput")
     def test_DockerRunner(self, mock_getstatusoutput, mock_getoutput):
@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from alibuild_helpers.build import storeHashes
+from alibuild_helpers.explain import changed_inputs, explain_rebuilds
+
+
+def zlib_spec(recipe="./configure\nmake install\n"):
+  return OrderedDict([
+    ("package", "zlib"), ("version", "v1.2.3"), ("recipe", recipe),
+    ("commit_hash", "a" * 40), ("tag", "v1.2.3"), ("requires", ["GCC"]),
+    ("is_devel_pkg", False),
+  ])
+
+
+def hashed(spec, gcc_hash="1" * 40):
+  storeHashes("zlib", {"zlib": spec, "GCC": {"hash": gcc_hash}}, considerRelocation=False)
+  spec["hash"] = spec["remote_revision_hash"]
+  return spec
+
+
+class ExplainTestCase(unittest.TestCase):
+  def test_changed_inputs(self):
+    old = hashed(zlib_spec())["hash_manifest"]
+    self.assertEqual(changed_inputs(old, hashed(zlib_spec())["hash_manifest"]), [])
+    self.assertEqual(changed_inputs(old, hashed(zlib_spec(), gcc_hash="2" * 40)["hash_manifest"]),
+                     ["dependency GCC changed from %s to %s" % ("1" * 40, "2" * 40)])
+    spec = zlib_spec()
+    spec["env"] = OrderedDict([("ZLIB_ROOT", "/sw")])
+    self.assertEqual(changed_inputs(old, hashed(spec)["hash_manifest"]),
+                     ["env changed from none to OrderedDict([('ZLIB_ROOT', '/sw')])"])
+    self.assertEqual(
+      changed_inputs(old, hashed(zlib_spec("./configure\nmake -j install\n"))["hash_manifest"]),
+      ["recipe changed:\n"
+       "    --- installed\n"
+       "    +++ current\n"
+       "    @@ -1,2 +1,2 @@\n"
+       "     ./configure\n"
+       "    -make install\n"
+       "    +make -j install"])
+
+  def test_explain_rebuilds(self):
+    with tempfile.TemporaryDirectory() as work_dir:
+      installed = hashed(zlib_spec())
+      install_dir = os.path.join(work_dir, "slc7_x86-64", "zlib", "v1.2.3-1")
+      os.makedirs(install_dir)
+      os.symlink("v1.2.3-1", os.path.join(work_dir, "slc7_x86-64", "zlib", "latest"))
+      with open(os.path.join(install_dir, ".build-hash"), "w") as f:
+        f.write(installed["hash"])
+      specs = {"zlib": hashed(zlib_spec())}
+      self.assertEqual(explain_rebuilds(specs, ["zlib"], work_dir, "slc7_x86-64"), "")
+      specs = {"zlib": hashed(zlib_spec(), gcc_hash="2" * 40)}
+      self.assertEqual(explain_rebuilds(specs, ["zlib"], work_dir, "slc7_x86-64"),
+                       "  - zlib@v1.2.3: the installed revision does not record what "
+                       "its hash was calculated from")
+      with open(os.path.join(install_dir, ".meta.json"), "w") as f:
+        json.dump({"hash_inputs": installed["hash_manifest"]}, f)
+      self.assertEqual(explain_rebuilds(specs, ["zlib"], work_dir, "slc7_x86-64"),
+                       "  - zlib@v1.2.3: dependency GCC changed from %s to %s"
+                       % ("1" * 40, "2" * 40))
+      self.assertEqual(explain_rebuilds(specs, ["zlib"], os.path.join(work_dir, "missing"),
+                                        "slc7_x86-64"),
+                       "  - zlib@v1.2.3: not installed yet")
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from alibuild_helpers.failures import log_tail, read_failure, record_failure, forget_failure
+from alibuild_helpers.failures import known_failure_message, record_success, is_recipe_failure
+from alibuild_helpers.utilities import resolve_failure_path
+
+
+SPEC = {"package": "ROOT", "version": "v6-32", "hash": "0123456789abcdef"}
+
+
+class FailuresTestCase(unittest.TestCase):
+  def test_log_tail(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      log = os.path.join(tmp, "log")
+      with open(log, "w") as f:
+        f.write("".join("line %d\n" % i for i in range(1000)))
+      self.assertEqual(log_tail(log, 3), "line 997\nline 998\nline 999")
+      self.assertEqual(log_tail(os.path.join(tmp, "missing")), "")
+
+  def test_record_failure(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      log = os.path.join(tmp, "log")
+      with open(log, "w") as f:
+        f.write("compiling...\nerror: no such file\n")
+      path = os.path.join(tmp, resolve_failure_path("slc7_x86-64", SPEC["hash"]))
+      self.assertEqual(path, os.path.join(tmp, "TARS/slc7_x86-64/failures/01/0123456789abcdef.json"))
+      self.assertIsNone(read_failure(path))
+      record_failure(path, SPEC, log)
+      record = read_failure(path)
+      self.assertEqual((record["package"], record["version"], record["hash"]),
+                       ("ROOT", "v6-32", SPEC["hash"]))
+      self.assertEqual(record["log"], "compiling...\nerror: no such file")
+      message = known_failure_message(SPEC, record)
+      self.assertIn("error: no such file", message)
+      self.assertIn("--retry-failed", message)
+      forget_failure(path)
+      self.assertIsNone(read_failure(path))
+      # Forgetting a failure that was never recorded is fine.
+      forget_failure(path)
+
+  def test_record_success(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, resolve_failure_path("slc7_x86-64", SPEC["hash"]))
+      record_failure(path, SPEC, os.path.join(tmp, "log"))
+      self.assertIsNotNone(read_failure(path))
+      record_success(path, SPEC)
+      self.assertIsNone(read_failure(path))
+
+  def test_is_recipe_failure(self):
+    self.assertTrue(is_recipe_failure(1))
+    self.assertTrue(is_recipe_failure(2))
+    self.assertFalse(is_recipe_failure(0))
+    # Killed by a timeout, directly or through the shell.
+    self.assertFalse(is_recipe_failure(-15))
+    self.assertFalse(is_recipe_failure(137))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,11 +1,14 @@
 import codecs
 import os.path
 import re
+import tempfile
 import unittest
 
 from collections import OrderedDict
 
 from alibuild_helpers.build import storeHashes
+from alibuild_helpers.hashcache import HashCache
+from alibuild_helpers.utilities import Hasher
 
 LOGFILE = "build.log"
 SPEC_RE = re.compile(r"spec = (OrderedDict\(\[\('package', '([^']+)'.*\)\]\))")
@@ -63,5 +66,75 @@ class KnownGoodHashesTestCase(unittest.TestCase):
                 continue
 
 
+def zlib_spec():
+    return OrderedDict([
+        ("package", "zlib"), ("version", "v1.2.3"), ("recipe", "make install"),
+        ("commit_hash", "v1.2.3"), ("tag", "v1.2.3"), ("requires", ["GCC"]),
+        ("env", OrderedDict([("ZLIB_ROOT", "/sw")])), ("is_devel_pkg", False),
+        ("scm_refs", {"refs/tags/v1.2.3": "a" * 40, "refs/tags/zlib-1.2.3": "a" * 40}),
+    ])
+
+
+class HashCacheTestCase(unittest.TestCase):
+    """Make sure hashes taken from a HashCache are the ones storeHashes calculates."""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "SPECS", "package-hashes.json")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def store(self, spec, gcc_hash="1" * 40):
+        specs = {"zlib": spec, "GCC": {"hash": gcc_hash}}
+        cache = HashCache(self.path)
+        storeHashes("zlib", specs, considerRelocation=False, cache=cache)
+        cache.save()
+        return cache
+
+    def test_reuse(self) -> None:
+        expected = zlib_spec()
+        storeHashes("zlib", {"zlib": expected, "GCC": {"hash": "1" * 40}},
+                    considerRelocation=False)
+        self.store(zlib_spec())
+        spec = zlib_spec()
+        cache = self.store(spec)
+        self.assertEqual(cache.changed, [])
+        for key in ("remote_revision_hash", "remote_hashes", "local_revision_hash",
+                    "local_hashes", "deps_hash"):
+            self.assertEqual(spec[key], expected[key])
+
+    def test_manifest(self) -> None:
+        spec = zlib_spec()
+        storeHashes("zlib", {"zlib": spec, "GCC": {"hash": "1" * 40}},
+                    considerRelocation=False)
+        # The manifest lists exactly what the primary hashes were calculated from.
+        for key, extra in (("remote_revision_hash", ""), ("local_revision_hash", "local")):
+            h = Hasher()
+            for _, data in spec["hash_manifest"]["hash"]:
+                h(data)
+            h(extra)
+            self.assertEqual(h.hexdigest(), spec[key])
+        self.assertEqual(spec["hash_manifest"]["deps_hash"], [["dependency GCC", "1" * 40]])
+
+    def test_changed_inputs(self) -> None:
+        self.store(zlib_spec())
+        for change in ({"recipe": "make -j install"}, {"commit_hash": "b" * 40},
+                       {"env": OrderedDict([("ZLIB_ROOT", "/opt")])}):
+            spec = zlib_spec()
+            spec.update(change)
+            cache = HashCache(self.path)
+            storeHashes("zlib", {"zlib": spec, "GCC": {"hash": "1" * 40}},
+                        considerRelocation=False, cache=cache)
+            self.assertEqual(cache.changed, ["zlib"])
+        # A dependency with a different hash changes the package's inputs too.
+        first = zlib_spec()
+        self.store(first)
+        spec = zlib_spec()
+        self.store(spec, gcc_hash="2" * 40)
+        self.assertNotEqual(spec["remote_revision_hash"], first["remote_revision_hash"])
+        self.assertNotEqual(spec["deps_hash"], first["deps_hash"])
+
+
 if __name__ == '__main__':
     unittest.main()
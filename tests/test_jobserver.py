@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from alibuild_helpers.cmd import execute
+from alibuild_helpers.jobserver import Jobserver, install_make_wrapper
+
+
+# Every target records how many targets are running while it starts.
+MAKEFILE = """\
+all: a b c d e f
+a b c d e f:
+\t@mkdir running/$@; ls running | wc -l >> counts; sleep 0.2; rmdir running/$@
+"""
+
+
+class JobserverTestCase(unittest.TestCase):
+  def test_tokens(self):
+    jobserver = Jobserver(4)
+    try:
+      self.assertEqual(jobserver.makeflags(), "-j4 --jobserver-auth=%d,%d --jobserver-fds=%d,%d"
+                       % (jobserver.fds + jobserver.fds))
+      self.assertEqual(jobserver.available(), 3)
+      os.set_blocking(jobserver.read_fd, False)
+      # One job runs without a token.
+      self.assertEqual(os.read(jobserver.read_fd, 100), b"+++")
+    finally:
+      jobserver.close()
+
+  def test_refill(self):
+    jobserver = Jobserver(4)
+    try:
+      with jobserver.running():
+        with jobserver.running():
+          # A build killed while holding two tokens.
+          os.read(jobserver.read_fd, 2)
+        # Another build may hold the missing tokens.
+        self.assertEqual(jobserver.available(), 1)
+      self.assertEqual(jobserver.available(), 3)
+    finally:
+      jobserver.close()
+
+  def run_make(self, command, jobs):
+    """Run COMMAND in a directory with MAKEFILE, and return the counts it records."""
+    jobserver = Jobserver(jobs)
+    with tempfile.TemporaryDirectory() as tmp:
+      with open(os.path.join(tmp, "Makefile"), "w") as f:
+        f.write(MAKEFILE)
+      os.mkdir(os.path.join(tmp, "running"))
+      install_make_wrapper(tmp)
+      env = dict(os.environ, MAKEFLAGS=jobserver.makeflags(),
+                 PATH=os.path.join(tmp, "wrapper-scripts") + ":" + os.environ["PATH"])
+      try:
+        err = execute(command % tmp, env=env, pass_fds=jobserver.fds)
+      finally:
+        jobserver.close()
+      self.assertEqual(err, 0)
+      with open(os.path.join(tmp, "counts")) as f:
+        return [int(line) for line in f]
+
+  @unittest.skipIf(shutil.which("make") is None, "make is not installed")
+  def test_make_shares_jobs(self):
+    # Without -j, make only runs parallel jobs thanks to the jobserver.
+    counts = self.run_make("make -C %s", 3)
+    self.assertEqual(len(counts), 6)
+    self.assertGreater(max(counts), 1)
+    self.assertLessEqual(max(counts), 3)
+
+  @unittest.skipIf(shutil.which("make") is None, "make is not installed")
+  def test_make_wrapper_drops_jobs(self):
+    # Recipes run make -j$JOBS, which would leave the jobserver.
+    for command in ("make -j6 -C %s", "make -C %s -j 6 all", "make --jobs=6 -C %s"):
+      counts = self.run_make(command, 2)
+      self.assertEqual(len(counts), 6)
+      self.assertLessEqual(max(counts), 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,139 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+from alibuild_helpers.locks import FileLock, PackageClaims, RevisionReservations
+from alibuild_helpers.scheduler import BuildScheduler, run_builds
+
+
+SPECS = {
+  "zlib": {"requires": []},
+  "bz2": {"requires": []},
+  "lzma": {"requires": []},
+  "ROOT": {"requires": ["zlib", "bz2", "lzma"]},
+  "O2": {"requires": ["ROOT"]},
+}
+BUILD_ORDER = ["zlib", "bz2", "lzma", "ROOT", "O2"]
+
+
+def try_lock(path, queue, shared=False):
+  queue.put(FileLock(path).acquire(blocking=False, shared=shared))
+
+
+def build_as_worker(work_dir):
+  """Build all packages, coordinating with other processes through WORK_DIR."""
+  claims = PackageClaims(os.path.join(work_dir, "BUILD", "locks"))
+
+  def installed(package):
+    return os.path.exists(os.path.join(work_dir, package))
+
+  def build(package, job):
+    with open(os.path.join(work_dir, "build.log"), "a") as log:
+      log.write("%s %d\n" % (package, os.getpid()))
+    time.sleep(0.3)
+    with open(os.path.join(work_dir, package), "w"):
+      pass
+    return 0
+
+  try:
+    run_builds(BuildScheduler(BUILD_ORDER, SPECS), 1, 1,
+               lambda package, jobs: None if installed(package) else package,
+               build, lambda package, job, result: None,
+               claim=lambda package: claims.claim(package, "0123"),
+               release=claims.release, poll_interval=0.05)
+  finally:
+    claims.release_all()
+
+
+class FileLockTestCase(unittest.TestCase):
+  def test_exclusive(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, "locks", "test.lock")
+      queue = multiprocessing.Queue()
+      lock = FileLock(path)
+      self.assertTrue(lock.acquire(blocking=False))
+      self.assertEqual(lock.holder().split()[-1], str(os.getpid()))
+      process = multiprocessing.Process(target=try_lock, args=(path, queue))
+      process.start()
+      self.assertFalse(queue.get(timeout=5))
+      process.join()
+      lock.release(remove=True)
+      self.assertFalse(os.path.exists(path))
+      process = multiprocessing.Process(target=try_lock, args=(path, queue))
+      process.start()
+      self.assertTrue(queue.get(timeout=5))
+      process.join()
+
+  def test_shared(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, "test.lock")
+      queue = multiprocessing.Queue()
+      lock = FileLock(path)
+      self.assertTrue(lock.acquire(blocking=False, shared=True))
+      for shared, expected in ((True, True), (False, False)):
+        process = multiprocessing.Process(target=try_lock, args=(path, queue, shared))
+        process.start()
+        self.assertEqual(queue.get(timeout=5), expected)
+        process.join()
+      lock.release()
+
+  def test_claims(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      claims = PackageClaims(tmp)
+      self.assertTrue(claims.claim("zlib", "0123"))
+      # Claiming a package we hold already succeeds.
+      self.assertTrue(claims.claim("zlib", "0123"))
+      self.assertEqual(os.listdir(tmp), ["zlib-0123.lock"])
+      claims.release_all()
+      self.assertEqual(os.listdir(tmp), [])
+
+  def test_revision_reservations(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      directory = os.path.join(tmp, "revisions", "zlib", "v1.2.3")
+      claims = PackageClaims(tmp)
+      claims.claim("zlib", "0123")
+      claims.claim("ROOT", "4567")
+      with RevisionReservations(directory) as reservations:
+        self.assertEqual(reservations.reserved(), {})
+        reservations.reserve("local1", "0123", claims.lock_path("zlib"))
+        # The lock is held while we choose.
+        self.assertFalse(FileLock(directory + ".lock").acquire(blocking=False))
+      with RevisionReservations(directory) as reservations:
+        reservations.reserve("local2", "4567", claims.lock_path("ROOT"))
+        reservations.reserve("local3", "89ab", claims.lock_path("ROOT"))
+        self.assertEqual(reservations.reserved(),
+                         {"local1": "0123", "local2": "4567", "local3": "89ab"})
+        # Only the holder of a reservation releases it.
+        reservations.release("local3", claims.lock_path("zlib"))
+        reservations.release("local2", claims.lock_path("ROOT"))
+        self.assertEqual(reservations.reserved(), {"local1": "0123", "local3": "89ab"})
+      # Reservations of holders that are gone are dropped.
+      claims.release("ROOT")
+      with RevisionReservations(directory) as reservations:
+        self.assertEqual(reservations.reserved(), {"local1": "0123"})
+        self.assertEqual(os.listdir(directory), ["local1"])
+      claims.release_all()
+
+
+class WorkersTestCase(unittest.TestCase):
+  def test_each_package_built_once(self):
+    with tempfile.TemporaryDirectory() as work_dir:
+      workers = [multiprocessing.Process(target=build_as_worker, args=(work_dir,))
+                 for _ in range(3)]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join(timeout=30)
+        self.assertEqual(worker.exitcode, 0)
+      with open(os.path.join(work_dir, "build.log")) as log:
+        built = [line.split() for line in log]
+      self.assertEqual(sorted(package for package, _ in built), sorted(BUILD_ORDER))
+      # The independent packages were shared between workers.
+      self.assertGreater(len({pid for _, pid in built}), 1)
+      self.assertEqual(os.listdir(os.path.join(work_dir, "BUILD", "locks")), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
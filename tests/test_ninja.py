@@ -0,0 +1,57 @@
+import os
+import unittest
+from argparse import Namespace
+from unittest.mock import patch
+
+from alibuild_helpers.ninja_plugin import generate_ninja, ninja_path, job_command
+
+
+def spec(package, requires=(), devel=False):
+  return {"package": package, "version": "v1", "revision": "1",
+          "requires": list(requires), "is_devel_pkg": devel}
+
+
+SPECS = {
+  "zlib": spec("zlib"),
+  "ROOT": spec("ROOT", ["zlib"]),
+  "O2": spec("O2", ["ROOT"], devel=True),
+}
+
+
+def job(package):
+  return {"command": "/bin/bash -e -x /sw/SPECS/%s/build.sh 2>&1" % package,
+          "env": None, "message": "Compiling %s@v1" % package}
+
+
+class NinjaPluginTestCase(unittest.TestCase):
+  def test_ninja_path(self):
+    self.assertEqual(ninja_path("/my sw/c:$x"), "/my$ sw/c$:$$x")
+
+  @patch.dict(os.environ, {"PATH": "/usr/bin"}, clear=True)
+  def test_job_command(self):
+    command = job_command({"command": "bash build.sh", "env": {"PATH": "/usr/bin", "JOBS": "4",
+                                                               "PKGNAME": "my zlib"}})
+    self.assertEqual(command, "env JOBS=4 'PKGNAME=my zlib' bash build.sh")
+    self.assertEqual(job_command({"command": "docker run ...", "env": None}), "docker run ...")
+
+  def test_generate_ninja(self):
+    args = Namespace(workDir="/sw", architecture="slc7_x86-64", pkgname=["O2"], builders=2)
+    # zlib is installed already, so it has no job.
+    ninja = generate_ninja(SPECS, args, ["zlib", "ROOT", "O2"],
+                           {"ROOT": job("ROOT"), "O2": job("O2")})
+    root = "/sw/slc7_x86-64/ROOT/v1-1/.build-hash"
+    o2 = "/sw/slc7_x86-64/O2/v1-1/.build-hash"
+    self.assertIn("pool builders\n  depth = 2\n", ninja)
+    self.assertIn("build %s: alibuild\n  command = /bin/bash -e -x /sw/SPECS/ROOT/build.sh 2>&1\n" % root,
+                  ninja)
+    # Development packages are always rebuilt.
+    self.assertIn("build always: phony\n", ninja)
+    self.assertIn("build %s: alibuild | %s always\n" % (o2, root), ninja)
+    self.assertIn("  pool = builders\n", ninja)
+    self.assertIn("build O2: phony %s\n" % o2, ninja)
+    self.assertTrue(ninja.endswith("default %s %s\n" % (root, o2)))
+    self.assertNotIn("zlib", ninja)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+from collections import OrderedDict
+
+from alibuild_helpers.git import Git
+from alibuild_helpers.plan import plan_path, inputs_fingerprint, read_plan, write_plan
+from alibuild_helpers.plan import record_finished, progress_path
+
+
+def make_args(config_dir, **kwds):
+  args = Namespace(pkgname=["O2"], defaults="o2", architecture="slc7_x86-64",
+                   disable=[], force_rebuild=[], noDevel=[], configDir=config_dir)
+  vars(args).update(kwds)
+  return args
+
+
+class PlanTestCase(unittest.TestCase):
+  def setUp(self) -> None:
+    self.tmp = tempfile.TemporaryDirectory()
+    self.config_dir = os.path.join(self.tmp.name, "alidist")
+    os.makedirs(self.config_dir)
+    self.write_recipe("package: zlib\nversion: v1\n---\n")
+
+  def tearDown(self) -> None:
+    self.tmp.cleanup()
+
+  def write_recipe(self, recipe):
+    with open(os.path.join(self.config_dir, "zlib.sh"), "w") as f:
+      f.write(recipe)
+
+  def test_plan_path(self):
+    self.assertEqual(plan_path("/sw", "slc7_x86-64", ["O2", "O2Physics"]),
+                     "/sw/SPECS/slc7_x86-64/plans/O2,O2Physics.json")
+    self.assertEqual(plan_path("/sw", "slc7_x86-64", ["O2"], "o2-epn"),
+                     "/sw/SPECS/slc7_x86-64/plans/O2@o2-epn.json")
+    # Long lists of packages are abbreviated.
+    path = plan_path("/sw", "slc7_x86-64", ["package%d" % i for i in range(100)])
+    self.assertRegex(path, r"^/sw/SPECS/slc7_x86-64/plans/100-packages-[0-9a-f]{12}\.json$")
+
+  def test_inputs_fingerprint(self):
+    args = make_args(self.config_dir)
+    fingerprint = inputs_fingerprint(args, "abcdef")
+    self.assertEqual(fingerprint, inputs_fingerprint(make_args(self.config_dir), "abcdef"))
+    self.assertNotEqual(fingerprint, inputs_fingerprint(args, "012345"))
+    self.assertNotEqual(fingerprint, inputs_fingerprint(
+      make_args(self.config_dir, defaults="release"), "abcdef"))
+    # Uncommitted changes to recipes count, too.
+    self.write_recipe("package: zlib\nversion: v2\n---\n")
+    self.assertNotEqual(fingerprint, inputs_fingerprint(args, "abcdef"))
+
+  def test_round_trip(self):
+    path = plan_path(self.tmp.name, "slc7_x86-64", ["zlib"])
+    specs = {"zlib": {
+      "package": "zlib", "version": "v1", "requires": [], "scm": Git(),
+      "env": OrderedDict([("B", "1"), ("A", "2")]),
+      "full_requires": {"b", "a"}, "full_runtime_requires": set(),
+      "full_build_requires": set(), "hash": "1234", "revision": "1",
+    }}
+    write_plan(path, "inputs", ["zlib"], specs, {"zlib"}, [], ["zlib"], [], "")
+    self.assertIsNone(read_plan(path, "other inputs"))
+    plan = read_plan(path, "inputs")
+    self.assertEqual(plan["build_order"], ["zlib"])
+    self.assertEqual(plan["finished"], {"zlib"})
+    self.assertEqual(plan["own_packages"], ["zlib"])
+    spec = plan["specs"]["zlib"]
+    self.assertIsInstance(spec["scm"], Git)
+    self.assertIsInstance(spec["env"], OrderedDict)
+    self.assertEqual(list(spec["env"]), ["B", "A"])
+    self.assertEqual(spec["full_requires"], {"a", "b"})
+    self.assertEqual(spec["hash"], "1234")
+
+  def test_progress(self):
+    path = plan_path(self.tmp.name, "slc7_x86-64", ["zlib"])
+    specs = OrderedDict((p, {"package": p, "requires": [], "full_requires": set(),
+                             "full_runtime_requires": set(), "full_build_requires": set()})
+                        for p in ("zlib", "ROOT"))
+    write_plan(path, "inputs", ["zlib", "ROOT"], specs, set(), [], [], [], "")
+    record_finished(path, dict(specs["zlib"], hash="1234", revision="2"))
+    # A line cut short by a crash is ignored.
+    with open(progress_path(path), "a") as f:
+      f.write('{"package": "RO')
+    plan = read_plan(path, "inputs")
+    self.assertEqual(plan["finished"], {"zlib"})
+    self.assertEqual(plan["specs"]["zlib"]["revision"], "2")
+    self.assertEqual(plan["specs"]["zlib"]["full_requires"], set())
+    self.assertNotIn("hash", plan["specs"]["ROOT"])
+    # A new plan starts without progress.
+    write_plan(path, "inputs", ["zlib", "ROOT"], specs, set(), [], [], [], "")
+    self.assertEqual(read_plan(path, "inputs")["finished"], set())
+    self.assertFalse(os.path.exists(progress_path(path)))
+
+  def test_unusable_plan(self):
+    path = plan_path(self.tmp.name, "slc7_x86-64", ["zlib"])
+    self.assertIsNone(read_plan(path, "inputs"))
+    # Specs that cannot be stored leave no (partial) plan behind.
+    write_plan(path, "inputs", ["zlib"], {"zlib": {"x": object()}}, set(), [], [], [], "")
+    self.assertEqual(os.listdir(os.path.dirname(path)), [])
+    self.assertIsNone(read_plan(path, "inputs"))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,141 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from alibuild_helpers.prefetch import Prefetcher
+from alibuild_helpers.utilities import resolve_store_path, resolve_links_path
+
+
+ARCH = "slc7_x86-64"
+
+
+def make_spec(package, pkg_hash, is_devel_pkg=False):
+  return {"package": package, "version": "v1", "is_devel_pkg": is_devel_pkg,
+          "remote_hashes": [pkg_hash], "local_hashes": [pkg_hash + "0"]}
+
+
+class FakeSync:
+  def __init__(self, work_dir, size=100) -> None:
+    self.work_dir = work_dir
+    self.size = size
+    self.symlinks = []
+    self.tarballs = []
+
+  def fetch_symlinks(self, spec) -> None:
+    self.symlinks.append(spec["package"])
+    links = os.path.join(self.work_dir, resolve_links_path(ARCH, spec["package"]))
+    os.makedirs(links, exist_ok=True)
+    tarball = "%s-v1-1.%s.tar.gz" % (spec["package"], ARCH)
+    os.symlink("../../" + resolve_store_path(ARCH, spec["remote_hashes"][0]) + "/" + tarball,
+               os.path.join(links, tarball))
+
+  def tarball_size(self, spec):
+    assert spec["hash"] == spec["remote_hashes"][0] and spec["revision"] == "1"
+    return self.size
+
+  def fetch_tarball(self, spec) -> None:
+    self.tarballs.append(spec["package"])
+    store = os.path.join(self.work_dir, resolve_store_path(ARCH, spec["remote_hashes"][0]))
+    os.makedirs(store, exist_ok=True)
+    with open(os.path.join(store, "%s-v1-1.%s.tar.gz" % (spec["package"], ARCH)), "wb") as f:
+      f.write(b"x" * self.size)
+
+
+class PrefetcherTestCase(unittest.TestCase):
+  def setUp(self) -> None:
+    self.tmp = tempfile.TemporaryDirectory()
+    self.work_dir = self.tmp.name
+
+  def tearDown(self) -> None:
+    self.tmp.cleanup()
+
+  def prefetch(self, sync, specs, disk_budget=10**9):
+    prefetcher = Prefetcher(sync, self.work_dir, ARCH, 1, disk_budget)
+    for spec in specs:
+      prefetcher.schedule(spec)
+      prefetcher.schedule(spec)   # scheduling twice does nothing
+    # With a single worker, packages are fetched one after the other.
+    prefetcher.executor.submit(lambda: None).result()
+    return prefetcher
+
+  def test_prefetch(self):
+    sync = FakeSync(self.work_dir)
+    specs = [make_spec("zlib", "aa11"), make_spec("O2", "bb22", is_devel_pkg=True)]
+    prefetcher = self.prefetch(sync, specs)
+    self.assertEqual(sync.symlinks, ["zlib", "O2"])
+    # Development packages never use tarballs.
+    self.assertEqual(sync.tarballs, ["zlib"])
+    self.assertEqual(prefetcher.prefetched_bytes, {"zlib": 100})
+    # The symlinks need not be fetched again, but only the first time.
+    self.assertTrue(prefetcher.wait("zlib"))
+    self.assertFalse(prefetcher.wait("zlib"))
+    self.assertFalse(prefetcher.wait("unknown"))
+    self.assertEqual(prefetcher.prefetched_bytes, {})
+    prefetcher.shutdown()
+
+  def test_disk_budget(self):
+    sync = FakeSync(self.work_dir, size=60)
+    specs = [make_spec("zlib", "aa11"), make_spec("bz2", "cc33")]
+    prefetcher = self.prefetch(sync, specs, disk_budget=100)
+    self.assertEqual(sync.symlinks, ["zlib", "bz2"])
+    self.assertEqual(sync.tarballs, ["zlib"])
+    prefetcher.shutdown()
+
+  def test_disk_budget_reserved(self):
+    # Both downloads start before either has finished.
+    started = threading.Barrier(2, timeout=1)
+
+    class SlowSync(FakeSync):
+      def fetch_tarball(self, spec) -> None:
+        try:
+          started.wait()
+        except threading.BrokenBarrierError:
+          pass
+        super().fetch_tarball(spec)
+
+    sync = SlowSync(self.work_dir, size=60)
+    prefetcher = Prefetcher(sync, self.work_dir, ARCH, 2, 100)
+    for spec in make_spec("zlib", "aa11"), make_spec("bz2", "cc33"):
+      prefetcher.schedule(spec)
+    prefetcher.wait("zlib")
+    prefetcher.wait("bz2")
+    self.assertEqual(len(sync.tarballs), 1)
+    prefetcher.shutdown()
+
+  def test_failed_download_releases_budget(self):
+    class FailingSync(FakeSync):
+      def fetch_tarball(self, spec) -> None:
+        if spec["package"] == "zlib":
+          raise OSError("connection reset")
+        super().fetch_tarball(spec)
+
+    sync = FailingSync(self.work_dir, size=60)
+    prefetcher = self.prefetch(sync, [make_spec("zlib", "aa11"), make_spec("bz2", "cc33")],
+                               disk_budget=100)
+    self.assertEqual(sync.tarballs, ["bz2"])
+    self.assertEqual(prefetcher.prefetched_bytes, {"bz2": 60})
+    prefetcher.shutdown()
+
+  def test_skip_installed(self):
+    install_dir = os.path.join(self.work_dir, ARCH, "zlib", "v1-1")
+    os.makedirs(install_dir)
+    with open(os.path.join(install_dir, ".build-hash"), "w") as f:
+      f.write("aa11\n")
+    sync = FakeSync(self.work_dir)
+    self.prefetch(sync, [make_spec("zlib", "aa11")]).shutdown()
+    self.assertEqual(sync.tarballs, [])
+
+  def test_errors_ignored(self):
+    class FailingSync(FakeSync):
+      def fetch_symlinks(self, spec) -> None:
+        sys.exit(1)
+    prefetcher = self.prefetch(FailingSync(self.work_dir), [make_spec("zlib", "aa11")])
+    # The symlinks must be fetched again.
+    self.assertFalse(prefetcher.wait("zlib"))
+    prefetcher.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,340 @@
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from alibuild_helpers.cmd import execute
+from alibuild_helpers.scheduler import BuildScheduler, run_builds
+from alibuild_helpers.scheduler import read_durations, record_duration, expected_durations
+from alibuild_helpers.scheduler import assign_shards
+from alibuild_helpers.scheduler import read_resource_usage, record_resource_usage, expected_needs
+from alibuild_helpers.scheduler import ResourceBudget, available_cpus, GiB
+
+
+SPECS = {
+  "zlib": {"requires": []},
+  "bz2": {"requires": []},
+  "ROOT": {"requires": ["zlib", "bz2", "defaults-release"]},
+  "O2": {"requires": ["ROOT"]},
+}
+BUILD_ORDER = ["zlib", "bz2", "ROOT", "O2"]
+
+
+class BuildSchedulerTestCase(unittest.TestCase):
+  def test_ready(self):
+    scheduler = BuildScheduler(BUILD_ORDER, SPECS)
+    # Dependencies outside of the build order are ignored.
+    self.assertEqual(scheduler.ready(), ["zlib", "bz2"])
+    scheduler.start("zlib")
+    self.assertEqual(scheduler.ready(), ["bz2"])
+    scheduler.finish("zlib")
+    self.assertEqual(scheduler.ready(), ["bz2"])
+    scheduler.finish("bz2")
+    self.assertEqual(scheduler.ready(), ["ROOT"])
+    self.assertFalse(scheduler.done())
+
+  def test_retry(self):
+    scheduler = BuildScheduler(BUILD_ORDER, SPECS)
+    scheduler.start("bz2")
+    scheduler.retry("bz2")
+    self.assertEqual(scheduler.ready(), ["bz2", "zlib"])
+    for package in BUILD_ORDER:
+      scheduler.finish(package)
+    self.assertTrue(scheduler.done())
+
+  def test_critical_path(self):
+    specs = dict(SPECS, GEANT4={"requires": []}, O2={"requires": ["ROOT", "GEANT4"]})
+    build_order = ["zlib", "bz2", "GEANT4", "ROOT", "O2"]
+    durations = {"zlib": 10, "bz2": 20, "GEANT4": 600, "ROOT": 1200, "O2": 900}
+    scheduler = BuildScheduler(build_order, specs, durations)
+    self.assertEqual(scheduler.critical_path,
+                     {"zlib": 2110, "bz2": 2120, "GEANT4": 1500, "ROOT": 2100, "O2": 900})
+    self.assertEqual(scheduler.ready(), ["bz2", "zlib", "GEANT4"])
+    # Packages whose build script ran are checked before anything else.
+    scheduler.start("GEANT4")
+    scheduler.retry("GEANT4")
+    self.assertEqual(scheduler.ready(), ["GEANT4", "bz2", "zlib"])
+
+  def test_fail(self):
+    specs = dict(SPECS, GEANT4={"requires": []}, O2={"requires": ["ROOT", "GEANT4"]})
+    scheduler = BuildScheduler(["zlib", "bz2", "GEANT4", "ROOT", "O2"], specs)
+    scheduler.start("zlib")
+    scheduler.fail("zlib")
+    # Everything depending on the failed package, even indirectly, is blocked.
+    self.assertEqual(scheduler.failed, {"zlib"})
+    self.assertEqual(scheduler.blocked, {"ROOT", "O2"})
+    self.assertEqual(scheduler.ready(), ["bz2", "GEANT4"])
+    scheduler.finish("bz2")
+    scheduler.finish("GEANT4")
+    self.assertTrue(scheduler.done())
+
+
+class DurationsTestCase(unittest.TestCase):
+  def test_record_duration(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, "SPECS", "build-durations.json")
+      self.assertEqual(read_durations(path), {})
+      record_duration(path, "ROOT", "v6-30", 1200.04)
+      record_duration(path, "ROOT", "v6-32", 1500)
+      record_duration(path, "zlib", "v1.3", 5)
+      self.assertEqual(read_durations(path), {
+        "ROOT": {"v6-30": 1200.0, "v6-32": 1500},
+        "zlib": {"v1.3": 5},
+      })
+      self.assertEqual(os.listdir(os.path.dirname(path)), ["build-durations.json"])
+
+  def test_expected_durations(self):
+    specs = {p: {"version": "v1", "requires": []} for p in ("zlib", "ROOT", "O2")}
+    durations = {"zlib": {"v1": 10}, "ROOT": {"v0": 100, "v0.9": 50}}
+    self.assertEqual(expected_durations(durations, specs, ["zlib", "ROOT", "O2"]),
+                     {"zlib": 10, "ROOT": 100, "O2": 55})
+    self.assertEqual(expected_durations({}, specs, ["zlib"]), {"zlib": 0})
+
+  def test_assign_shards(self):
+    durations = {"zlib": 10, "bz2": 100, "ROOT": 50, "O2": 20}
+    # ROOT could start on either shard once bz2 is done, so it stays with bz2.
+    self.assertEqual(assign_shards(BUILD_ORDER, SPECS, durations, 2),
+                     {"zlib": 1, "bz2": 2, "ROOT": 2, "O2": 2})
+    self.assertEqual(assign_shards(BUILD_ORDER, SPECS, {}, 2),
+                     {"zlib": 1, "bz2": 2, "ROOT": 2, "O2": 2})
+    self.assertEqual(assign_shards(BUILD_ORDER, SPECS, durations, 1),
+                     dict.fromkeys(BUILD_ORDER, 1))
+    # Independent packages are spread out.
+    specs = {p: {"requires": []} for p in "abcd"}
+    self.assertEqual(assign_shards(list("abcd"), specs, {"a": 30, "b": 10, "c": 10, "d": 10}, 2),
+                     {"a": 1, "b": 2, "c": 2, "d": 2})
+
+
+class ResourcesTestCase(unittest.TestCase):
+  def test_record_resource_usage(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, "build-resources.json")
+      record_resource_usage(path, "ROOT", 8, 100, {"max_rss": 2 * GiB, "cpu_time": 250})
+      self.assertEqual(read_resource_usage(path), {
+        "ROOT": {"jobs": 8, "memory_per_job": 2 * GiB, "parallelism": 2.5},
+      })
+
+  def test_expected_needs(self):
+    specs = {
+      "zlib": {},
+      "ROOT": {"memory_per_job": "1.5", "max_jobs": 32},
+      "O2": {"memory_per_job": 4},
+    }
+    stats = {
+      # ROOT kept its 16 jobs busy and used more memory than declared.
+      "ROOT": {"jobs": 16, "memory_per_job": 2 * GiB, "parallelism": 15},
+      # O2 only kept 4 CPUs busy with 16 jobs.
+      "O2": {"jobs": 16, "memory_per_job": GiB, "parallelism": 4},
+      # zlib was only given 2 jobs, so this shows nothing.
+      "zlib": {"jobs": 2, "memory_per_job": 0, "parallelism": 1.5},
+    }
+    self.assertEqual(expected_needs(stats, specs, ["zlib", "ROOT", "O2"]), {
+      "zlib": (0, None),
+      "ROOT": (2 * GiB, 32),
+      "O2": (4 * GiB, 5),
+    })
+
+  def test_limit_does_not_ratchet(self):
+    specs = {"O2": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, "build-resources.json")
+      record_resource_usage(path, "O2", 16, 100, {"max_rss": GiB, "cpu_time": 300})
+      self.assertEqual(expected_needs(read_resource_usage(path), specs, ["O2"]), {"O2": (GiB, 4)})
+      # Limited to 4 jobs, O2 kept fewer CPUs busy still.
+      record_resource_usage(path, "O2", 4, 100, {"max_rss": GiB, "cpu_time": 200})
+      self.assertEqual(expected_needs(read_resource_usage(path), specs, ["O2"]), {"O2": (GiB, 4)})
+
+  def test_budget(self):
+    budget = ResourceBudget(16, 24 * GiB, {"ROOT": (2 * GiB, None),
+                                           "GEANT4": (2 * GiB, None),
+                                           "O2": (4 * GiB, None),
+                                           "zlib": (0, 2)})
+    self.assertEqual(budget.reserve("ROOT", 8), 8)
+    # Only 2 jobs' worth of memory is left for O2.
+    self.assertEqual(budget.reserve("O2", 8), 2)
+    # No memory is left, but packages that need none can still use CPUs.
+    self.assertEqual(budget.reserve("zlib", 8), 2)
+    self.assertIsNone(budget.reserve("GEANT4", 8))
+    budget.release("ROOT")
+    self.assertEqual(budget.reserve("GEANT4", 8), 8)
+    # With nothing else running, a build always starts.
+    budget = ResourceBudget(4, GiB, {"O2": (4 * GiB, None)})
+    self.assertEqual(budget.reserve("O2", 4), 1)
+
+  def test_available_cpus(self):
+    with patch("alibuild_helpers.scheduler._cgroup_file",
+               new=lambda v2, v1: "150000 100000" if v2 == "cpu.max" else None), \
+         patch("os.sched_getaffinity", create=True, new=lambda pid: set(range(8))):
+      self.assertEqual(available_cpus(), 2)
+    with patch("alibuild_helpers.scheduler._cgroup_file", new=lambda v2, v1: "max 100000"), \
+         patch("os.sched_getaffinity", create=True, new=lambda pid: set(range(8))):
+      self.assertEqual(available_cpus(), 8)
+
+
+def build_until_stopped(pidfile):
+  """Run a build that never finishes, and exit with 3 once it was interrupted."""
+  def build(package, job):
+    return execute("sleep 60 & echo $! > %s; wait" % pidfile, lambda *args: None,
+                   new_group=True)
+  try:
+    run_builds(BuildScheduler(["zlib"], SPECS), 1, 1, lambda package, jobs: package,
+               build, lambda package, job, result: None)
+  except KeyboardInterrupt:
+    sys.exit(3)
+
+
+def process_running(pid):
+  """Check if PID is running, and not just waiting to be reaped."""
+  try:
+    with open("/proc/%d/stat" % pid) as f:
+      return f.read().rpartition(")")[2].split()[0] != "Z"
+  except FileNotFoundError:
+    return False
+
+
+class RunBuildsTestCase(unittest.TestCase):
+  def run_all(self, builders, jobs=8):
+    built, shares, events = set(), {}, []
+    lock = threading.Lock()
+    independent_started = threading.Barrier(2 if builders > 1 else 1, timeout=5)
+
+    def prepare(package, share):
+      events.append(("prepare", package))
+      if package in built:
+        return None
+      shares[package] = share
+      return package
+
+    def build(package, job):
+      if package in ("zlib", "bz2"):
+        # Only returns if both independent packages build at the same time.
+        independent_started.wait()
+      with lock:
+        events.append(("build", package))
+      return 0
+
+    def complete(package, job, result):
+      self.assertEqual(result, 0)
+      built.add(package)
+
+    run_builds(BuildScheduler(BUILD_ORDER, SPECS), builders, jobs,
+               prepare, build, complete)
+    return built, shares, events
+
+  def test_sequential(self):
+    built, shares, events = self.run_all(builders=1)
+    self.assertEqual(built, set(BUILD_ORDER))
+    self.assertEqual(shares, dict.fromkeys(BUILD_ORDER, 8))
+    # With a single builder, packages are processed strictly in build order,
+    # and every package is prepared again right after it was built.
+    self.assertEqual(events, [(step, p) for p in BUILD_ORDER
+                              for step in ("prepare", "build", "prepare")])
+
+  def test_parallel(self):
+    built, shares, events = self.run_all(builders=4)
+    self.assertEqual(built, set(BUILD_ORDER))
+    # The two independent packages share the available jobs.
+    self.assertEqual(shares, {"zlib": 4, "bz2": 4, "ROOT": 8, "O2": 8})
+    builds = [p for step, p in events if step == "build"]
+    self.assertEqual(sorted(builds[:2]), ["bz2", "zlib"])
+    self.assertEqual(builds[2:], ["ROOT", "O2"])
+
+  def test_resources(self):
+    running, overlapped, shares, claimed = set(), [], {}, set()
+    lock = threading.Lock()
+
+    def build(package, job):
+      with lock:
+        overlapped.append(bool(running))
+        running.add(package)
+      threading.Event().wait(0.05)
+      with lock:
+        # Packages waiting for resources are left for other workers.
+        self.assertEqual(claimed, {package})
+        running.discard(package)
+      return 0
+
+    def prepare(package, jobs):
+      if package in shares:
+        return None
+      shares[package] = jobs
+      return package
+
+    # Both independent packages need all the memory, so they run one by one.
+    needs = dict.fromkeys(BUILD_ORDER, (GiB, None))
+    run_builds(BuildScheduler(BUILD_ORDER, SPECS), 4, 8, prepare, build,
+               lambda package, job, result: None,
+               claim=lambda package: claimed.add(package) or True,
+               release=claimed.discard,
+               resources=ResourceBudget(8, 4 * GiB, needs))
+    self.assertEqual(overlapped, [False] * len(BUILD_ORDER))
+    self.assertEqual(claimed, set())
+    self.assertEqual(shares, {"zlib": 4, "bz2": 4, "ROOT": 4, "O2": 4})
+
+  def test_failure_waits_for_running_builds(self):
+    finished = []
+
+    def build(package, job):
+      if package == "bz2":
+        return 1
+      finished.append(package)
+      return 0
+
+    def complete(package, job, result):
+      if result:
+        raise RuntimeError(package)
+
+    with self.assertRaises(RuntimeError):
+      run_builds(BuildScheduler(BUILD_ORDER, SPECS), 2, 8,
+                 lambda package, jobs: package, build, complete)
+    # Nothing depending on the failed package was started.
+    self.assertNotIn("ROOT", finished)
+
+  def test_keep_going(self):
+    specs = dict(SPECS, GEANT4={"requires": []}, O2={"requires": ["ROOT", "GEANT4"]})
+    scheduler = BuildScheduler(["zlib", "bz2", "GEANT4", "ROOT", "O2"], specs)
+    built = set()
+
+    def prepare(package, jobs):
+      return None if package in built else package
+
+    def complete(package, job, result):
+      if result:
+        return False
+      built.add(package)
+
+    run_builds(scheduler, 2, 8, prepare,
+               lambda package, job: 1 if package == "bz2" else 0, complete)
+    self.assertEqual(built, {"zlib", "GEANT4"})
+    self.assertEqual(scheduler.failed, {"bz2"})
+    self.assertEqual(scheduler.blocked, {"ROOT", "O2"})
+
+
+  @unittest.skipIf(not os.path.isdir("/proc/self"), "needs /proc")
+  def test_sigterm_stops_builds(self):
+    # Cancelled CI jobs get SIGTERM, which must stop the builds running in
+    # their own process groups like Ctrl-C does.
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+      with tempfile.TemporaryDirectory() as tmp:
+        pidfile = os.path.join(tmp, "pid")
+        process = multiprocessing.Process(target=build_until_stopped, args=(pidfile,))
+        process.start()
+        deadline = time.monotonic() + 10
+        while not os.path.exists(pidfile) or not os.path.getsize(pidfile):
+          self.assertLess(time.monotonic(), deadline)
+          time.sleep(0.05)
+        with open(pidfile) as f:
+          pid = int(f.read())
+        os.kill(process.pid, signum)
+        process.join(timeout=10)
+        self.assertEqual(process.exitcode, 3)
+        self.assertFalse(process_running(pid))
+
+
+if __name__ == '__main__':
+  unittest.main()
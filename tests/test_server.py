@@ -0,0 +1,185 @@
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from argparse import Namespace
+from collections import OrderedDict
+from unittest.mock import patch
+
+from alibuild_helpers.server import ResolutionStore, ServerClient, ServerCache, file_stamp
+from alibuild_helpers.server import _Server, _RequestHandler
+from alibuild_helpers.build import hash_local_changes, execute
+from alibuild_helpers.git import Git
+from alibuild_helpers.watch import SourceWatcher, _inotify
+
+
+def wait_for(condition, timeout=5):
+  deadline = time.time() + timeout
+  while not condition() and time.time() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+
+class ResolutionStoreTestCase(unittest.TestCase):
+  def test_stamps(self):
+    store = ResolutionStore(max_age=60)
+    self.assertEqual(store.handle({"op": "get", "kind": "recipes", "key": ["zlib.sh"], "stamp": [1]}),
+                     {"found": False})
+    store.handle({"op": "put", "kind": "recipes", "key": ["zlib.sh"], "stamp": [1], "value": "x"})
+    self.assertEqual(store.handle({"op": "get", "kind": "recipes", "key": ["zlib.sh"], "stamp": [1]}),
+                     {"found": True, "value": "x"})
+    # A different stamp invalidates the entry.
+    self.assertEqual(store.handle({"op": "get", "kind": "recipes", "key": ["zlib.sh"], "stamp": [2]}),
+                     {"found": False})
+    self.assertEqual(store.handle({"op": "get", "kind": "recipes", "key": ["zlib.sh"], "stamp": [1]}),
+                     {"found": False})
+
+  def test_max_age(self):
+    store = ResolutionStore(max_age=60)
+    with patch("alibuild_helpers.server.time.time", return_value=1000):
+      store.handle({"op": "put", "kind": "checks", "key": ["zlib"], "stamp": None, "value": [0, ""]})
+    with patch("alibuild_helpers.server.time.time", return_value=1059):
+      self.assertTrue(store.handle({"op": "get", "kind": "checks", "key": ["zlib"], "stamp": None})["found"])
+    with patch("alibuild_helpers.server.time.time", return_value=1061):
+      self.assertFalse(store.handle({"op": "get", "kind": "checks", "key": ["zlib"], "stamp": None})["found"])
+
+
+class ServerCacheTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    path = os.path.join(self.tmp.name, "server.sock")
+    self.server = _Server(path, _RequestHandler)
+    self.server.store = ResolutionStore()
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.client = ServerClient.connect(path)
+
+  def tearDown(self):
+    self.client.close()
+    self.server.shutdown()
+    self.server.server_close()
+    self.tmp.cleanup()
+
+  def test_no_server(self):
+    self.assertIsNone(ServerClient.connect(os.path.join(self.tmp.name, "missing.sock")))
+
+  def test_other_user(self):
+    path = os.path.join(self.tmp.name, "server.sock")
+    # Sockets of other users are not used, as they could answer anything.
+    with patch("alibuild_helpers.server.os.getuid", return_value=os.getuid() + 1), \
+         patch("alibuild_helpers.server.warning") as mock_warning:
+      self.assertIsNone(ServerClient.connect(path))
+    mock_warning.assert_called_once()
+    # Neither are servers run by other users, even if the socket is ours.
+    with patch("alibuild_helpers.server._peer_uid", return_value=os.getuid() + 1), \
+         patch("alibuild_helpers.server.warning") as mock_warning:
+      self.assertIsNone(ServerClient.connect(path))
+    mock_warning.assert_called_once()
+
+  def test_checks(self):
+    args = Namespace(docker=False, dockerImage=None, environment=[], referenceSources=self.tmp.name)
+    cache = ServerCache(self.client, args)
+    self.assertNotIn(("zlib", "true"), cache.checks)
+    cache.checks["zlib", "true"] = (0, "found")
+    # Another client sees the result, as long as it runs the check the same way.
+    cache = ServerCache(self.client, args)
+    self.assertIn(("zlib", "true"), cache.checks)
+    self.assertEqual(cache.checks["zlib", "true"], [0, "found"])
+    args.environment = ["FOO=bar"]
+    self.assertNotIn(("zlib", "true"), ServerCache(self.client, args).checks)
+
+  def test_recipes(self):
+    cache = ServerCache(self.client, Namespace())
+    recipe = os.path.join(self.tmp.name, "zlib.sh")
+    with open(recipe, "w") as f:
+      f.write("package: zlib\n---\n")
+    spec = OrderedDict([("package", "zlib"), ("env", OrderedDict([("A", "1")]))])
+    cache.recipes[recipe] = None, spec, "make"
+    err, cached, script = cache.recipes[recipe]
+    self.assertEqual((err, cached, script), (None, spec, "make"))
+    self.assertIsInstance(cached["env"], OrderedDict)
+    # Changing the recipe invalidates the entry.
+    stamp = file_stamp(recipe)
+    with open(recipe, "a") as f:
+      f.write("make install\n")
+    self.assertNotEqual(file_stamp(recipe), stamp)
+    self.assertNotIn(recipe, cache.recipes)
+    # Values that do not survive being sent to the server are not saved.
+    cache.recipes[recipe] = None, {1: "a"}, "make"
+    self.assertNotIn(recipe, cache.recipes)
+
+  def test_refs(self):
+    refs = None, {"refs/heads/master": "0" * 40}
+    # Without a mirror, the refs of the remote repository are never kept.
+    cache = ServerCache(self.client, Namespace(referenceSources=None))
+    cache.refs["zlib", "https://example.com/zlib"] = refs
+    self.assertNotIn(("zlib", "https://example.com/zlib"), cache.refs)
+    cache = ServerCache(self.client, Namespace(referenceSources=self.tmp.name))
+    cache.refs["zlib", "https://example.com/zlib"] = refs
+    self.assertNotIn(("zlib", "https://example.com/zlib"), cache.refs)
+    # With one, they are kept until it is fetched again.
+    mirror = os.path.join(self.tmp.name, "zlib")
+    os.makedirs(os.path.join(mirror, "refs", "heads"))
+    cache.refs["zlib", "https://example.com/zlib"] = refs
+    self.assertIn(("zlib", "https://example.com/zlib"), cache.refs)
+    with open(os.path.join(mirror, "FETCH_HEAD"), "w") as f:
+      f.write("0" * 40 + "\t\tbranch 'master'\n")
+    self.assertNotIn(("zlib", "https://example.com/zlib"), cache.refs)
+
+
+  @unittest.skipIf(_inotify() is None, "needs inotify")
+  def test_local_changes(self):
+    repo = os.path.join(self.tmp.name, "zlib")
+    subprocess.check_call(["git", "init", "-q", repo])
+    with open(os.path.join(repo, "zlib.c"), "w") as f:
+      f.write("int x;\n")
+    subprocess.check_call(["git", "add", "zlib.c"], cwd=repo)
+    subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@test",
+                           "commit", "-q", "-m", "init"], cwd=repo)
+    spec = {"source": repo, "scm": Git()}
+    cache = ServerCache(self.client, Namespace())
+    with patch("alibuild_helpers.build.execute", wraps=execute) as mock_execute:
+      first, _ = hash_local_changes(spec, cache=cache)
+      self.assertEqual(mock_execute.call_count, 1)
+      # Nothing changed, so the sources are not scanned again.
+      self.assertEqual(hash_local_changes(spec, cache=cache), (first, []))
+      self.assertEqual(mock_execute.call_count, 1)
+      generation = self.server.store.watcher.generation(repo)
+      with open(os.path.join(repo, "zlib.c"), "a") as f:
+        f.write("int y;\n")
+      self.assertTrue(wait_for(lambda: self.server.store.watcher.generation(repo) != generation))
+      second, _ = hash_local_changes(spec, cache=cache)
+      self.assertEqual(mock_execute.call_count, 2)
+      self.assertNotEqual(second, first)
+      self.assertEqual(second, hash_local_changes(spec)[0])
+
+
+@unittest.skipIf(_inotify() is None, "needs inotify")
+class SourceWatcherTestCase(unittest.TestCase):
+  def test_generation(self):
+    with tempfile.TemporaryDirectory() as top:
+      os.makedirs(os.path.join(top, ".git", "refs"))
+      watcher = SourceWatcher()
+      generation = watcher.generation(top)
+      self.assertEqual(generation, 0)
+      # Only the top level of repository metadata is watched, and git's lock
+      # files are not changes.
+      for path in (os.path.join(".git", "index.lock"), os.path.join(".git", "refs", "main")):
+        with open(os.path.join(top, path), "w") as f:
+          f.write("x")
+      time.sleep(0.1)
+      self.assertEqual(watcher.generation(top), generation)
+      # New directories are watched too.
+      os.makedirs(os.path.join(top, "src", "new"))
+      self.assertTrue(wait_for(lambda: watcher.generation(top) != generation))
+      time.sleep(0.1)
+      generation = watcher.generation(top)
+      with open(os.path.join(top, "src", "new", "file.c"), "w") as f:
+        f.write("x")
+      self.assertTrue(wait_for(lambda: watcher.generation(top) != generation))
+      self.assertIsNone(watcher.generation(os.path.join(top, "missing")))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -10,6 +10,7 @@ from alibuild_helpers.utilities import prunePaths
 from alibuild_helpers.utilities import resolve_version
 from alibuild_helpers.utilities import topological_sort
 from alibuild_helpers.utilities import resolveFilename, resolveDefaultsFilename
+from alibuild_helpers.utilities import getAllPackages, symlink
 from alibuild_helpers.utilities import docker_platform_for
 import alibuild_helpers
 
@@ -24,6 +25,7 @@ class DockerPlatformTestCase(unittest.TestCase):
         self.assertIsNone(docker_platform_for(""))
 import os
 import string
+import tempfile
 
 UBUNTU_1510_OS_RELEASE = """
 NAME="Ubuntu"
@@ -432,6 +434,36 @@ class TestUtilities(unittest.TestCase):
           self.assertEqual(resolveFilename({}, "zlib", "alidost"), (None, None))
           self.assertEqual(resolveFilename({}, "python", "alidist"), ("/bar/python.sh", "/bar"))
 
+  def test_getAllPackages(self) -> None:
+      recipes = {
+          "defaults-o2.sh": "package: defaults-o2\nversion: v1\n---\n",
+          "zlib.sh": "package: zlib\nversion: v1\n---\n",
+          "root.sh": "package: ROOT\nversion: v6\nrequires:\n  - zlib\n---\n",
+          "only-release.sh": "package: only-release\nversion: v1\nvalid_defaults: release\n---\n",
+          "make.sh": "package: make\nversion: v1\nsystem_requirement: .*\n---\n",
+          "disabled.sh": "package: disabled\nversion: v1\n---\n",
+          "broken.sh": "broken\n",
+      }
+      with tempfile.TemporaryDirectory() as config_dir, \
+           patch("alibuild_helpers.utilities.warning") as mock_warning:
+          for name, recipe in recipes.items():
+              with open(os.path.join(config_dir, name), "w") as f:
+                  f.write(recipe)
+          self.assertEqual(getAllPackages(config_dir, "o2", disable=["disabled"]),
+                           ["ROOT", "zlib"])
+          self.assertEqual(mock_warning.call_count, 1)
+
+  def test_symlink(self) -> None:
+      with tempfile.TemporaryDirectory() as tmp:
+          os.mkdir(os.path.join(tmp, "v1"))
+          os.mkdir(os.path.join(tmp, "v2"))
+          link = os.path.join(tmp, "latest")
+          symlink("v1", link)
+          # An existing link is replaced, even if it points to a directory.
+          symlink("v2", link)
+          self.assertEqual(os.readlink(link), "v2")
+          self.assertEqual(sorted(os.listdir(tmp)), ["latest", "v1", "v2"])
+
 
 class TestTopologicalSort(unittest.TestCase):
     """Check that various properties of topological sorting hold."""